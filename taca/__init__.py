@@ -1,4 +1,4 @@
 """ Main TACA module
 """
 
-__version__ = '0.5.2'
+__version__ = '0.30.0'
@@ -4,24 +4,104 @@ Analysis methods for TACA
 import glob
 import logging
 import os
+import threading
+import time
 
+from datetime import datetime, timedelta
+
+from multiprocessing.pool import ThreadPool
+
+from taca.analysis import scheduler
+from taca.analysis.cache import RunMetadataCache
+from taca.analysis.watch import RunWatcher
 from taca.illumina.NextSeq_Runs import NextSeq_Run
 from taca.utils.config import CONFIG
+from taca.utils import filesystem, ssh
+from taca.utils.ledger import TransferMetrics
 
 from flowcell_parser.classes import RunParametersParser
 
 logger = logging.getLogger(__name__)
 
-def get_runObj(run):
+def get_metadata_cache():
+    """ Return the run metadata cache, kept in the status directory unless
+        analysis.metadata_cache says otherwise
+        :rtype: taca.analysis.cache.RunMetadataCache
+        :returns: The cache, None if there is nowhere to keep it
+    """
+    db_file = CONFIG['analysis'].get('metadata_cache')
+    if not db_file and CONFIG['analysis'].get('status_dir'):
+        db_file = os.path.join(CONFIG['analysis']['status_dir'], 'run_metadata.db')
+    return RunMetadataCache(db_file) if db_file else None
+
+_demux_scheduler = None
+_demux_scheduler_lock = threading.Lock()
+
+def get_demux_scheduler():
+    """ Return the demultiplexing scheduler shared by the whole process, configured
+        by analysis.demux (max_jobs, cores, memory_per_job and max_retries) and
+        keeping track of the jobs in the status directory
+        :rtype: taca.analysis.scheduler.DemuxScheduler
+    """
+    global _demux_scheduler
+    with _demux_scheduler_lock:
+        if _demux_scheduler is None:
+            demux_config = CONFIG['analysis'].get('demux', {})
+            db_file = os.path.join(CONFIG['analysis']['status_dir'], 'demux_jobs.db')
+            _demux_scheduler = scheduler.DemuxScheduler(db_file,
+                                                        max_jobs=demux_config.get('max_jobs', 1),
+                                                        cores=demux_config.get('cores'),
+                                                        memory_per_job=demux_config.get('memory_per_job'),
+                                                        max_retries=demux_config.get('max_retries', 1))
+        return _demux_scheduler
+
+def _start_demultiplexing(run):
+    """ Start the demultiplexing of a run through the scheduler
+        :param taca.illumina.Run run: Run to demultiplex
+    """
+    exit_dir = os.path.join(CONFIG['analysis']['status_dir'], 'demux')
+    filesystem.create_folder(exit_dir)
+    try:
+        if get_demux_scheduler().start(run, os.path.join(exit_dir, '{}.exit'.format(run.id))):
+            logger.info(("Starting BCL to FASTQ conversion and demultiplexing for run {}".format(run.id)))
+    except:
+        logger.info(("Error demultiplexing for run {}".format(run.id)))
+
+def get_runObj(run, cache=None):
     """ Tries to read runParameters.xml to parse the type of sequencer
         and then return the respective Run object (NextSeq)
         :param run: run name identifier
         :type run: string
+        :param cache: cache of run metadata, used to skip parsing unchanged runs
+        :type cache: taca.analysis.cache.RunMetadataCache
         :rtype: Object
         :returns: returns the sequencer type object,
         None if the sequencer type is unknown of there was an error
     """
+    metadata = cache.get(run) if cache else None
+    if metadata:
+        runtype = metadata['sequencer_type']
+    else:
+        runtype = _parse_run_type(run)
+        if runtype is None:
+            return None
+
+    runObj = None
+    if "NextSeq" in runtype:
+        runObj = NextSeq_Run(run, CONFIG["analysis"]["NextSeq"],
+                             run_type=metadata['run_type'] if metadata else None)
+    else:
+        logger.warn("Unrecognized run type {}, cannot parse the run {}. "
+                    "The sequencer must be NextSeq".format(runtype, run))
+    if cache and not metadata:
+        cache.put(run, sequencer_type=runtype, run_type=runObj.run_type if runObj else None)
+    return runObj
 
+def _parse_run_type(run):
+    """ Parse the type of sequencer from runParameters.xml
+        :param str run: Path to the run folder
+        :returns str: The run type, None if it could not be parsed
+    """
     if os.path.exists(os.path.join(run, 'runParameters.xml')):
         run_parameters_file = "runParameters.xml"
     elif os.path.exists(os.path.join(run, 'RunParameters.xml')):
@@ -38,112 +118,274 @@ def get_runObj(run):
         logger.warn("Problems parsing the runParameters.xml file at {}. "
                     "This is quite unexpected. please archive the run {} manually".format(rppath, run))
         return None
-    else:
-        # This information about the run type 
-        try:
-            # Works for recent control software
-            runtype = rp.data['RunParameters']["Setup"]["Flowcell"]
-        except KeyError:
-            # Use this as second resource but print a warning in the logs
-            logger.warn("Parsing runParameters to fecth instrument type, "
-                        "not found Flowcell information in it. Using ApplicaiotnName")
-            # here makes sense to use get with default value "" ->
-            # so that it doesn't raise an exception in the next lines
-            # (in case ApplicationName is not found, get returns None)
-            runtype = rp.data['RunParameters']["Setup"].get("ApplicationName", "")
-
-        if "NextSeq" in runtype:
-            return NextSeq_Run(run, CONFIG["analysis"]["NextSeq"])
-        else:
-            logger.warn("Unrecognized run type {}, cannot parse the run {}. "
-                        "The sequencer must be NextSeq".format(runtype, run))
-    return None
+    # This information about the run type 
+    try:
+        # Works for recent control software
+        runtype = rp.data['RunParameters']["Setup"]["Flowcell"]
+    except KeyError:
+        # Use this as second resource but print a warning in the logs
+        logger.warn("Parsing runParameters to fecth instrument type, "
+                    "not found Flowcell information in it. Using ApplicaiotnName")
+        # here makes sense to use get with default value "" ->
+        # so that it doesn't raise an exception in the next lines
+        # (in case ApplicationName is not found, get returns None)
+        runtype = rp.data['RunParameters']["Setup"].get("ApplicationName", "")
+    return runtype
 
-def run_preprocessing(run):
-    """ Run demultiplexing in all data directories
-        :param str run: Process a particular run instead of looking for runs
-        :param bool force_tranfer: if set to True the FC is transferred also if fails QC
+def get_run_dirs():
+    """ Return the run folders present in the data directories
+        :returns list: Paths to the run folders
     """
-    def _process(run):
-        """ Process a run/flowcell and transfer to analysis server
-            :param taca.illumina.Run run: Run to be processed and transferred
-        """
-        logger.info('Checking run {}'.format(run.id))
-        t_file = os.path.join(CONFIG['analysis']['status_dir'], 'transfer.tsv')
-        if run.is_transferred(t_file):
-            # In this case I am either processing a run that is in transfer
-            # or that has been already transferred. Do nothing.
-            # time to time this situation is due to runs that are copied back from NAS after a reboot.
-            # This check avoid failures
-            logger.info('Run {} already transferred to analysis server, skipping it'.format(run.id))
-            return
+    runs = []
+    for data_dir in CONFIG.get('analysis').get('data_dirs'):
+        # Run folder looks like DATE_*_*_*, the last section is the FC name. 
+        # See Courtesy information from illumina of 10 June 2016 (no more XX at the end of the FC)
+        runs.extend(glob.glob(os.path.join(data_dir, '[1-9]*_*_*_*')))
+    return runs
 
-        if run.get_run_status() == 'SEQUENCING':
-            # Check status files and say i.e Run in second read, maybe something
-            # even more specific like cycle or something
-            logger.info('Run {} is not finished yet'.format(run.id))
-        elif run.get_run_status() == 'TO_START':
-            if run.get_run_type() == 'NON-NGI-RUN':
-                # For now MiSeq specific case. Process only NGI-run, skip all the others (PhD student runs)
-                logger.warn("Run {} marked as {}, "
-                            "TACA will skip this and move the run to "
-                            "no-sync directory".format(run.id, run.get_run_type()))
-                # Archive the run if indicated in the config file
-                if 'storage' in CONFIG:
-                    run.archive_run(CONFIG['storage']['archive_dirs'])
-                return
-            # Otherwise it is fine, process it
-            logger.info(("Starting BCL to FASTQ conversion and demultiplexing for run {}".format(run.id)))
-            try:
-                run.demultiplex_run()
-            except:
-                logger.info(("Error demultiplexing for run {}".format(run.id)))
-                pass
-        elif run.get_run_status() == 'IN_PROGRESS':
-            logger.info(("BCL conversion and demultiplexing process in "
-                         "progress for run {}, skipping it".format(run.id)))
-        elif run.get_run_status() == 'COMPLETED':
-            logger.info(("Preprocessing of run {} is finished, transferring it".format(run.id)))
+def rebuild_metadata_cache():
+    """ Empty the run metadata cache and fill it again with the runs present
+        in the data directories
+        :returns dict: Statistics of the rebuilt cache
+    """
+    cache = get_metadata_cache()
+    if not cache:
+        raise RuntimeError("No status_dir or metadata_cache in the analysis configuration")
+    cache.clear()
+    for run_dir in get_run_dirs():
+        try:
+            get_runObj(run_dir, cache=cache)
+        except Exception as e:
+            logger.warning("Could not cache the metadata of run {}: {}".format(run_dir, e))
+    return cache.stats()
 
-            # Transfer to analysis server if flag is True
-            if run.transfer_to_analysis_server:
-                logger.info('Transferring run {} to {} into {}'
-                            .format(run.id,
-                                    run.CONFIG['analysis_server']['host'],
-                                    run.CONFIG['analysis_server']['sync']['data_archive']))
-                run.transfer_run(t_file)
+def transfer_stats_report(run=None, days=None):
+    """ Report the throughput of the transfers to the analysis server
+        :param str run: Only the transfers of this run
+        :param int days: Only the transfers of the last days
+        :returns list: Lines of the report
+    """
+    db_file = os.path.join(CONFIG['analysis']['status_dir'], 'transfer_metrics.db')
+    if not os.path.exists(db_file):
+        raise RuntimeError("No transfer metrics in {}".format(CONFIG['analysis']['status_dir']))
+    since = datetime.now() - timedelta(days=days) if days else None
+    transfers = TransferMetrics(db_file).query(run_id=run, since=since)
+    lines = ['\t'.join(['run', 'started', 'shards', 'files', 'GB', 'seconds', 'MB/s',
+                        'speedup', 'listing', 'file_list'])]
+    for t in transfers:
+        lines.append('\t'.join([t['run'], t['started'][:19], str(t['shards']), str(t['files']),
+                                '{:.2f}'.format((t['bytes_sent'] or 0) / 1e9),
+                                '{:.0f}'.format(t['elapsed'] or 0),
+                                '{:.1f}'.format(t['mb_per_s'] or 0),
+                                '{:.2f}'.format(t['speedup'] or 0),
+                                '{:.1f}'.format(t['listing_time'] or 0),
+                                '{:.1f}'.format(t['file_list_time'] or 0)]))
+    if transfers:
+        sent = sum(t['bytes_sent'] or 0 for t in transfers)
+        elapsed = sum(t['elapsed'] or 0 for t in transfers)
+        rates = sorted(t['mb_per_s'] for t in transfers if t['mb_per_s'])
+        lines.append('{} transfers, {:.2f} GB in {:.0f} seconds, {:.1f} MB/s overall, '
+                     '{:.1f} MB/s median'.format(len(transfers), sent / 1e9, elapsed,
+                                                 sent / elapsed / 1e6 if elapsed else 0,
+                                                 rates[len(rates) // 2] if rates else 0))
+    return lines
 
+def _process(run):
+    """ Process a run/flowcell and transfer to analysis server
+        :param taca.illumina.Run run: Run to be processed and transferred
+    """
+    logger.info('Checking run {}'.format(run.id))
+    t_file = os.path.join(CONFIG['analysis']['status_dir'], 'transfer.tsv')
+    # Check all the status markers once and use them for all the decisions below
+    snapshot = run.get_status_snapshot()
+    if run.is_transferred(t_file, snapshot=snapshot):
+        # In this case I am either processing a run that is in transfer
+        # or that has been already transferred. Do nothing.
+        # time to time this situation is due to runs that are copied back from NAS after a reboot.
+        # This check avoid failures
+        logger.info('Run {} already transferred to analysis server, skipping it'.format(run.id))
+        return
+
+    status = run.get_run_status(snapshot=snapshot)
+    if status == 'SEQUENCING':
+        # Check status files and say i.e Run in second read, maybe something
+        # even more specific like cycle or something
+        logger.info('Run {} is not finished yet'.format(run.id))
+    elif status == 'TO_START':
+        if run.get_run_type() == 'NON-NGI-RUN':
+            # For now MiSeq specific case. Process only NGI-run, skip all the others (PhD student runs)
+            logger.warn("Run {} marked as {}, "
+                        "TACA will skip this and move the run to "
+                        "no-sync directory".format(run.id, run.get_run_type()))
             # Archive the run if indicated in the config file
             if 'storage' in CONFIG:
                 run.archive_run(CONFIG['storage']['archive_dirs'])
-
-    if run:
-        # Needs to guess what run type I have (NextSeq)
-        runObj = get_runObj(run)
-        if not runObj:
-            logger.warning("Unrecognized instrument type or incorrect run folder {}".format(run))
-            raise RuntimeError("Unrecognized instrument type or incorrect run folder {}".format(run))
+            return
+        # Otherwise it is fine, process it (as soon as there is a free slot)
+        _start_demultiplexing(run)
+    elif status == 'IN_PROGRESS':
+        demux_scheduler = get_demux_scheduler()
+        if demux_scheduler.check(run.id) in (scheduler.FAILED, scheduler.DEAD):
+            if demux_scheduler.can_retry(run.id):
+                logger.warning("Demultiplexing of run {} did not finish, starting it again".format(run.id))
+                run.reset_demultiplexing()
+                _start_demultiplexing(run)
+            else:
+                logger.error("Demultiplexing of run {} did not finish and will not be started again, "
+                             "it has to be looked at manually".format(run.id))
         else:
-            _process(runObj)
-    else:
-        data_dirs = CONFIG.get('analysis').get('data_dirs')
-        for data_dir in data_dirs:
-            # Run folder looks like DATE_*_*_*, the last section is the FC name. 
-            # See Courtesy information from illumina of 10 June 2016 (no more XX at the end of the FC)
-            runs = glob.glob(os.path.join(data_dir, '[1-9]*_*_*_*'))
-            for _run in runs:
-                runObj = get_runObj(_run)
-                if not runObj:
-                    logger.warning("Unrecognized instrument type or incorrect run folder {}".format(_run))
-                else:
-                    try:
-                        _process(runObj)
-                    except:
-                        # this function might throw and exception,
-                        # it is better to continue processing other runs
-                        logger.warning("There was an error processing the run {}".format(_run))
-                        pass
+            logger.info(("BCL conversion and demultiplexing process in "
+                         "progress for run {}, skipping it".format(run.id)))
+    elif status == 'COMPLETED':
+        logger.info(("Preprocessing of run {} is finished, transferring it".format(run.id)))
 
+        # Transfer to analysis server if flag is True
+        if run.transfer_to_analysis_server:
+            logger.info('Transferring run {} to {} into {}'
+                        .format(run.id,
+                                run.CONFIG['analysis_server']['host'],
+                                run.CONFIG['analysis_server']['sync']['data_archive']))
+            run.transfer_run(t_file)
 
+        # Archive the run if indicated in the config file
+        if 'storage' in CONFIG:
+            run.archive_run(CONFIG['storage']['archive_dirs'])
 
+def _process_locked(run):
+    """ Process a run only if no one else (i.e another TACA instance started
+        by cron while this one is still running) is processing it
+        :param taca.illumina.Run run: Run to be processed and transferred
+    """
+    lock_dir = os.path.join(CONFIG['analysis']['status_dir'], 'locks')
+    filesystem.create_folder(lock_dir)
+    with filesystem.locked(os.path.join(lock_dir, '{}.lock'.format(run.id))) as acquired:
+        if not acquired:
+            logger.info('Run {} is being processed by another TACA instance, skipping it'.format(run.id))
+            return
+        _process(run)
 
+def _process_run_dir(run_dir, cache=None):
+    """ Process a run folder found in the data directories, errors are logged
+        and contained so that they do not affect the other runs
+        :param str run_dir: Path to the run folder
+        :param taca.analysis.cache.RunMetadataCache cache: cache of run metadata
+    """
+    runObj = get_runObj(run_dir, cache=cache)
+    if not runObj:
+        logger.warning("Unrecognized instrument type or incorrect run folder {}".format(run_dir))
+        return
+    try:
+        _process_locked(runObj)
+    except Exception as e:
+        # this function might throw and exception,
+        # it is better to continue processing other runs
+        logger.warning("There was an error processing the run {}: {}".format(run_dir, e))
+
+def run_preprocessing(run, workers=1):
+    """ Run demultiplexing in all data directories
+        :param str run: Process a particular run instead of looking for runs
+        :param int workers: Number of runs to process concurrently
+    """
+    cache = get_metadata_cache()
+    try:
+        if run:
+            # Needs to guess what run type I have (NextSeq)
+            runObj = get_runObj(run, cache=cache)
+            if not runObj:
+                logger.warning("Unrecognized instrument type or incorrect run folder {}".format(run))
+                raise RuntimeError("Unrecognized instrument type or incorrect run folder {}".format(run))
+            else:
+                _process_locked(runObj)
+        else:
+            runs = get_run_dirs()
+            if workers > 1:
+                # Runs are independent and mostly wait on rsync/bcl2fastq, so a slow
+                # transfer should not hold up the rest of the runs
+                pool = ThreadPool(min(workers, len(runs)) or 1)
+                try:
+                    pool.map(lambda run_dir: _process_run_dir(run_dir, cache), runs)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for _run in runs:
+                    _process_run_dir(_run, cache)
+    finally:
+        # The transfers share SSH master connections, close them once all are done
+        ssh.close_all()
+
+def _demux_waiting(watcher):
+    """ Return the runs waiting for a demultiplexing slot, being demultiplexed by
+        TACA or waiting for their demultiplexing to be started again. None of their
+        status markers changes until something happens, so they are checked on every scan.
+        :param taca.analysis.watch.RunWatcher watcher: The watcher that knows the runs
+        :returns list: Paths to the run folders
+    """
+    demux_scheduler = get_demux_scheduler()
+    waiting = []
+    for run_dir in watcher.run_dirs():
+        status = watcher.status(run_dir)
+        if status == 'TO_START':
+            waiting.append(run_dir)
+        elif status == 'IN_PROGRESS':
+            run_id = os.path.basename(run_dir)
+            job = demux_scheduler.job(run_id)
+            if job and (job['status'] == scheduler.RUNNING or demux_scheduler.can_retry(run_id)):
+                waiting.append(run_dir)
+    return waiting
+
+def _log_run_error(run_dir, result):
+    """ Log the error of a run processed in the background, otherwise it would
+        be lost with its result
+        :param str run_dir: Path to the run folder
+        :param multiprocessing.pool.AsyncResult result: Finished processing of the run
+    """
+    try:
+        result.get()
+    except Exception as e:
+        logger.error("There was an error processing the run {}: {}".format(run_dir, e))
+
+def watch_runs(interval=60, workers=1, rescan=3600):
+    """ Keep watching the data directories and process the runs as soon as
+        they change status, instead of waiting for the next cron tick
+        :param int interval: Maximum number of seconds between two scans
+        :param int workers: Number of runs to process concurrently
+        :param int rescan: Seconds after which all runs are processed again,
+                           i.e. to retry failed transfers
+    """
+    watcher = RunWatcher(CONFIG['analysis']['data_dirs'])
+    cache = get_metadata_cache()
+    pool = ThreadPool(workers)
+    pending = {}
+    requeued = set()
+    last_rescan = time.time()
+    logger.info('Watching data directories {}'.format(', '.join(watcher.data_dirs)))
+    try:
+        while True:
+            changed = watcher.scan()
+            if time.time() - last_rescan >= rescan:
+                changed = watcher.run_dirs()
+                last_rescan = time.time()
+            for run_dir in [r for r, result in pending.items() if result.ready()]:
+                _log_run_error(run_dir, pending.pop(run_dir))
+            waiting = set(_demux_waiting(watcher)).difference(pending).difference(changed)
+            # Runs that changed while being processed are processed again afterwards
+            for run_dir in sorted(requeued.union(changed).union(waiting)):
+                if run_dir in pending:
+                    requeued.add(run_dir)
+                    continue
+                requeued.discard(run_dir)
+                if run_dir in waiting:
+                    logger.debug('Checking the demultiplexing of run {}'.format(os.path.basename(run_dir)))
+                else:
+                    logger.info('Status of run {} changed, processing it'.format(os.path.basename(run_dir)))
+                pending[run_dir] = pool.apply_async(_process_run_dir, (run_dir, cache))
+            watcher.wait(interval)
+    except KeyboardInterrupt:
+        logger.info('Stopping, waiting for {} run(s) being processed'.format(len(pending)))
+    finally:
+        pool.close()
+        pool.join()
+        for run_dir, result in pending.items():
+            _log_run_error(run_dir, result)
+        ssh.close_all()
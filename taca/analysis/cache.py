@@ -0,0 +1,118 @@
+"""
+Persistent cache of the run metadata parsed by get_runObj
+"""
+import json
+import logging
+import os
+import sqlite3
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Files the cached metadata is parsed from, an entry is only valid while
+# none of them has changed
+SIGNATURE_FILES = ['runParameters.xml', 'RunParameters.xml', 'SampleSheet.csv']
+
+def run_signature(run_dir):
+    """ Return a signature of the files the run metadata is parsed from
+        :param str run_dir: Path to the run folder
+        :returns str: JSON with the size and mtime of each of the files
+    """
+    signature = {}
+    for name in SIGNATURE_FILES:
+        try:
+            st = os.stat(os.path.join(run_dir, name))
+        except OSError:
+            continue
+        # runParameters.xml and RunParameters.xml are the same file (Run renames it)
+        key = 'runParameters' if name.lower() == 'runparameters.xml' else name
+        signature[key] = [st.st_size, st.st_mtime]
+    return json.dumps(signature, sort_keys=True)
+
+class RunMetadataCache(object):
+    """ SQLite cache of the sequencer type and run type of the runs, the ones that
+        need parsing runParameters.xml and SampleSheet.csv, keyed on the run path
+        and the signature of these files
+    """
+    FIELDS = ['sequencer_type', 'run_type']
+
+    def __init__(self, db_file, timeout=60):
+        """
+        :param str db_file: Path to the SQLite database
+        :param int timeout: Seconds to wait for a concurrent writer to release the database
+        """
+        self.db_file = db_file
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS runs (path TEXT PRIMARY KEY, signature TEXT, "
+                             "sequencer_type TEXT, run_type TEXT, updated TEXT)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def get(self, run_dir):
+        """ Return the cached metadata of a run if its metadata files did not change
+            :param str run_dir: Path to the run folder
+            :returns dict: The cached fields, None if there is no valid entry
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT signature, {} FROM runs WHERE path = ?".format(', '.join(self.FIELDS)),
+                               (os.path.abspath(run_dir),)).fetchone()
+        finally:
+            conn.close()
+        if not row or row[0] != run_signature(run_dir):
+            return None
+        return dict(zip(self.FIELDS, row[1:]))
+
+    def put(self, run_dir, **metadata):
+        """ Store the metadata of a run
+            :param str run_dir: Path to the run folder
+            :param metadata: Values for the cached fields
+        """
+        values = [metadata.get(field) for field in self.FIELDS]
+        conn = self._connect()
+        try:
+            with conn:
+                # The columns are named, databases written by older versions have more of them
+                conn.execute("INSERT OR REPLACE INTO runs (path, signature, {}, updated) VALUES ({})".format(
+                             ', '.join(self.FIELDS), ', '.join(['?'] * (len(self.FIELDS) + 3))),
+                             [os.path.abspath(run_dir), run_signature(run_dir)] + values +
+                             [str(datetime.now())])
+        finally:
+            conn.close()
+
+    def clear(self):
+        """ Remove all the entries from the cache
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM runs")
+        finally:
+            conn.close()
+
+    def stats(self):
+        """ Return some numbers about the entries in the cache
+            :returns dict: Number of entries, how many of them are still valid,
+                           stale (the run changed) or orphan (the run is gone)
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT path, signature FROM runs").fetchall()
+        finally:
+            conn.close()
+        stats = {'entries': len(rows), 'valid': 0, 'stale': 0, 'orphan': 0}
+        for path, signature in rows:
+            if not os.path.isdir(path):
+                stats['orphan'] += 1
+            elif signature != run_signature(path):
+                stats['stale'] += 1
+            else:
+                stats['valid'] += 1
+        return stats
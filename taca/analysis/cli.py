@@ -13,12 +13,28 @@ def analysis():
 @analysis.command()
 @click.option('-r', '--run', type=click.Path(exists=True), default=None,
 				 help='Demultiplex only a particular run')
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1,
+				 help='Number of runs to process concurrently')
 
-def demultiplex(run):
+def demultiplex(run, workers):
 	"""
 	Demultiplex all runs present in the data directories
 	"""
-	an.run_preprocessing(run)
+	an.run_preprocessing(run, workers=workers)
+
+@analysis.command()
+@click.option('-i', '--interval', type=click.IntRange(min=1), default=60,
+				help='Maximum number of seconds between two scans of the data directories')
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1,
+				help='Number of runs to process concurrently')
+@click.option('--rescan', type=click.IntRange(min=1), default=3600,
+				help='Seconds after which all runs are processed again')
+
+def watch(interval, workers, rescan):
+	"""
+	Keep watching the data directories and process runs as soon as they change status
+	"""
+	an.watch_runs(interval=interval, workers=workers, rescan=rescan)
 
 @analysis.command()
 @click.option('-a','--analysis', 
@@ -29,3 +45,37 @@ def demultiplex(run):
 def transfer(rundir, analysis):
 	"""Transfers the run without qc"""
 	an.transfer_run(rundir, analysis=analysis)
+
+@analysis.command('transfer-stats')
+@click.option('-r', '--run', help='Only the transfers of this run')
+@click.option('-d', '--days', type=click.IntRange(min=1), help='Only the transfers of the last days')
+
+def transfer_stats(run, days):
+	"""Report the throughput of the transfers to the analysis server"""
+	try:
+		lines = an.transfer_stats_report(run=run, days=days)
+	except RuntimeError as e:
+		raise click.ClickException(str(e))
+	for line in lines:
+		click.echo(line)
+
+@analysis.command()
+@click.option('--rebuild', is_flag=True,
+				help='Empty the cache and parse again the runs in the data directories')
+@click.option('--stats', is_flag=True, help='Show statistics about the cached entries')
+
+def cache(rebuild, stats):
+	"""Inspect or rebuild the run metadata cache"""
+	if rebuild:
+		try:
+			cache_stats = an.rebuild_metadata_cache()
+		except RuntimeError as e:
+			raise click.ClickException(str(e))
+	else:
+		metadata_cache = an.get_metadata_cache()
+		if not metadata_cache:
+			raise click.ClickException("No status_dir or metadata_cache in the analysis configuration")
+		cache_stats = metadata_cache.stats()
+	if stats or not rebuild:
+		for key in ['entries', 'valid', 'stale', 'orphan']:
+			click.echo("{}\t{}".format(key, cache_stats[key]))
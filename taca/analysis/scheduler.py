@@ -0,0 +1,206 @@
+"""
+Scheduling of the demultiplexing jobs started by TACA
+"""
+import errno
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Status of a job, as returned by DemuxScheduler.check
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+DEAD = 'DEAD'
+
+JOB_FIELDS = ['run', 'pid', 'started', 'exit_status_file', 'attempts', 'status', 'exit_status', 'finished']
+
+def _total_memory():
+    """ Physical memory of the machine in GB, None if it cannot be found out
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9
+    except (ValueError, OSError):
+        return None
+
+def _pid_alive(pid, marker=None):
+    """ Checks if a process is running
+        :param int pid: Process id
+        :param str marker: Something in the command line of the process, to tell
+                           it apart from a new process that got the same pid
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    if marker:
+        try:
+            with open('/proc/{}/cmdline'.format(pid)) as fh:
+                return marker in fh.read()
+        except IOError:
+            # No /proc, trust the pid
+            pass
+    return True
+
+class DemuxScheduler(object):
+    """ Starts the demultiplexing of the runs, limiting how many run at the same
+        time and splitting the cores of the machine between them, and keeps track
+        of the jobs (pid, start time, exit status) in an SQLite database, so that
+        a job that died or failed is noticed on the next check even if it was
+        started by another TACA instance.
+    """
+    def __init__(self, db_file, max_jobs=1, cores=None, memory_per_job=None, max_retries=1, timeout=60):
+        """
+        :param str db_file: Path to the SQLite database
+        :param int max_jobs: Maximum number of concurrent jobs
+        :param int cores: Cores to split between the jobs, all the cores of the machine if not given
+        :param int memory_per_job: GB of memory a job needs, to lower max_jobs on small machines
+        :param int max_retries: Times a failed job is started again
+        :param int timeout: Seconds to wait for a concurrent writer to release the database
+        """
+        self.db_file = db_file
+        self.max_jobs = max_jobs
+        memory = _total_memory()
+        if memory_per_job and memory:
+            self.max_jobs = max(1, min(max_jobs, int(memory // memory_per_job)))
+        self.cores = cores or multiprocessing.cpu_count()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # Handles of the jobs started by this process, waited for so that they do not linger as zombies
+        self._handles = {}
+        self._lock = threading.Lock()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS jobs (run TEXT PRIMARY KEY, pid INTEGER, started TEXT, "
+                             "exit_status_file TEXT, attempts INTEGER, status TEXT, exit_status INTEGER, "
+                             "finished TEXT)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Autocommit mode, transactions are started explicitly
+        return sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+
+    def threads(self):
+        """ Number of threads of each kind for one job, as bcl2fastq options
+            :returns dict: loading-threads, processing-threads and writing-threads
+        """
+        per_job = max(1, self.cores // self.max_jobs)
+        # bcl2fastq uses 4 loading and 4 writing threads by default, fewer for small shares
+        io_threads = max(1, min(4, per_job // 4))
+        return {'loading-threads': io_threads, 'processing-threads': per_job, 'writing-threads': io_threads}
+
+    def job(self, run_id):
+        """ Return the job of a run
+            :param str run_id: Run name
+            :returns dict: The job, None if the run has no job
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT {} FROM jobs WHERE run = ?".format(', '.join(JOB_FIELDS)),
+                               (run_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(zip(JOB_FIELDS, row)) if row else None
+
+    def _update(self, conn, run_id, **values):
+        conn.execute("UPDATE jobs SET {} WHERE run = ?".format(', '.join('{} = ?'.format(k) for k in values)),
+                     values.values() + [run_id])
+
+    def _refresh(self, conn, job):
+        """ Update the status of a running job from its exit status file and process
+        """
+        if job['status'] != RUNNING:
+            return job
+        handle = self._handles.get(job['run'])
+        if handle is not None and handle.poll() is not None:
+            del self._handles[job['run']]
+        exit_status = None
+        try:
+            with open(job['exit_status_file']) as fh:
+                content = fh.read().strip()
+            exit_status = int(content) if content else None
+        except (IOError, ValueError):
+            pass
+        if exit_status is not None:
+            job.update(status=DONE if exit_status == 0 else FAILED, exit_status=exit_status)
+        elif not _pid_alive(job['pid'], marker=job['exit_status_file']):
+            job['status'] = DEAD
+        else:
+            return job
+        job['finished'] = str(datetime.now())
+        self._update(conn, job['run'], status=job['status'], exit_status=job['exit_status'],
+                     finished=job['finished'])
+        if job['status'] != DONE:
+            logger.error("Demultiplexing of run {} {} (pid {}, started on {}, exit status {})".format(
+                         job['run'], 'died' if job['status'] == DEAD else 'failed', job['pid'],
+                         job['started'], job['exit_status']))
+        return job
+
+    def check(self, run_id):
+        """ Return the status of the job of a run, noticing if it finished since the last check
+            :param str run_id: Run name
+            :returns str: RUNNING, DONE, FAILED or DEAD, None if the run has no job
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT {} FROM jobs WHERE run = ?".format(', '.join(JOB_FIELDS)),
+                                   (run_id,)).fetchone()
+                job = self._refresh(conn, dict(zip(JOB_FIELDS, row))) if row else None
+                conn.execute("COMMIT")
+            finally:
+                # Closing without COMMIT rolls back
+                conn.close()
+        return job['status'] if job else None
+
+    def can_retry(self, run_id):
+        """ Checks if the job of a run can be started again
+            :param str run_id: Run name
+        """
+        job = self.job(run_id)
+        return bool(job) and job['status'] in (FAILED, DEAD) and job['attempts'] <= self.max_retries
+
+    def start(self, run, exit_status_file):
+        """ Start the demultiplexing of a run if there is a free slot
+            :param taca.illumina.Runs.Run run: The run, its demultiplex_run method is called
+                                               with the threads and exit_status_file options
+            :param str exit_status_file: Where the job writes its exit status
+            :returns bool: True if the job was started, False if all the slots are in use
+        """
+        with self._lock:
+            conn = self._connect()
+            try:
+                # Also keeps other TACA instances from taking the same slot
+                conn.execute("BEGIN IMMEDIATE")
+                running = 0
+                for row in conn.execute("SELECT {} FROM jobs WHERE status = ?".format(', '.join(JOB_FIELDS)),
+                                        (RUNNING,)).fetchall():
+                    running += self._refresh(conn, dict(zip(JOB_FIELDS, row)))['status'] == RUNNING
+                if running >= self.max_jobs:
+                    conn.execute("COMMIT")
+                    logger.info("{} demultiplexing jobs running, run {} has to wait".format(running, run.id))
+                    return False
+                row = conn.execute("SELECT attempts FROM jobs WHERE run = ?", (run.id,)).fetchone()
+                if os.path.exists(exit_status_file):
+                    os.remove(exit_status_file)
+                handle = run.demultiplex_run(threads=self.threads(), exit_status_file=exit_status_file)
+                self._handles[run.id] = handle
+                conn.execute("INSERT OR REPLACE INTO jobs ({}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(
+                             ', '.join(JOB_FIELDS)),
+                             (run.id, handle.pid, str(datetime.now()), exit_status_file,
+                              (row[0] if row else 0) + 1, RUNNING, None, None))
+                conn.execute("COMMIT")
+            finally:
+                # Closing without COMMIT rolls back
+                conn.close()
+        logger.info("Started demultiplexing of run {} (pid {})".format(run.id, handle.pid))
+        return True
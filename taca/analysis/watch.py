@@ -0,0 +1,154 @@
+"""
+Watch the data directories for runs changing status
+"""
+import copy
+import fnmatch
+import logging
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from taca.illumina.Runs import RunStatusSnapshot
+
+logger = logging.getLogger(__name__)
+
+# Run folder looks like DATE_*_*_*, same pattern used by run_preprocessing
+RUN_PATTERN = '[1-9]*_*_*_*'
+
+class RunWatcher(object):
+    """ Keeps track of the status markers (RTAComplete.txt, demultiplexing folder
+        and DemultiplexingStats.xml) of the runs in the data directories and
+        reports the runs whose markers changed since the previous scan.
+
+        Directories are only listed again when their mtime changes, so scanning
+        an idle instrument share costs a stat per data directory and run. When
+        pyinotify is available it is used to wake up as soon as something changes,
+        otherwise (or on filesystems without inotify support, like NFS) the
+        watcher just polls.
+    """
+    def __init__(self, data_dirs, demux_dir='Demultiplexing', use_inotify=True):
+        """
+        :param list data_dirs: Directories where the sequencers write the runs
+        :param str demux_dir: Name of the demultiplexing folder inside a run
+        :param bool use_inotify: Use inotify to wake up early if available
+        """
+        self.data_dirs = data_dirs
+        self.demux_dir = demux_dir
+        self._listings = {}
+        self._runs = {}
+        self._watched = set()
+        self._notifier = None
+        if use_inotify and pyinotify:
+            self._wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(self._wm, pyinotify.ProcessEvent(), timeout=0)
+
+    def _list_runs(self, data_dir):
+        """ Return the run folders of a data directory, listing it only if it changed
+            :param str data_dir: Path to the data directory
+        """
+        try:
+            mtime = os.stat(data_dir).st_mtime
+        except OSError as e:
+            logger.warn("Cannot access data directory {}: {}".format(data_dir, e))
+            return []
+        listing = self._listings.get(data_dir)
+        if listing and listing[0] == mtime:
+            return listing[1]
+        runs = [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir))
+                if fnmatch.fnmatch(name, RUN_PATTERN) and os.path.isdir(os.path.join(data_dir, name))]
+        self._listings[data_dir] = (mtime, runs)
+        return runs
+
+    def _snapshot(self, run_dir):
+        """ Return the status snapshot of a run, listing the run folder only if it changed
+            :param str run_dir: Path to the run folder
+            :returns tuple: mtime of the run folder and RunStatusSnapshot
+        """
+        mtime = os.stat(run_dir).st_mtime
+        previous = self._runs.get(run_dir)
+        if previous and previous[0] == mtime:
+            snapshot = copy.copy(previous[1])
+            # DemultiplexingStats.xml is written deep inside the demux folder,
+            # it does not change the mtime of the run folder
+            if snapshot.demux_started and not snapshot.demux_done:
+                snapshot.demux_done = os.path.exists(os.path.join(run_dir, self.demux_dir,
+                                                                  'Stats', 'DemultiplexingStats.xml'))
+        else:
+            snapshot = RunStatusSnapshot(run_dir, self.demux_dir)
+        return mtime, snapshot
+
+    @staticmethod
+    def _state(snapshot):
+        return (snapshot.sequencing_done, snapshot.demux_started, snapshot.demux_done)
+
+    def run_dirs(self):
+        """ Return all the run folders currently known to the watcher
+        """
+        return sorted(self._runs.keys())
+
+    def status(self, run_dir):
+        """ Return the status of a run as of the last scan
+            :param str run_dir: Path to the run folder
+            :returns str: The status, see RunStatusSnapshot.status, None for unknown runs
+        """
+        if run_dir not in self._runs:
+            return None
+        return self._runs[run_dir][1].status
+
+    def scan(self):
+        """ Look for new runs and for runs whose status markers changed
+            :returns list: Paths to the new or changed runs
+        """
+        changed = []
+        runs = {}
+        for data_dir in self.data_dirs:
+            for run_dir in self._list_runs(data_dir):
+                try:
+                    runs[run_dir] = self._snapshot(run_dir)
+                except OSError:
+                    # The run was moved away (i.e archived) in the meantime
+                    continue
+                previous = self._runs.get(run_dir)
+                if not previous or self._state(previous[1]) != self._state(runs[run_dir][1]):
+                    changed.append(run_dir)
+        self._runs = runs
+        if self._notifier:
+            self._add_watches()
+        return changed
+
+    def _add_watches(self):
+        """ Watch the data directories, the run folders and the demultiplexing Stats folders
+        """
+        mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
+        paths = set(self.data_dirs)
+        for run_dir, (_, snapshot) in self._runs.items():
+            paths.add(run_dir)
+            if snapshot.demux_started:
+                paths.add(os.path.join(run_dir, self.demux_dir))
+                stats_dir = os.path.join(run_dir, self.demux_dir, 'Stats')
+                if os.path.isdir(stats_dir):
+                    paths.add(stats_dir)
+        for path in paths - self._watched:
+            self._wm.add_watch(path, mask, quiet=True)
+        for path in self._watched - paths:
+            wd = self._wm.get_wd(path)
+            if wd is not None:
+                self._wm.rm_watch(wd, quiet=True)
+        self._watched = paths
+
+    def wait(self, timeout):
+        """ Wait for filesystem events (if inotify is in use) or for the given time
+            :param int timeout: Maximum number of seconds to wait
+        """
+        if self._notifier:
+            if self._notifier.check_events(timeout * 1000):
+                self._notifier.read_events()
+                self._notifier.process_events()
+                # Let the writer finish what it was doing before scanning
+                time.sleep(1)
+        else:
+            time.sleep(timeout)
@@ -1,16 +1,38 @@
 """Backup methods and utilities"""
+import datetime
+import hashlib
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess as sp
+import tempfile
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
+
 from taca.utils.config import CONFIG
 from taca.utils import filesystem, misc
 
 logger = logging.getLogger(__name__)
 
+# A file line in the output of 'dsmc query archive', i.e.
+#        20,480  B  04/21/2016 15:13:11    /path/to/file.tar.gz.gpg Never Archive Date: 04/21/2016
+PDC_QUERY_RE = '^\s*([\d,]+)\s+(B|KB|MB|GB|TB)\s+(\d{2}/\d{2}/\d{4}\s+\d{2}:\d{2}:\d{2})\s+(/\S+)'
+# A line in the output of 'dsmc retrieve' for a retrieved file, i.e.
+# Retrieving         20,480 /path/to/file.tar.gz.gpg --> /dest/file.tar.gz.gpg [Done]
+PDC_RETRIEVE_RE = '^Retrieving\s+[\d,]+\s+(/\S+)\s+-->\s+\S+\s+\[Done\]'
+PDC_SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+# Extension of the directory holding a run archived in chunks
+CHUNKS_EXT = ".chunks"
+DEFAULT_CHUNK_SIZE = 50 * 1024**3
+# Random passphrase of a run. gpg reads a passphrase file up to the first new line, so
+# the 256 random bytes are armored into a single printable line
+GEN_KEY_CMD = "gpg --gen-random --armor 1 256"
+
 class run_vars(object):
     """A simple variable storage class"""
     def __init__(self, run):
@@ -21,12 +43,22 @@ class run_vars(object):
         self.key = "{}.key".format(self.name)
         self.key_encrypted = "{}.key.gpg".format(self.name)
         self.zip_encrypted = "{}.tar.gz.gpg".format(self.name)
+        self.zip_md5 = "{}.tar.gz.md5".format(self.name)
+        # chunked layout, the parts and their manifest are kept in their own directory
+        self.chunks = "{}{}".format(self.name, CHUNKS_EXT)
+        self.manifest = "{}.manifest".format(self.name)
+
+    def part(self, index):
+        """Name of a part of the chunked archive, each one is compressed and encrypted on its own"""
+        return "{}.tar.{:04d}.gz.gpg".format(self.name, index)
 
 class backup_utils(object):
     """A class object with main utility methods related to backing up"""
 
     def __init__(self, run=None):
         self.run = run
+        # runs and parts are sent to PDC from several threads sharing the index
+        self._pdc_index_lock = threading.Lock()
         self.fetch_config_info()
         self.host_name = os.getenv('HOSTNAME', os.uname()[1]).split('.', 1)[0]
 
@@ -41,6 +73,12 @@ class backup_utils(object):
             self.keys_path = CONFIG['backup']['keys_path']
             self.gpg_receiver = CONFIG['backup']['gpg_receiver']
             self.mail_recipients = CONFIG['mail']['recipients']
+            # Command used to talk to PDC, can be replaced i.e. for testing
+            self.dsmc = CONFIG['backup'].get('dsmc', 'dsmc')
+            # Failed dsmc archive calls are retried, waiting longer after each attempt
+            self.pdc_retries = CONFIG['backup'].get('pdc_retries', 3)
+            self.pdc_retry_delay = CONFIG['backup'].get('pdc_retry_delay', 15)
+            self.pdc_index = {}
         except KeyError as e:
             logger.error("Config file is missing the key {}, " \
                          "make sure it have all required information".format(str(e)))
@@ -56,66 +94,149 @@ class backup_utils(object):
                 raise SystemExit
             self.runs.append(run)
         else:
+            names = set()
             for adir in self.archive_dirs:
                 if not os.path.isdir(adir):
                     logger.warn("Path {} does not exist or it is not a directory".format(adir))
                     return self.runs
                 for item in os.listdir(adir):
-                    if filter_by_ext and not item.endswith(ext):
+                    if item.endswith(CHUNKS_EXT) and os.path.isdir(os.path.join(adir, item)):
+                        # runs archived (or being archived) in chunks are always collected
+                        item = item[:-len(CHUNKS_EXT)]
+                    elif filter_by_ext and not item.endswith(ext):
                         continue
                     elif item.endswith(ext):
                         item = item.replace(ext, '')
-                    elif not os.path.isdir(item):
+                    elif not os.path.isdir(os.path.join(adir, item)):
                         continue
-                    if re.match(filesystem.RUN_RE, item) and item not in self.runs:
+                    if re.match(filesystem.RUN_RE, item) and item not in names:
+                        names.add(item)
                         self.runs.append(run_vars(os.path.join(adir, item)))
 
-    def avail_disk_space(self, path, run):
-        """Check the space on file system based on GB"""
-        required_size = 500 * 2
-        # check for any ongoing runs and add up the required size accrdingly
+    def _run_cycles(self, run_dir):
+        """Return the number of cycles of a run according to RunInfo.xml and the number of
+        cycles written so far (folders C<n>.1 or files <n>.bcl.bgzf of the first lane),
+        the total is None if RunInfo.xml could not be parsed"""
+        try:
+            reads = ElementTree.parse(os.path.join(run_dir, "RunInfo.xml")).getroot().iter("Read")
+            total = sum(int(read.get("NumCycles")) for read in reads) or None
+        except (IOError, ElementTree.ParseError, TypeError, ValueError):
+            total = None
+        lane_dir = os.path.join(run_dir, "Data", "Intensities", "BaseCalls", "L001")
+        try:
+            items = os.listdir(lane_dir)
+        except OSError:
+            items = []
+        done = max(len([i for i in items if re.match(r'^C\d+\.1$', i)]),
+                   len([i for i in items if re.match(r'^\d+\.bcl\.bgzf$', i)]))
+        return total, done
+
+    def _ongoing_runs(self):
+        """Estimate how big the runs still being sequenced will get. The size written so
+        far is extrapolated to all the cycles in RunInfo.xml; before the first cycle is
+        written the median size of the finished runs of the same instrument in the data
+        directories is used, and backup.ongoing_run_size (in GB, default 500) as a last
+        resort. Returns a list of (run path, current size, expected size, how it was estimated)"""
+        default_size = int(CONFIG['backup'].get('ongoing_run_size', 500) * 1024**3)
+        ongoing, finished = [], {}
         for ddir in self.data_dirs:
             for item in os.listdir(ddir):
-                if not re.match(filesystem.RUN_RE, item):
+                run_dir = os.path.join(ddir, item)
+                if not re.match(filesystem.RUN_RE, item) or not os.path.isdir(run_dir):
                     continue
-                if not os.path.exists(os.path.join(ddir, item, "RTAComplete.txt")):
-                    required_size += 500
-        # get available free space from the file system
-        try:
-            df_proc = sp.Popen(['df', path], stdout=sp.PIPE, stderr=sp.PIPE)
-            df_out, _ = df_proc.communicate()
-            available_size = int(df_out.strip().split('\n')[-1].strip().split()[2])/1024/1024
-        except Exception as e:
-            logger.error("Evaluation of disk space failed with error {}".format(e))
-            raise SystemExit
-        if available_size < required_size:
-            e_msg = "Required space for encryption is {}GB, " \
-            "but only {}GB available".format(required_size, available_size)
-            subjt = "Low space for encryption - {}".format(self.host_name)
-            logger.error(e_msg)
-            misc.send_mail(subjt, e_msg, self.mail_recipients)
-            raise SystemExit
-    
+                if os.path.exists(os.path.join(run_dir, "RTAComplete.txt")):
+                    finished.setdefault(item.split('_')[1], []).append(run_dir)
+                else:
+                    ongoing.append(run_dir)
+        estimates = []
+        for run_dir in ongoing:
+            current = self._dir_size(run_dir, finished=False)
+            total, done = self._run_cycles(run_dir)
+            instrument = os.path.basename(run_dir).split('_')[1]
+            if total and done:
+                expected, how = current * total // min(done, total), "cycles {}/{}".format(min(done, total), total)
+            elif finished.get(instrument):
+                sizes = sorted(self._dir_size(r) for r in finished[instrument])
+                expected, how = sizes[len(sizes) // 2], "median of {} finished run(s)".format(len(sizes))
+            else:
+                expected, how = default_size, "default"
+            estimates.append((run_dir, current, max(expected, current), how))
+        return estimates
+
+    def _ongoing_runs_size(self):
+        """Return the space in bytes to keep free for the runs still being sequenced"""
+        return sum(expected - current for _, current, expected, _ in self._ongoing_runs())
+
+    def query_pdc(self, pattern):
+        """Query PDC for the archived files matching a path pattern (i.e. '/dir/*') with a
+        single dsmc call and return a dict with (size, archive date) by absolute path, or
+        None if the query failed"""
+        cmd = self.dsmc.split() + ['query', 'archive', pattern]
+        dsmc_proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        dsmc_out, dsmc_err = dsmc_proc.communicate()
+        archived = {}
+        for line in dsmc_out.splitlines():
+            match = re.match(PDC_QUERY_RE, line)
+            if match:
+                size, unit, date, path = match.groups()
+                size = int(size.replace(',', '')) * PDC_SIZE_UNITS.get(unit, 1)
+                archived[path] = (size, date)
+        # dsmc returns non-zero also when no file matches, which is just an empty result
+        if dsmc_proc.returncode != 0 and not archived and "ANS1092W" not in dsmc_out + dsmc_err:
+            logger.warn("Querying PDC for {} failed with the error '{}'".format(pattern, dsmc_err.strip()))
+            return None
+        return archived
+
+    def _pdc_dir_index(self, directory):
+        """Return the files archived in PDC from a directory, querying PDC only the
+        first time (or after 'refresh_pdc_index'). None if the query failed"""
+        with self._pdc_index_lock:
+            archived = self.pdc_index.get(directory)
+            if archived is None:
+                archived = self.query_pdc(os.path.join(directory, '*'))
+                if archived is not None:
+                    self.pdc_index[directory] = archived
+            return archived
+
+    def refresh_pdc_index(self, directory=None):
+        """Forget what is known about the files archived from a directory (or from all
+        directories), so that PDC is queried again i.e. after archiving something there"""
+        with self._pdc_index_lock:
+            if directory:
+                self.pdc_index.pop(os.path.abspath(directory), None)
+            else:
+                self.pdc_index = {}
+
     def file_in_pdc(self, src_file, silent=True):
         """Check if the given files exist in PDC"""
-        # dsmc will return zero/True only when file exists, it returns
-        # non-zero/False though cmd is execudted but file not found
+        # The whole directory is queried at once and kept in an index, so that
+        # checking several files from the same directory needs a single dsmc call
         src_file_abs = os.path.abspath(src_file)
-        try:
-            sp.check_call(['dsmc', 'query', 'archive', src_file_abs], stdout=sp.PIPE, stderr=sp.PIPE)
-            value = True
-        except sp.CalledProcessError:
-            value = False
+        archived = self._pdc_dir_index(os.path.dirname(src_file_abs))
+        if archived is not None:
+            value = src_file_abs in archived
+        else:
+            # dsmc will return zero/True only when file exists, it returns
+            # non-zero/False though cmd is execudted but file not found
+            try:
+                sp.check_call(self.dsmc.split() + ['query', 'archive', src_file_abs], stdout=sp.PIPE, stderr=sp.PIPE)
+                value = True
+            except sp.CalledProcessError:
+                value = False
         if not silent:
             msg = "File {} {} in PDC".format(src_file_abs, "exist" if value else "do not exist")
             logger.info(msg)
         return value
 
     def _call_commands(self, cmd1, cmd2=None, out_file=None, return_out=False, 
-                       mail_failed=False, tmp_files=[]):
+                       mail_failed=False, tmp_files=[], cwd=None):
         """Call an external command(s) with at most two commands per function call.
         Given 'out_file' is always used for the later cmd and also stdout can be return
-        for the later cmd. In case of failure, the 'tmp_files' are removed"""
+        for the later cmd. In case of failure, the 'tmp_files' are removed. If 'cwd'
+        is given, the commands are called from there and relative paths are relative to it"""
+        if cwd:
+            out_file = os.path.join(cwd, out_file) if out_file else None
+            tmp_files = [os.path.join(cwd, fl) for fl in tmp_files]
         if out_file:
             if not cmd2:
                 stdout1 = open(out_file, 'w')
@@ -128,10 +249,10 @@ class backup_utils(object):
         # calling the commands
         try:
             cmd1 = cmd1.split()
-            p1 = sp.Popen(cmd1, stdout=stdout1, stderr=sp.PIPE)
+            p1 = sp.Popen(cmd1, stdout=stdout1, stderr=sp.PIPE, cwd=cwd)
             if cmd2:
                 cmd2 = cmd2.split()
-                p2 = sp.Popen(cmd2, stdin=p1.stdout, stdout=stdout2, stderr=sp.PIPE)
+                p2 = sp.Popen(cmd2, stdin=p1.stdout, stdout=stdout2, stderr=sp.PIPE, cwd=cwd)
                 p2_stat = p2.wait()
                 p2_out, p2_err = p2.communicate()
                 if not self._check_status(cmd2, p2_stat, p2_err, mail_failed, tmp_files):
@@ -164,129 +285,991 @@ class backup_utils(object):
             return False
         return True
 
-    def _clean_tmp_files(self, files):
-        """Remove the file is exist"""
+    def _clean_tmp_files(self, files, cwd=None):
+        """Remove the file is exist, relative paths are relative to 'cwd' if given"""
+        if cwd:
+            files = [os.path.join(cwd, fl) for fl in files]
         for fl in files:
             if os.path.exists(fl):
                 os.remove(fl)
             
+    def _stream_encrypt(self, run, tmp_files=[], pigz_cmd="pigz --fast -c -"):
+        """Create the encrypted archive of a run in a single pass, piping tar and pigz
+        (or the already zipped archive if it exists) into gpg. The md5sum of the zipped
+        stream is calculated on the way, so there is no need to decrypt it again to
+        verify it. Returns the md5sum or None if any of the commands failed"""
+        gpg_cmd = ["gpg", "--symmetric", "--cipher-algo", "aes256", "--passphrase-file", run.key,
+                   "--batch", "--compress-algo", "none", "-o", run.zip_encrypted]
+        procs = []
+        try:
+            if os.path.exists(os.path.join(run.path, run.zip)):
+                zip_stream = open(os.path.join(run.path, run.zip), 'rb')
+            else:
+                tar = self._popen(["tar", "-cf", "-", run.name], procs, stdout=sp.PIPE, cwd=run.path)
+                pigz = self._popen(pigz_cmd.split(), procs, stdin=tar.stdout, stdout=sp.PIPE)
+                tar.stdout.close()
+                zip_stream = pigz.stdout
+            gpg = self._popen(gpg_cmd, procs, stdin=sp.PIPE, cwd=run.path)
+            md5 = hashlib.md5()
+            try:
+                misc.copy_stream(zip_stream, gpg.stdin, hashers=[md5])
+            except IOError as e:
+                # gpg died, its exit status will tell why
+                logger.error("Streaming run {} into gpg failed with error {}".format(run.name, e))
+            finally:
+                zip_stream.close()
+                gpg.stdin.close()
+            # gpg may have written part of the file before another command failed
+            tmp_files = set(tmp_files).union([run.zip_encrypted])
+            if not self._wait_commands(procs, mail_failed=True,
+                                       tmp_files=[os.path.join(run.path, fl) for fl in tmp_files]):
+                return None
+            return md5.hexdigest()
+        finally:
+            for _, _, err in procs:
+                err.close()
+
+    def _popen(self, cmd, procs, **kwargs):
+        """Start a command of a pipeline and add it to the list 'procs', stderr goes to a
+        temporary file because a pipe could fill up and block the command"""
+        err = tempfile.TemporaryFile()
+        proc = sp.Popen(cmd, stderr=err, **kwargs)
+        procs.append((cmd, proc, err))
+        return proc
+
+    def _wait_commands(self, procs, mail_failed=False, tmp_files=[]):
+        """Wait for all the commands of a pipeline started with '_popen' and check their status"""
+        # All of them have to be done before checking, the files of a failed pipeline
+        # are removed and a command still running could write them again
+        statuses = [proc.wait() for _, proc, _ in procs]
+        success = True
+        for (cmd, proc, err), status in zip(procs, statuses):
+            err.seek(0)
+            if success and not self._check_status(cmd, status, err.read(), mail_failed, tmp_files):
+                success = False
+        return success
+
+    def _write_md5(self, run, md5_sum):
+        """Write the md5sum of the zipped run next to the encrypted file, md5sum style"""
+        with open(os.path.join(run.path, run.zip_md5), 'w') as md5_file:
+            md5_file.write("{}  {}\n".format(md5_sum, run.zip))
+
+    def _read_manifest(self, run):
+        """Read the manifest of a run archived in chunks. Returns the chunk size, the list
+        of (part, size, md5sum) done so far and whether all the parts are done. The md5sum
+        is the one of the slice of the tar stream the part holds"""
+        chunk_size, parts, complete = None, [], False
+        for name, done in [(run.manifest, True), ("{}.partial".format(run.manifest), False)]:
+            manifest = os.path.join(run.path, run.chunks, name)
+            if os.path.exists(manifest):
+                complete = done
+                break
+        else:
+            return chunk_size, parts, complete
+        with open(manifest) as fh:
+            for line in fh:
+                if line.startswith("# chunk_size"):
+                    chunk_size = int(line.split()[-1])
+                elif line.strip():
+                    part, size, md5 = line.strip().split('\t')
+                    parts.append((part, int(size), md5))
+        return chunk_size, parts, complete
+
+    def _chunk_encrypt(self, run, chunk_size, pigz_cmd="pigz --fast -c -"):
+        """Split the tar stream of a run (or the already zipped archive, if it exists) in
+        parts of 'chunk_size' bytes, compressing and encrypting each of them on its own.
+        Every finished part is recorded in a partial manifest, so an interrupted encryption
+        goes on from the last finished part; the parts already done are only read again
+        to make sure they come from the same data. The manifest is completed at the end"""
+        chunks_dir = os.path.join(run.path, run.chunks)
+        partial = os.path.join(chunks_dir, "{}.partial".format(run.manifest))
+        filesystem.create_folder(chunks_dir)
+        previous_size, parts, _ = self._read_manifest(run)
+        if parts and previous_size != chunk_size:
+            logger.warn("Run {} was partly encrypted in chunks of {} bytes, going on with them".format(run.name, previous_size))
+            chunk_size = previous_size
+        if os.path.exists(os.path.join(run.path, run.zip)):
+            source_cmd = ["pigz", "-dc", run.zip]
+        else:
+            source_cmd = ["tar", "-cf", "-", run.name]
+        procs = []
+        try:
+            source = self._popen(source_cmd, procs, stdout=sp.PIPE, cwd=run.path)
+            for part, size, md5 in parts:
+                hasher = hashlib.md5()
+                if (not os.path.exists(os.path.join(chunks_dir, part)) or
+                        misc.copy_stream(source.stdout, None, hashers=[hasher], size=size) != size or
+                        hasher.hexdigest() != md5):
+                    logger.warn("Run {} changed since its encryption was interrupted, starting over".format(run.name))
+                    source.kill()
+                    source.wait()
+                    shutil.rmtree(chunks_dir)
+                    return self._chunk_encrypt(run, chunk_size, pigz_cmd)
+            if parts:
+                logger.info("Resuming encryption of run {} from part {}".format(run.name, len(parts)))
+            with open(partial, 'a') as manifest:
+                if not parts:
+                    manifest.write("# chunk_size {}\n".format(chunk_size))
+                index = len(parts)
+                while True:
+                    part = run.part(index)
+                    gpg_cmd = ["gpg", "--symmetric", "--cipher-algo", "aes256", "--passphrase-file",
+                               os.path.join(run.path, run.key), "--batch", "--yes", "--compress-algo",
+                               "none", "-o", part]
+                    part_procs = []
+                    try:
+                        pigz = self._popen(pigz_cmd.split(), part_procs, stdin=sp.PIPE, stdout=sp.PIPE)
+                        self._popen(gpg_cmd, part_procs, stdin=pigz.stdout, cwd=chunks_dir)
+                        pigz.stdout.close()
+                        md5 = hashlib.md5()
+                        size = None
+                        try:
+                            size = misc.copy_stream(source.stdout, pigz.stdin, hashers=[md5], size=chunk_size)
+                        except IOError as e:
+                            logger.error("Streaming part {} into gpg failed with error {}".format(part, e))
+                        finally:
+                            pigz.stdin.close()
+                        if not self._wait_commands(part_procs, mail_failed=True) or size is None:
+                            source.kill()
+                            source.wait()
+                            return False
+                    finally:
+                        for _, _, err in part_procs:
+                            err.close()
+                    if size == 0 and index > 0:
+                        # the stream ended right at the end of the previous part
+                        self._clean_tmp_files([part], cwd=chunks_dir)
+                        break
+                    manifest.write("{}\t{}\t{}\n".format(part, size, md5.hexdigest()))
+                    manifest.flush()
+                    os.fsync(manifest.fileno())
+                    index += 1
+                    if size < chunk_size:
+                        break
+            if not self._wait_commands(procs, mail_failed=True):
+                return False
+            os.rename(partial, os.path.join(chunks_dir, run.manifest))
+            logger.info("Run {} was encrypted in {} part(s)".format(run.name, index))
+            return True
+        finally:
+            for _, _, err in procs:
+                err.close()
+
+    def _encrypt_run_chunked(self, run, chunk_size, pigz_cmd):
+        """Encrypt a single collected run in chunks and return True if it was successfully
+        done. Unlike the single file encryption, nothing is removed if it fails, so that
+        calling it again resumes the encryption"""
+        flag = os.path.join(run.path, "{}.encrypting".format(run.name))
+        key = os.path.join(run.path, run.key)
+        dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        source = os.path.join(run.path, run.name)
+        zipped = os.path.join(run.path, run.zip)
+        _, parts, complete = self._read_manifest(run)
+        if complete and not os.path.exists(key):
+            logger.info("Run {} is already encrypted in chunks, skipping it".format(run.name))
+            return True
+        if os.path.exists(flag):
+            logger.warn("Run {} is already being encrypted, so skipping now".format(run.name))
+            return False
+        if os.path.isdir(source) and os.path.exists(zipped):
+            logger.warn("Both run source and zipped archive exist for run {}, skipping run as precaution".format(run.name))
+            return False
+        if not complete and not os.path.isdir(source) and not os.path.exists(zipped):
+            logger.error("Run {} is partly encrypted in chunks but its source is gone, skipping it".format(run.name))
+            return False
+        logger.info("Encryption of run {} in chunks of {} bytes is now started".format(run.name, chunk_size))
+        open(flag, 'w').close()
+        try:
+            if not os.path.exists(key):
+                if parts:
+                    # the parts can not be decrypted without it
+                    logger.warn("Key of the partly encrypted run {} is gone, starting over".format(run.name))
+                    shutil.rmtree(os.path.join(run.path, run.chunks))
+                if not self._call_commands(cmd1=GEN_KEY_CMD, out_file=run.key, tmp_files=[run.key], cwd=run.path):
+                    logger.warn("Skipping run {} and moving on".format(run.name))
+                    return False
+                logger.info("Generated random phrase key for run {}".format(run.name))
+            if not complete and not self._chunk_encrypt(run, chunk_size, pigz_cmd):
+                logger.warn("Encryption of run {} stopped, it will be resumed the next time".format(run.name))
+                return False
+            if not self._call_commands(cmd1="gpg -e -r {} --yes -o {} {}".format(self.gpg_receiver, run.key_encrypted, run.key),
+                                       tmp_files=[run.key_encrypted], cwd=run.path):
+                logger.error("Encrption of key file failed, skipping run")
+                return False
+            shutil.move(os.path.join(run.path, run.key_encrypted), dst_key_encrypted)
+            if os.path.isdir(source):
+                logger.info("Run {} was successfully encrypted, so removing the run source directory".format(run.name))
+                shutil.rmtree(source)
+            self._clean_tmp_files([zipped, key])
+            logger.info("Encryption of run {} in chunks is successfully done".format(run.name))
+            return True
+        finally:
+            self._clean_tmp_files([flag])
+
+    def _encrypt_run(self, run, force, stream=False, pigz_threads=None, chunk_size=None):
+        """Encrypt a single collected run and return True if it was successfully done.
+        Commands are called from the run's directory and files are handled with their
+        absolute path, so that several runs can be encrypted at the same time. If
+        'chunk_size' is given (or the run was already partly encrypted in chunks), the
+        run is encrypted in parts of that size instead of a single file"""
+        pigz_cmd = "pigz --fast -c -" if not pigz_threads else "pigz --fast -p {} -c -".format(pigz_threads)
+        if chunk_size or os.path.isdir(os.path.join(run.path, run.chunks)):
+            chunk_size = chunk_size or self._read_manifest(run)[0] or DEFAULT_CHUNK_SIZE
+            return self._encrypt_run_chunked(run, chunk_size, pigz_cmd)
+        run.flag = "{}.encrypting".format(run.name)
+        run.dst_key_encrypted = os.path.join(self.keys_path, run.key_encrypted)
+        tmp_files = [run.zip_encrypted, run.key_encrypted, run.key, run.flag]
+        def in_run_path(name):
+            return os.path.join(run.path, name)
+        logger.info("Encryption of run {} is now started".format(run.name))
+        # skip run if already ongoing
+        if os.path.exists(in_run_path(run.flag)):
+            logger.warn("Run {} is already being encrypted, so skipping now".format(run.name))
+            return False
+        flag = open(in_run_path(run.flag), 'w').close()
+        # zip the run directory, unless the archive is streamed straight into gpg
+        if os.path.exists(in_run_path(run.zip)):
+            if os.path.isdir(in_run_path(run.name)):
+                logger.warn("Both run source and zipped archive exist for run {}, skipping run as precaution".format(run.name))
+                self._clean_tmp_files([run.flag], cwd=run.path)
+                return False
+            logger.info("Zipped archive already exist for run {}, so using it for encryption".format(run.name))
+        elif not stream:
+            logger.info("Creating zipped archive for run {}".format(run.name))
+            if self._call_commands(cmd1="tar -cf - {}".format(run.name), cmd2=pigz_cmd, out_file=run.zip,
+                                   mail_failed=True, tmp_files=[run.zip, run.flag], cwd=run.path):
+                logger.info("Run {} was successfully compressed, so removing the run source directory".format(run.name))
+                shutil.rmtree(in_run_path(run.name))
+            else:
+                logger.warn("Skipping run {} and moving on".format(run.name))
+                return False
+        # Remove encrypted file if already exists
+        if os.path.exists(in_run_path(run.zip_encrypted)):
+            logger.warn(("Removing already existing encrypted file for run {}, this is a precaution "
+                         "to make sure the file was encrypted with correct key file".format(run.name)))
+            self._clean_tmp_files([run.zip_encrypted, run.key, run.key_encrypted, run.dst_key_encrypted], cwd=run.path)
+        # Generate random key to use as pasphrase
+        if not self._call_commands(cmd1=GEN_KEY_CMD, out_file=run.key, tmp_files=tmp_files, cwd=run.path):
+            logger.warn("Skipping run {} and moving on".format(run.name))
+            return False
+        logger.info("Generated random phrase key for run {}".format(run.name))
+        if stream:
+            # Compress, encrypt and calculate md5sum in a single pass over the data
+            logger.info("Streaming run {} into the encrypted file".format(run.name))
+            md5_pre_encrypt = self._stream_encrypt(run, tmp_files=tmp_files, pigz_cmd=pigz_cmd)
+            if not md5_pre_encrypt:
+                logger.warn("Skipping run {} and moving on".format(run.name))
+                return False
+            self._write_md5(run, md5_pre_encrypt)
+        else:
+            # Calculate md5 sum pre encryption
+            if not force:
+                logger.info("Calculating md5sum before encryption")
+                try:
+                    md5_pre_encrypt = misc.hashfile(in_run_path(run.zip), hasher='md5', blocksize=8388608)
+                except IOError as e:
+                    logger.error("Calculating md5sum of {} failed with error {}".format(run.zip, e))
+                    self._clean_tmp_files(tmp_files, cwd=run.path)
+                    logger.warn("Skipping run {} and moving on".format(run.name))
+                    return False
+            # Encrypt the zipped run file
+            logger.info("Encrypting the zipped run file")
+            if not self._call_commands(cmd1=("gpg --symmetric --cipher-algo aes256 --passphrase-file {} --batch --compress-algo "
+                                             "none -o {} {}".format(run.key, run.zip_encrypted, run.zip)),
+                                       tmp_files=tmp_files, cwd=run.path):
+                logger.warn("Skipping run {} and moving on".format(run.name))
+                return False
+            # Decrypt and check for md5
+            if not force:
+                logger.info("Calculating md5sum after encryption")
+                md5_call, md5_out = self._call_commands(cmd1="gpg --decrypt --cipher-algo aes256 --passphrase-file {} --batch {}".format(run.key, run.zip_encrypted),
+                                                        cmd2="md5sum", return_out=True, tmp_files=tmp_files, cwd=run.path)
+                if not md5_call:
+                    logger.warn("Skipping run {} and moving on".format(run.name))
+                    return False
+                md5_post_encrypt = md5_out.split()[0]
+                if md5_pre_encrypt != md5_post_encrypt:
+                    logger.error(("md5sum did not match before {} and after {} encryption. Will remove temp files and "
+                                  "move on".format(md5_pre_encrypt, md5_post_encrypt)))
+                    self._clean_tmp_files(tmp_files, cwd=run.path)
+                    return False
+                logger.info("Md5sum is macthing before and after encryption")
+                self._write_md5(run, md5_pre_encrypt)
+        # Encrypt and move the key file
+        if self._call_commands(cmd1="gpg -e -r {} -o {} {}".format(self.gpg_receiver, run.key_encrypted, run.key),
+                               tmp_files=tmp_files, cwd=run.path):
+            shutil.move(in_run_path(run.key_encrypted), run.dst_key_encrypted)
+        else:
+            logger.error("Encrption of key file failed, skipping run")
+            return False
+        if os.path.isdir(in_run_path(run.name)):
+            # Only happens when streaming, the run was never zipped
+            logger.info("Run {} was successfully encrypted, so removing the run source directory".format(run.name))
+            shutil.rmtree(in_run_path(run.name))
+        self._clean_tmp_files([run.zip, run.key, run.flag], cwd=run.path)
+        logger.info("Encryption of run {} is successfully done, removing zipped run file".format(run.name))
+        return True
+
+    def _encrypt_run_safely(self, run, force, stream, pigz_threads, chunk_size=None):
+        """Encrypt a run from a worker thread, errors are logged and contained
+        so that they do not affect the other runs"""
+        try:
+            return self._encrypt_run(run, force, stream=stream, pigz_threads=pigz_threads, chunk_size=chunk_size)
+        except Exception as e:
+            logger.error("Encryption of run {} failed with error {}".format(run.name, e))
+            return False
+
+    def _dir_size(self, path, finished=True):
+        """Return the size in bytes of the files under a directory. The sizes of the
+        directories are kept in the cache backup.size_cache (by default dir_sizes.db in
+        ~/.taca), so only what changed is listed again. For runs still being sequenced,
+        only the directories not written for backup.size_settle seconds (default 3600)
+        are cached, as the files of the current cycles grow in place"""
+        cache = CONFIG['backup'].get('size_cache')
+        if cache is None:
+            cache_dir = os.path.join(os.environ.get('HOME'), '.taca')
+            filesystem.create_folder(cache_dir)
+            cache = os.path.join(cache_dir, 'dir_sizes.db')
+        settle = None if finished else CONFIG['backup'].get('size_settle', 3600)
+        return filesystem.tree_stats(path, workers=CONFIG['backup'].get('size_workers', 8),
+                                     cache=cache, settle=settle)[0]
+
+    def _run_size(self, run):
+        """Return the size in bytes of the run directory, or of its zipped archive if it exists"""
+        zip_file = os.path.join(run.path, run.zip)
+        if os.path.exists(zip_file):
+            return os.path.getsize(zip_file)
+        if not os.path.isdir(os.path.join(run.path, run.name)):
+            return 0
+        return self._dir_size(os.path.join(run.path, run.name))
+
+    def _required_space(self, run, stream):
+        """Return the space in bytes the encryption of a run needs. The classic way
+        keeps the zipped and the encrypted file on disk at the same time, while the
+        streamed (or chunked) encrypted file is at most as big as the run itself. The
+        parts of a run already encrypted in chunks are not needed again"""
+        size = self._run_size(run)
+        zipped = os.path.exists(os.path.join(run.path, run.zip))
+        if os.path.isdir(os.path.join(run.path, run.chunks)):
+            _, parts, complete = self._read_manifest(run)
+            if complete:
+                return 0
+            if not zipped:
+                # the sizes in the manifest are the ones of the slices of the tar stream
+                size = max(0, size - sum(part_size for _, part_size, _ in parts))
+            return size
+        if stream or zipped:
+            return size
+        return 2 * size
+
     @classmethod
-    def encrypt_runs(cls, run, force):
-        """Encrypt the runs that have been collected"""
+    def encrypt_runs(cls, run, force, stream=False, workers=None, chunk_size=None):
+        """Encrypt the runs that have been collected. If 'stream' is set, the run is
+        compressed and encrypted in a single pass without an intermediate zipped file.
+        If 'chunk_size' (in GB, by default backup.chunk_size from the config) is set, the
+        run is streamed into parts of that size that are compressed and encrypted on
+        their own, so that an interrupted encryption can be resumed.
+        Up to 'workers' runs (by default backup.encrypt_workers from the config, or
+        the number of CPUs) are encrypted at the same time, as long as there is enough
+        free space for them; the rest wait in a queue until some space is freed"""
         bk = cls(run)
         bk.collect_runs(ext=".tar.gz")
         logger.info("In total, found {} run(s) to be encrypted".format(len(bk.runs)))
-        for run in bk.runs:
-            run.flag = "{}.encrypting".format(run.name)
-            run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
-            tmp_files = [run.zip_encrypted, run.key_encrypted, run.key, run.flag]
-            logger.info("Encryption of run {} is now started".format(run.name))
-            # Check if there is enough space and exit if not
-            bk.avail_disk_space(run.path, run.name)
-            with filesystem.chdir(run.path):
-                # skip run if already ongoing
-                if os.path.exists(run.flag):
-                    logger.warn("Run {} is already being encrypted, so skipping now".format(run.name))
-                    continue
-                flag = open(run.flag, 'w').close()
-                # zip the run directory
-                if os.path.exists(run.zip):
-                    if os.path.isdir(run.name):
-                        logger.warn("Both run source and zipped archive exist for run {}, skipping run as precaution".format(run.name))
-                        bk._clean_tmp_files([run.flag])
-                        continue
-                    logger.info("Zipped archive already exist for run {}, so using it for encryption".format(run.name))
-                else:
-                    logger.info("Creating zipped archive for run {}".format(run.name))
-                    if bk._call_commands(cmd1="tar -cf - {}".format(run.name), cmd2="pigz --fast -c -",
-                                         out_file=run.zip, mail_failed=True, tmp_files=[run.zip, run.flag]):
-                        logger.info("Run {} was successfully compressed, so removing the run source directory".format(run.name))
-                        shutil.rmtree(run.name)
-                    else:
-                        logger.warn("Skipping run {} and moving on".format(run.name))
-                        continue
-                # Remove encrypted file if already exists
-                if os.path.exists(run.zip_encrypted):
-                    logger.warn(("Removing already existing encrypted file for run {}, this is a precaution "
-                                 "to make sure the file was encrypted with correct key file".format(run.name)))
-                    bk._clean_tmp_files([run.zip_encrypted, run.key, run.key_encrypted, run.dst_key_encrypted])
-                # Generate random key to use as pasphrase
-                if not bk._call_commands(cmd1="gpg --gen-random 1 256", out_file=run.key, tmp_files=tmp_files):
-                    logger.warn("Skipping run {} and moving on".format(run.name))
-                    continue
-                logger.info("Generated random phrase key for run {}".format(run.name))
-                # Calculate md5 sum pre encryption
-                if not force:
-                    logger.info("Calculating md5sum before encryption")
-                    md5_call, md5_out = bk._call_commands(cmd1="md5sum {}".format(run.zip), return_out=True, tmp_files=tmp_files)
-                    if not md5_call:
-                        logger.warn("Skipping run {} and moving on".format(run.name))
-                        continue
-                    md5_pre_encrypt = md5_out.split()[0]
-                # Encrypt the zipped run file
-                logger.info("Encrypting the zipped run file")
-                if not bk._call_commands(cmd1=("gpg --symmetric --cipher-algo aes256 --passphrase-file {} --batch --compress-algo "
-                                               "none -o {} {}".format(run.key, run.zip_encrypted, run.zip)), tmp_files=tmp_files):
-                    logger.warn("Skipping run {} and moving on".format(run.name))
-                    continue
-                # Decrypt and check for md5
-                if not force:
-                    logger.info("Calculating md5sum after encryption")
-                    md5_call, md5_out = bk._call_commands(cmd1="gpg --decrypt --cipher-algo aes256 --passphrase-file {} --batch {}".format(run.key, run.zip_encrypted),
-                                                          cmd2="md5sum", return_out=True, tmp_files=tmp_files)
-                    if not md5_call:
-                        logger.warn("Skipping run {} and moving on".format(run.name))
-                        continue
-                    md5_post_encrypt = md5_out.split()[0]
-                    if md5_pre_encrypt != md5_post_encrypt:
-                        logger.error(("md5sum did not match before {} and after {} encryption. Will remove temp files and "
-                                      "move on".format(md5_pre_encrypt, md5_post_encrypt)))
-                        bk._clean_tmp_files(tmp_files)
+        if not bk.runs:
+            return
+        chunk_size = chunk_size or CONFIG['backup'].get('chunk_size')
+        chunk_size = int(chunk_size * 1024**3) if chunk_size else None
+        cpus = multiprocessing.cpu_count()
+        workers = min(workers or CONFIG['backup'].get('encrypt_workers', cpus), cpus, len(bk.runs))
+        # share the CPUs among the concurrent pigz processes
+        pigz_threads = max(1, cpus // workers) if workers > 1 else None
+        # space for the unfinished sequencing runs has to be left free on every file system
+        reserve = bk._ongoing_runs_size()
+        queue = [(r, bk._required_space(r, stream or chunk_size)) for r in bk.runs]
+        ongoing = {}
+        # The pool calls back before the result is ready, so the finished runs are
+        # recorded by the callback itself and no wake-up is lost
+        done = []
+        finished = threading.Condition()
+        def run_done(name):
+            with finished:
+                done.append(name)
+                finished.notify()
+        pool = ThreadPool(workers)
+        try:
+            while queue or ongoing:
+                with finished:
+                    for name, (result, _, _) in ongoing.items():
+                        if name in done or result.ready():
+                            del ongoing[name]
+                    del done[:]
+                for item in list(queue):
+                    if len(ongoing) >= workers:
+                        break
+                    r, required = item
+                    device = os.stat(r.path).st_dev
+                    reserved = sum(size for (_, dev, size) in ongoing.values() if dev == device)
+                    available = filesystem.disk_free(r.path) - reserved - reserve
+                    if required > available:
+                        if not any(dev == device for (_, dev, _) in ongoing.values()):
+                            # Nothing else will free space for this run in this round
+                            queue.remove(item)
+                            e_msg = ("Required space for encryption of run {} is {}GB, but only {}GB "
+                                     "available".format(r.name, required/1024**3, max(available, 0)/1024**3))
+                            logger.error(e_msg)
+                            misc.send_mail("Low space for encryption - {}".format(bk.host_name), e_msg, bk.mail_recipients)
                         continue
-                    logger.info("Md5sum is macthing before and after encryption")
-                # Encrypt and move the key file
-                if bk._call_commands(cmd1="gpg -e -r {} -o {} {}".format(bk.gpg_receiver, run.key_encrypted, run.key), tmp_files=tmp_files):
-                    shutil.move(run.key_encrypted, run.dst_key_encrypted)
-                else:
-                    logger.error("Encrption of key file failed, skipping run")
-                    continue
-                bk._clean_tmp_files([run.zip, run.key, run.flag])
-                logger.info("Encryption of run {} is successfully done, removing zipped run file".format(run.name))
+                    queue.remove(item)
+                    result = pool.apply_async(bk._encrypt_run_safely, (r, force, stream, pigz_threads, chunk_size),
+                                              callback=lambda _, name=r.name: run_done(name))
+                    ongoing[r.name] = (result, device, required)
+                if queue and ongoing:
+                    logger.info("{} run(s) being encrypted, {} waiting".format(len(ongoing), len(queue)))
+                if ongoing:
+                    with finished:
+                        if not done:
+                            finished.wait(60)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _archive_file(self, afile):
+        """Archive a file to PDC, retrying with an increasing delay if dsmc fails"""
+        return misc.retry(lambda: self._call_commands(cmd1="{} archive {}".format(self.dsmc, afile)),
+                          attempts=self.pdc_retries, delay=self.pdc_retry_delay)
+
+    def _verify_in_pdc(self, files):
+        """Poll PDC with an increasing delay until all the given files are listed as archived
+        (dsmc might need some time to settle). Every poll refreshes the index of each of
+        their directories, so it takes a single dsmc call per directory"""
+        files = [os.path.abspath(fl) for fl in files]
+        directories = misc.return_unique([os.path.dirname(fl) for fl in files])
+        def archived():
+            for directory in directories:
+                self.refresh_pdc_index(directory)
+            index = dict((directory, self._pdc_dir_index(directory) or {}) for directory in directories)
+            return all(fl in index[os.path.dirname(fl)] for fl in files)
+        return misc.retry(archived, attempts=self.pdc_retries + 2, delay=max(1, self.pdc_retry_delay // 3))
+
+    def _pdc_put_run(self, run, sessions=1):
+        """Archive the encrypted run and its encrypted key to PDC and remove them locally
+        once they are verified to be there. Returns the outcome of the run as a tuple
+        ('archived', 'skipped' or 'failed', message). The parts of a run encrypted in
+        chunks are sent using up to 'sessions' dsmc sessions"""
+        zip_encrypted = os.path.join(run.path, run.zip_encrypted)
+        dst_key_encrypted = os.path.join(os.path.abspath(self.keys_path), run.key_encrypted)
+        flag = os.path.join(run.path, "{}.archiving".format(run.name))
+        if run.path not in [os.path.abspath(adir) for adir in self.archive_dirs]:
+            return ('skipped', "not in one of the archive directories {}, kindly move it to an appropriate "
+                               "archive dir before sending it to PDC".format(",".join(self.archive_dirs)))
+        if not os.path.exists(dst_key_encrypted):
+            return ('skipped', "encrypted key file {} is not found".format(dst_key_encrypted))
+        # skip run if already ongoing
+        if os.path.exists(flag):
+            return ('skipped', "already being archived")
+        open(flag, 'w').close()
+        try:
+            if os.path.isdir(os.path.join(run.path, run.chunks)):
+                return self._pdc_put_chunked(run, dst_key_encrypted, sessions)
+            if self.file_in_pdc(zip_encrypted) or self.file_in_pdc(dst_key_encrypted):
+                return ('skipped', "files related to the run already exist in PDC, check and cleanup")
+            start = time.time()
+            files = [zip_encrypted, dst_key_encrypted]
+            # the md5sum of the zipped run lets a restore verify it on the way
+            zip_md5 = os.path.join(run.path, run.zip_md5)
+            if os.path.exists(zip_md5):
+                files.append(zip_md5)
+            for afile in files:
+                if not self._archive_file(afile):
+                    return ('failed', "dsmc archive of {} failed after {} attempt(s)".format(afile, self.pdc_retries))
+            if not self._verify_in_pdc(files):
+                return ('failed', "archived files could not be found in PDC, check and cleanup")
+            self._clean_tmp_files(files)
+            return ('archived', "sent to PDC in {:.0f}s and removed locally".format(time.time() - start))
+        finally:
+            self._clean_tmp_files([flag])
+
+    def _pdc_put_chunked(self, run, dst_key_encrypted, sessions=1):
+        """Archive the parts of a run encrypted in chunks, then its manifest and its
+        encrypted key. The parts sent are verified to be in PDC all at once and removed
+        locally, and parts found there already are not sent again, so an interrupted
+        upload goes on where it stopped. Returns the outcome like '_pdc_put_run'"""
+        chunks_dir = os.path.join(run.path, run.chunks)
+        manifest = os.path.join(chunks_dir, run.manifest)
+        _, parts, complete = self._read_manifest(run)
+        if not complete:
+            return ('skipped', "still being encrypted")
+        if self.file_in_pdc(manifest) or self.file_in_pdc(dst_key_encrypted):
+            return ('skipped', "files related to the run already exist in PDC, check and cleanup")
+        start = time.time()
+        def put_part(part):
+            path = os.path.join(chunks_dir, part)
+            if self.file_in_pdc(path):
+                self._clean_tmp_files([path])
+                return True
+            if not os.path.exists(path):
+                logger.error("Part {} of run {} is neither here nor in PDC".format(part, run.name))
+                return False
+            return self._archive_file(path)
+        pool = ThreadPool(max(1, min(sessions, len(parts))))
+        try:
+            sent = pool.map(put_part, [part for part, _, _ in parts])
+        finally:
+            pool.close()
+            pool.join()
+        # a single query of the chunks directory verifies all the parts sent
+        archived = [os.path.join(chunks_dir, part) for (part, _, _), done in zip(parts, sent)
+                    if done and os.path.exists(os.path.join(chunks_dir, part))]
+        if archived and not self._verify_in_pdc(archived):
+            return ('failed', "archived parts could not be found in PDC, check and cleanup")
+        self._clean_tmp_files(archived)
+        if not all(sent):
+            return ('failed', "{} of {} part(s) could not be sent, run again to resume".format(sent.count(False), len(parts)))
+        for afile in [manifest, dst_key_encrypted]:
+            if not self._archive_file(afile):
+                return ('failed', "dsmc archive of {} failed after {} attempt(s)".format(afile, self.pdc_retries))
+        if not self._verify_in_pdc([manifest, dst_key_encrypted]):
+            return ('failed', "archived files could not be found in PDC, check and cleanup")
+        shutil.rmtree(chunks_dir)
+        self._clean_tmp_files([dst_key_encrypted])
+        return ('archived', "sent {} part(s) to PDC in {:.0f}s and removed locally".format(len(parts), time.time() - start))
+
+    def _pdc_put_run_safely(self, run, sessions=1):
+        """Archive a run from a worker thread, errors are logged and contained
+        so that they do not affect the other runs"""
+        logger.info("Sending run {} to PDC".format(run.name))
+        try:
+            result = self._pdc_put_run(run, sessions)
+        except Exception as e:
+            result = ('failed', "unexpected error {}".format(e))
+        logger.info("Run {} {}: {}".format(run.name, result[0], result[1]))
+        return result
 
     @classmethod
-    def pdc_put(cls, run):
-        """Archive the collected runs to PDC"""
+    def pdc_put(cls, run, sessions=None):
+        """Archive the collected runs to PDC. Up to 'sessions' runs (by default
+        backup.pdc_sessions from the config, or 1) are sent at the same time, each
+        with its own dsmc session; sessions left over are used to send the parts of
+        the runs encrypted in chunks. A summary of all the runs is logged at the end,
+        and mailed if any of them failed"""
         bk = cls(run)
         bk.collect_runs(ext=".tar.gz.gpg", filter_by_ext=True)
         logger.info("In total, found {} run(s) to send PDC".format(len(bk.runs)))
-        for run in bk.runs:
-            run.flag = "{}.archiving".format(run.name)
-            run.dst_key_encrypted = os.path.join(bk.keys_path, run.key_encrypted)
-            if run.path not in bk.archive_dirs:
-                logger.error(("Given run is not in one of the archive directories {}. Kindly move the run {} to appropriate "
-                              "archive dir before sending it to PDC".format(",".join(bk.archive_dirs), run.name)))
-                continue
-            if not os.path.exists(run.dst_key_encrypted):
-                logger.error("Encrypted key file {} is not found for file {}, skipping it".format(run.dst_key_encrypted, run.zip_encrypted))
-                continue
-            # skip run if already ongoing
-            if os.path.exists(run.flag):
-                logger.warn("Run {} is already being archived, so skipping now".format(run.name))
-                continue
-            flag = open(run.flag, 'w').close()
-            with filesystem.chdir(run.path):
-                if bk.file_in_pdc(run.zip_encrypted, silent=False) or bk.file_in_pdc(run.dst_key_encrypted, silent=False):
-                    logger.warn("Seems like files realted to run {} already exist in PDC, check and cleanup".format(run.name))
-                    bk._clean_tmp_files([run.flag])
-                    continue
-                logger.info("Sending file {} to PDC".format(run.zip_encrypted))
-                if bk._call_commands(cmd1="dsmc archive {}".format(run.zip_encrypted), tmp_files=[run.flag]):
-                    time.sleep(15) # give some time just in case 'dsmc' needs to settle
-                    if bk._call_commands(cmd1="dsmc archive {}".format(run.dst_key_encrypted), tmp_files=[run.flag]):
-                        time.sleep(5) # give some time just in case 'dsmc' needs to settle
-                        if bk.file_in_pdc(run.zip_encrypted) and bk.file_in_pdc(run.dst_key_encrypted):
-                            logger.info("Successfully sent file {} to PDC, removing file locally from {}".format(run.zip_encrypted, run.path))
-                            bk._clean_tmp_files([run.zip_encrypted, run.dst_key_encrypted, run.flag])
-                        continue
-                logger.warn("Sending file {} to PDC failed".format(run.zip_encrypted))
+        if not bk.runs:
+            return {}
+        sessions = sessions or CONFIG['backup'].get('pdc_sessions', 1)
+        workers = min(sessions, len(bk.runs))
+        # query each archive directory once before the workers start using the index
+        for adir in set(r.path for r in bk.runs):
+            bk._pdc_dir_index(adir)
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(lambda r: bk._pdc_put_run_safely(r, max(1, sessions // workers)), bk.runs)
+        finally:
+            pool.close()
+            pool.join()
+        summary = dict((r.name, result) for r, result in zip(bk.runs, results))
+        counts = dict((status, sum(1 for s, _ in results if s == status)) for status in ['archived', 'skipped', 'failed'])
+        lines = ["{}\t{}\t{}".format(name, status, msg) for name, (status, msg) in sorted(summary.items())]
+        msg = "PDC archiving summary: {archived} archived, {skipped} skipped, {failed} failed".format(**counts)
+        logger.info("\n".join([msg] + lines))
+        if counts['failed']:
+            misc.send_mail("PDC archiving failed - {}".format(bk.host_name), "\n".join([msg] + lines), bk.mail_recipients)
+        return summary
+
+    def _pdc_locate(self, name):
+        """Find the files of an archived run in PDC, looking in the archive directories
+        for a single encrypted file or for the parts of a chunked one. Returns a dict
+        with (size, archive date) by path, including the encrypted key"""
+        found = {}
+        for adir in self.archive_dirs:
+            adir = os.path.abspath(adir)
+            for pattern in [os.path.join(adir, "{}.tar.gz*".format(name)),
+                            os.path.join(adir, "{}{}".format(name, CHUNKS_EXT), "*")]:
+                found.update(self.query_pdc(pattern) or {})
+            if found:
+                break
+        found.update(self.query_pdc(os.path.join(os.path.abspath(self.keys_path), "{}.key.gpg".format(name))) or {})
+        return found
+
+    def _pdc_retrieve(self, src_file, dst_dir):
+        """Retrieve a file from PDC into a directory, retrying with an increasing delay if dsmc fails"""
+        filesystem.create_folder(dst_dir)
+        return misc.retry(lambda: self._call_commands(cmd1="{} retrieve -replace=yes {} {}".format(
+                                                          self.dsmc, src_file, os.path.join(dst_dir, ''))),
+                          attempts=self.pdc_retries, delay=self.pdc_retry_delay)
+
+    def _restore_part(self, part, key, tar_stdin, compressed_md5=False):
+        """Decrypt and decompress a part of an archive into the stdin of tar, calculating
+        the md5sum of the stream on the way: of the compressed data if 'compressed_md5' is
+        set (as in the .tar.gz.md5 files) or else of the decompressed data (as in the
+        manifest of a chunked archive). Returns the md5sum or None if anything failed"""
+        procs = []
+        try:
+            gpg = self._popen(["gpg", "--decrypt", "--batch", "--passphrase-file", key, part], procs, stdout=sp.PIPE)
+            if compressed_md5:
+                pigz = self._popen(["pigz", "-dc"], procs, stdin=sp.PIPE, stdout=tar_stdin)
+                src, dst = gpg.stdout, pigz.stdin
+            else:
+                pigz = self._popen(["pigz", "-dc"], procs, stdin=gpg.stdout, stdout=sp.PIPE)
+                gpg.stdout.close()
+                src, dst = pigz.stdout, tar_stdin
+            md5 = hashlib.md5()
+            try:
+                misc.copy_stream(src, dst, hashers=[md5])
+            except IOError as e:
+                logger.error("Streaming {} into tar failed with error {}".format(part, e))
+                return None
+            finally:
+                src.close()
+                if compressed_md5:
+                    dst.close()
+                if not self._wait_commands(procs):
+                    md5 = None
+            return md5.hexdigest() if md5 else None
+        finally:
+            for _, _, err in procs:
+                err.close()
+
+    def _check_zip_md5(self, run, md5_sum):
+        """Compare the md5sum of a decrypted zipped run with the one written when it was
+        encrypted, if it is there. Returns False only if they do not match"""
+        zip_md5 = os.path.join(run.path, run.zip_md5)
+        if not os.path.exists(zip_md5):
+            logger.warn("No md5sum was found for run {}, relying on the integrity check of gpg".format(run.name))
+            return True
+        with open(zip_md5) as md5_file:
+            if md5_file.read().split()[0] != md5_sum:
+                logger.error("md5sum of the decrypted run {} did not match the one before encryption".format(run.name))
+                return False
+        logger.info("md5sum of the decrypted run {} matches the one before encryption".format(run.name))
+        return True
+
+    def _decrypt_key(self, key_encrypted, key, password=None):
+        """Decrypt the encrypted passphrase key of a run with the private gpg key, using
+        'password' to unlock it if given (or else gpg-agent). Returns True if it worked"""
+        cmd = ["gpg", "--decrypt", "--batch", "--yes", "-o", key]
+        if password:
+            cmd += ["--pinentry-mode", "loopback", "--passphrase-fd", "0"]
+        gpg = sp.Popen(cmd + [key_encrypted], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+        _, err = gpg.communicate(password)
+        if not self._check_status(cmd, gpg.returncode, err, False, [key]):
+            return False
+        os.chmod(key, 0600)
+        return True
+
+    def _decrypt_run(self, run, key_encrypted, password, outdir, extract=False):
+        """Decrypt an encrypted run (a single file or one encrypted in chunks) into 'outdir',
+        streaming it through gpg and pigz into a tar file or, if 'extract' is set, straight
+        into tar. The md5sums are calculated and checked on the way, so no plain zipped
+        file is written. Returns True if the run was decrypted"""
+        chunked = os.path.isdir(os.path.join(run.path, run.chunks))
+        if chunked:
+            _, parts, complete = self._read_manifest(run)
+            if not complete:
+                logger.error("Run {} is not completely encrypted in chunks".format(run.name))
+                return False
+        elif not os.path.exists(os.path.join(run.path, run.zip_encrypted)):
+            logger.error("Encrypted file {} is not found".format(os.path.join(run.path, run.zip_encrypted)))
+            return False
+        target = os.path.join(outdir, run.name if extract else "{}.tar".format(run.name))
+        if os.path.exists(target):
+            logger.error("{} already exists, not decrypting run {}".format(target, run.name))
+            return False
+        key = key_encrypted
+        if key_encrypted.endswith(".gpg"):
+            key = os.path.join(outdir, run.key)
+            if not self._decrypt_key(key_encrypted, key, password):
+                logger.error("Decryption of the key {} failed".format(key_encrypted))
+                return False
+        procs = []
+        success = False
+        try:
+            if extract:
+                tar = self._popen(["tar", "-xf", "-", "-C", outdir], procs, stdin=sp.PIPE)
+                dst = tar.stdin
+            else:
+                dst = open(target, 'wb')
+            try:
+                if chunked:
+                    logger.info("Decrypting run {} from {} part(s)".format(run.name, len(parts)))
+                    for part, _, md5 in parts:
+                        if self._restore_part(os.path.join(run.path, run.chunks, part), key, dst) != md5:
+                            logger.error("Part {} of run {} could not be decrypted or its md5sum did not match".format(part, run.name))
+                            break
+                    else:
+                        success = True
+                else:
+                    logger.info("Decrypting run {}".format(run.name))
+                    md5 = self._restore_part(os.path.join(run.path, run.zip_encrypted), key, dst, compressed_md5=True)
+                    success = bool(md5) and self._check_zip_md5(run, md5)
+            finally:
+                dst.close()
+            if extract:
+                if not success:
+                    tar.kill()
+                success = self._wait_commands(procs) and success
+        finally:
+            for _, _, err in procs:
+                err.close()
+            if key != key_encrypted:
+                self._clean_tmp_files([key])
+        if success:
+            logger.info("Run {} was successfully decrypted into {}".format(run.name, target))
+        elif not extract:
+            self._clean_tmp_files([target])
+        return success
+
+    def _pdc_locate_run(self, name, outdir):
+        """Find the archived files of a run that is to be restored into 'outdir', like
+        '_pdc_locate'. Returns None if the run can not be restored"""
+        found = self._pdc_locate(name)
+        key_encrypted = os.path.join(os.path.abspath(self.keys_path), "{}.key.gpg".format(name))
+        if key_encrypted not in found or len(found) == 1:
+            logger.error("Could not find the encrypted archive and key of run {} in PDC".format(name))
+            return None
+        if os.path.exists(os.path.join(outdir, name)):
+            logger.error("Run {} already exists in {}, not restoring it".format(name, outdir))
+            return None
+        return found
+
+    def _restore_space(self, found, batch=False):
+        """Return the space in bytes restoring an archived run needs, given the files found
+        in PDC: the retrieved files plus the extracted run, which is at least as big as its
+        archive. The parts of a chunked archive are retrieved and removed one at a time,
+        the next one being retrieved while the current one is extracted, unless all the
+        files are retrieved at once in a 'batch'"""
+        archive = [size for path, (size, _) in found.items() if path.endswith(".gz.gpg")]
+        retrieved = sum(size for size, _ in found.values())
+        parts = sorted(size for path, (size, _) in found.items() if CHUNKS_EXT in path and path.endswith(".gz.gpg"))
+        if parts and not batch:
+            retrieved -= sum(parts[:-2])
+        return retrieved + sum(archive)
+
+    def _pdc_get_run(self, name, outdir, found, fetch=None):
+        """Restore an archived run into 'outdir' in a single pass, piping the decryption,
+        decompression and extraction. The files found in PDC are retrieved with 'fetch'
+        (by default a dsmc call per file). A chunked archive is retrieved part by part,
+        the next part being retrieved while the current one is extracted, and every part
+        is removed once extracted. Returns True if the run was restored"""
+        fetch = fetch or self._pdc_retrieve
+        key_encrypted = os.path.join(os.path.abspath(self.keys_path), "{}.key.gpg".format(name))
+        # retrieved files are kept apart, mirroring the layout in the archive directory
+        run = run_vars(os.path.join(outdir, "{}.restore".format(name), name))
+        key = os.path.join(run.path, run.key)
+        logger.info("Retrieving the encrypted key of run {} from PDC".format(name))
+        if not fetch(key_encrypted, run.path):
+            return False
+        if not self._call_commands(cmd1="gpg --decrypt --batch --yes -o {} {}".format(run.key, run.key_encrypted),
+                                   tmp_files=[run.key], cwd=run.path):
+            logger.error("Decryption of the key of run {} failed".format(name))
+            return False
+        os.chmod(key, 0600)
+        chunked = any(CHUNKS_EXT in path for path in found)
+        tar = sp.Popen(["tar", "-xf", "-", "-C", outdir], stdin=sp.PIPE, stderr=sp.PIPE)
+        pool = ThreadPool(1)
+        success = False
+        try:
+            if chunked:
+                adir = os.path.dirname(os.path.dirname([path for path in found if CHUNKS_EXT in path][0]))
+                src_dir = os.path.join(adir, run.chunks)
+                chunks_dir = os.path.join(run.path, run.chunks)
+                if not fetch(os.path.join(src_dir, run.manifest), chunks_dir):
+                    return False
+                _, parts, _ = self._read_manifest(run)
+                logger.info("Restoring run {} from {} part(s)".format(name, len(parts)))
+                retrieved = pool.apply_async(fetch, (os.path.join(src_dir, parts[0][0]), chunks_dir))
+                for index, (part, _, md5) in enumerate(parts):
+                    if not retrieved.get():
+                        return False
+                    if index + 1 < len(parts):
+                        retrieved = pool.apply_async(fetch, (os.path.join(src_dir, parts[index + 1][0]), chunks_dir))
+                    if self._restore_part(os.path.join(chunks_dir, part), key, tar.stdin) != md5:
+                        logger.error("Part {} of run {} could not be restored or its md5sum did not match".format(part, name))
+                        return False
+                    self._clean_tmp_files([part], cwd=chunks_dir)
+            else:
+                adir = os.path.dirname([path for path in found if path.endswith(run.zip_encrypted)][0])
+                for afile in [run.zip_encrypted, run.zip_md5]:
+                    if os.path.join(adir, afile) in found and not fetch(os.path.join(adir, afile), run.path):
+                        return False
+                logger.info("Restoring run {} from {}".format(name, run.zip_encrypted))
+                md5 = self._restore_part(os.path.join(run.path, run.zip_encrypted), key, tar.stdin, compressed_md5=True)
+                if not md5:
+                    logger.error("Run {} could not be restored".format(name))
+                    return False
+                if not self._check_zip_md5(run, md5):
+                    return False
+            tar.stdin.close()
+            success = self._check_status(["tar", "-xf", "-"], tar.wait(), tar.stderr.read(), False)
+        finally:
+            pool.close()
+            pool.join()
+            if not success:
+                tar.stdin.close()
+                tar.kill()
+                tar.wait()
+            # the decrypted key is never left behind
+            self._clean_tmp_files([key])
+        if success:
+            shutil.rmtree(os.path.dirname(run.abs_path))
+            logger.info("Run {} was successfully restored into {}".format(name, outdir))
+        else:
+            logger.warn("Restoring run {} failed, the retrieved files are kept in {}".format(name, run.path))
+        return success
+
+    @classmethod
+    def pdc_get(cls, run=None, outdir=None, runs_file=None, workers=1):
+        """Retrieve a run, or the runs listed in 'runs_file' (one per line), from PDC and
+        restore them into 'outdir' (by default the current directory), without landing
+        intermediate files on disk. The files of all the runs in 'runs_file' are retrieved
+        with a single dsmc call, ordered by archive date so that files written to tape
+        together are read together, and every run is restored (up to 'workers' at the
+        same time) as soon as its files have been retrieved"""
+        bk = cls()
+        outdir = os.path.abspath(outdir or os.getcwd())
+        if runs_file:
+            with open(runs_file) as fh:
+                names = [line.strip() for line in fh if line.strip() and not line.startswith('#')]
+        else:
+            names = [run]
+        names = misc.return_unique([os.path.basename(name).split('.', 1)[0] for name in names])
+        located = {}
+        for name in names:
+            found = bk._pdc_locate_run(name, outdir)
+            if found:
+                located[name] = found
+        # nothing is retrieved unless there is room for all of it and the extracted runs
+        required = sum(bk._restore_space(found, batch=bool(runs_file)) for found in located.values())
+        available = filesystem.disk_free(outdir)
+        if available < required:
+            logger.error("Restoring {} run(s) needs at least {}GB in {}, but only {}GB are available".format(
+                         len(located), required/1024**3, outdir, available/1024**3))
+            raise SystemExit(1)
+        restored = {}
+        if located and runs_file:
+            files = sorted([(_pdc_date(date), path) for found in located.values() for path, (_, date) in found.items()])
+            retrieval = batch_retrieval(bk.dsmc, [path for _, path in files],
+                                        os.path.join(outdir, "pdc_retrieve.{}".format(os.getpid())))
+            # runs are restored in the order their files are retrieved
+            order = misc.return_unique([name for _, path in files for name in located if path in located[name]])
+            logger.info("Retrieving {} file(s) of {} run(s) from PDC".format(len(files), len(order)))
+            pool = ThreadPool(max(1, min(workers, len(order))))
+            try:
+                results = pool.map(lambda name: bk._pdc_get_run(name, outdir, located[name], fetch=retrieval.fetch), order)
+            finally:
+                pool.close()
+                pool.join()
+                retrieval.wait()
+            restored = dict(zip(order, results))
+        elif located:
+            restored[names[0]] = bk._pdc_get_run(names[0], outdir, located[names[0]])
+        failed = [name for name in names if not restored.get(name)]
+        if len(names) > 1:
+            logger.info("Restored {} of {} run(s) into {}".format(len(names) - len(failed), len(names), outdir))
+        if failed:
+            logger.error("Could not restore run(s) {}".format(", ".join(failed)))
+            raise SystemExit(1)
+
+    @classmethod
+    def space_report(cls, run=None, stream=False):
+        """Report the free space in the archive directories, the space reserved for the
+        runs still being sequenced and the space the runs to encrypt need
+        :returns list: Lines of the report"""
+        bk = cls(run)
+        bk.collect_runs(ext=".tar.gz")
+        gb = lambda size: "{:.1f}GB".format(size / float(1024**3))
+        ongoing = bk._ongoing_runs()
+        reserve = sum(expected - current for _, current, expected, _ in ongoing)
+        lines = ["Reserved for {} run(s) being sequenced: {}".format(len(ongoing), gb(reserve))]
+        for run_dir, current, expected, how in ongoing:
+            lines.append("\t{}\t{} now, {} expected ({})".format(os.path.basename(run_dir), gb(current), gb(expected), how))
+        by_device = {}
+        for path in [adir for adir in bk.archive_dirs if os.path.isdir(adir)] + [r.path for r in bk.runs]:
+            by_device.setdefault(os.stat(path).st_dev, (path, []))
+        for r in bk.runs:
+            by_device[os.stat(r.path).st_dev][1].append(r)
+        for path, runs in sorted(by_device.values()):
+            needed = [(r, bk._required_space(r, stream)) for r in runs]
+            free = filesystem.disk_free(path)
+            total = sum(size for _, size in needed)
+            lines.append("File system of {}: {} free, {} needed to encrypt {} run(s), {} left".format(
+                         path, gb(free), gb(total), len(runs), gb(free - total - reserve)))
+            for r, size in needed:
+                lines.append("\t{}\t{}".format(r.name, gb(size)))
+        return lines
+
+    @classmethod
+    def decrypt_run(cls, run, key, password=None, outdir=None, extract=False):
+        """Decrypt an encrypted run file (or the directory of a run encrypted in chunks)
+        with its encrypted key, into 'outdir' (by default next to the encrypted run)"""
+        bk = cls()
+        run = run_vars(run)
+        if not bk._decrypt_run(run, os.path.abspath(key), password, os.path.abspath(outdir or run.path), extract):
+            raise SystemExit(1)
+
+
+def _pdc_date(date):
+    """Parse the archive date reported by dsmc"""
+    return datetime.datetime.strptime(date, "%m/%d/%Y %H:%M:%S")
+
+
+class batch_retrieval(object):
+    """Retrieve a list of files from PDC with a single dsmc call, so that files stored
+    on the same tape are read in one go, and let each file be picked up as soon as it
+    has been retrieved"""
+
+    def __init__(self, dsmc, files, staging_dir):
+        """
+        :param str dsmc: Command used to call dsmc
+        :param list files: Absolute paths of the archived files, in the order to retrieve them
+        :param str staging_dir: Directory to retrieve the files into
+        """
+        self.staging_dir = staging_dir
+        self.landed = dict((afile, threading.Event()) for afile in files)
+        self.retrieved = {}
+        filesystem.create_folder(staging_dir)
+        filelist = os.path.join(staging_dir, "filelist.txt")
+        with open(filelist, 'w') as fh:
+            fh.write("".join("{}\n".format(afile) for afile in files))
+        self.proc = sp.Popen(dsmc.split() + ["retrieve", "-replace=yes", "-filelist={}".format(filelist),
+                                             os.path.join(staging_dir, '')], stdout=sp.PIPE, stderr=sp.STDOUT)
+        self.thread = threading.Thread(target=self._follow)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _staged(self, afile):
+        return os.path.join(self.staging_dir, os.path.basename(afile))
+
+    def _follow(self):
+        """Follow the output of dsmc, which reports every file once it is retrieved"""
+        for line in iter(self.proc.stdout.readline, ''):
+            match = re.match(PDC_RETRIEVE_RE, line)
+            if match and match.group(1) in self.landed:
+                self.retrieved[match.group(1)] = True
+                self.landed[match.group(1)].set()
+        status = self.proc.wait()
+        if status not in [0, 4, 8]:
+            logger.error("Retrieving files from PDC failed with the exit status {}".format(status))
+        # files dsmc did not report are only taken if it did not fail
+        for afile, event in self.landed.items():
+            if not event.is_set():
+                self.retrieved[afile] = status == 0 and os.path.exists(self._staged(afile))
+                event.set()
+
+    def fetch(self, afile, dst_dir):
+        """Wait until a file is retrieved and move it into a directory, returns True if it was retrieved"""
+        while not self.landed[afile].wait(60):
+            pass
+        if not self.retrieved[afile]:
+            logger.error("File {} could not be retrieved from PDC".format(afile))
+            return False
+        filesystem.create_folder(dst_dir)
+        shutil.move(self._staged(afile), os.path.join(dst_dir, os.path.basename(afile)))
+        return True
 
+    def wait(self):
+        """Wait for dsmc to finish and remove the staging directory"""
+        self.thread.join()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        return self.proc.returncode
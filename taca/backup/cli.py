@@ -13,30 +13,51 @@ def backup(ctx):
 @backup.command()
 @click.option('-r', '--run', type=click.Path(exists=True), help="A run (directory or a zipped archive) to be encrypted")
 @click.option('-f', '--force', is_flag=True, help="Ignore the checks and just try encryption. USE IT WITH CAUTION.")
+@click.option('-s', '--stream', is_flag=True, help="Compress and encrypt in a single pass, without an intermediate zipped file")
+@click.option('-w', '--workers', type=click.IntRange(min=1), help="Maximum number of runs to encrypt at the same time")
+@click.option('-c', '--chunk-size', type=click.IntRange(min=1), help="Encrypt the runs in resumable parts of this many GB")
 @click.pass_context
-def encrypt(ctx, run, force):
-    bkut.encrypt_runs(run, force)
+def encrypt(ctx, run, force, stream, workers, chunk_size):
+    bkut.encrypt_runs(run, force, stream=stream, workers=workers, chunk_size=chunk_size)
+
+@backup.command()
+@click.option('-r', '--run', type=click.Path(exists=True), help="A run (directory or a zipped archive) to be encrypted")
+@click.option('-s', '--stream', is_flag=True, help="Estimate for encrypting in a single pass, without an intermediate zipped file")
+@click.pass_context
+def space(ctx, run, stream):
+    """ Report the disk space available and needed for encryption """
+    for line in bkut.space_report(run, stream=stream):
+        click.echo(line)
 
 @backup.command()
 @click.option('-r', '--run', type=click.Path(exists=True), help="A run name (without extension) to be sent to PDC")
+@click.option('-s', '--sessions', type=click.IntRange(min=1), help="Maximum number of runs to send to PDC at the same time")
 @click.pass_context
-def put_data(ctx, run):
-    bkut.pdc_put(run)
+def put_data(ctx, run, sessions):
+    bkut.pdc_put(run, sessions=sessions)
 
 @backup.command()
-@click.option('-r', '--run', required=True, help="A run name (without extension) to download from PDC")
+@click.option('-r', '--run', help="A run name (without extension) to download from PDC")
+@click.option('-f', '--runs-file', type=click.Path(exists=True, dir_okay=False),
+              help="A file with the names of the runs to download from PDC, one per line")
 @click.option('-o', '--outdir', type=click.Path(exists=True, file_okay=False, writable=True),
-              help="Optional directory name to save the downloaded file. Directory should exist")
+              help="Optional directory to restore the run into, by default the current one. Directory should exist")
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1, help="Maximum number of runs to restore at the same time")
 @click.pass_context
-def get_data(ctx, run, outdir):
-    ## W I P ##
-    raise NotImplementedError
+def get_data(ctx, run, runs_file, outdir, workers):
+    if bool(run) == bool(runs_file):
+        raise SystemExit("Give either a run or a file with runs")
+    bkut.pdc_get(run, outdir=outdir, runs_file=runs_file, workers=workers)
 
 @backup.command()
-@click.option('-r', '--run', required=True, type=click.Path(exists=True, dir_okay=False), help="A encripted run file")
-@click.option('-k', '--key', required=True, help="Key file to be used for decryption")
-@click.option('-p', '--password', help="To pass decryption passphrase via command line")
+@click.option('-r', '--run', required=True, type=click.Path(exists=True),
+              help="A encripted run file, or the directory of a run encrypted in chunks")
+@click.option('-k', '--key', required=True, type=click.Path(exists=True, dir_okay=False),
+              help="Key file to be used for decryption, decrypted first with gpg if it ends with .gpg")
+@click.option('-p', '--password', help="To pass the passphrase of the gpg private key via command line")
+@click.option('-o', '--outdir', type=click.Path(exists=True, file_okay=False, writable=True),
+              help="Optional directory to decrypt the run into, by default next to the encrypted run")
+@click.option('-x', '--extract', is_flag=True, help="Extract the run instead of writing a tar file")
 @click.pass_context
-def decrypt(ctx, run, key, password):
-    ## W I P ##
-    raise NotImplementedError
+def decrypt(ctx, run, key, password, outdir, extract):
+    bkut.decrypt_run(run, key, password=password, outdir=outdir, extract=extract)
@@ -2,7 +2,6 @@ import os
 from datetime import datetime
 
 from flowcell_parser.classes import SampleSheetParser
-from taca.utils.filesystem import chdir
 from taca.illumina.Runs import Run
 from taca.utils import misc
 
@@ -11,7 +10,7 @@ logger = logging.getLogger(__name__)
 
 class NextSeq_Run(Run):
 
-    def __init__(self,  path_to_run, configuration):
+    def __init__(self,  path_to_run, configuration, run_type=None):
         # Constructor, it returns a NextSeq object only 
         # if the NextSeq run belongs to NGI or ST facility, i.e., contains
         # Application or Production in the Description
@@ -20,7 +19,11 @@ class NextSeq_Run(Run):
         # and placed in the run root folder.
         self.ssname = os.path.join(self.run_dir, "SampleSheet.csv")
         self.sequencer_type = "NextSeq"
-        self._set_run_type()
+        # The run type might be already known (i.e. cached), skip parsing the Sample Sheet then
+        if run_type:
+            self.run_type = run_type
+        else:
+            self._set_run_type()
 
     def _set_run_type(self):
         if not os.path.exists(self.ssname):
@@ -46,32 +49,39 @@ class NextSeq_Run(Run):
     def check_run_status(self):
         return
 
-    def demultiplex_run(self): 
+    def demultiplex_run(self, threads=None, exit_status_file=None):
         """ Demultiplex a NextSeq run:
             - define if necessary the bcl2fastq commands (if indexes are not of size 8, i.e. neoprep)
             - run bcl2fastq conversion
+            :param dict threads: bcl2fastq thread options (i.e. processing-threads) and their
+                                 values, used unless they are in the configuration file
+            :param str exit_status_file: File where to write the exit status of bcl2fastq
+            :returns subprocess.Popen: The handle of the bcl2fastq process
         """
         # Samplesheet need to be positioned in the FC directory with name SampleSheet.csv (Illumina default)
-        # Make the demux call
-        with chdir(self.run_dir):
-            cl = [self.CONFIG.get('bcl2fastq')['bin']]
-            if self.CONFIG.get('bcl2fastq').has_key('options'):
-                cl_options = self.CONFIG['bcl2fastq']['options']
-                # Append all options that appear in the configuration file to the main command.
-                for option in cl_options:
-                    if isinstance(option, dict):
-                        opt, val = option.items()[0]
-                        cl.extend(['--{}'.format(opt), str(val)])
-                    else:
-                        cl.append('--{}'.format(option))
-            logger.info(("BCL to FASTQ conversion and demultiplexing started for "
-                 " run {} on {}".format(os.path.basename(self.id), datetime.now())))
-            try:
-                misc.call_external_command_detached(cl, with_log_files=True)
-            except:
-                logger.error("There was an error running bcl2fasq")
-                raise
-        return True
+        # Make the demux call. Run it from the run folder without changing the working
+        # directory of TACA, so that several runs can be started concurrently
+        cl = [self.CONFIG.get('bcl2fastq')['bin']]
+        if self.CONFIG.get('bcl2fastq').has_key('options'):
+            cl_options = self.CONFIG['bcl2fastq']['options']
+            # Append all options that appear in the configuration file to the main command.
+            for option in cl_options:
+                if isinstance(option, dict):
+                    opt, val = option.items()[0]
+                    cl.extend(['--{}'.format(opt), str(val)])
+                else:
+                    cl.append('--{}'.format(option))
+        for opt, val in sorted((threads or {}).items()):
+            if '--{}'.format(opt) not in cl:
+                cl.extend(['--{}'.format(opt), str(val)])
+        logger.info(("BCL to FASTQ conversion and demultiplexing started for "
+             " run {} on {}".format(os.path.basename(self.id), datetime.now())))
+        try:
+            return misc.call_external_command_detached(cl, with_log_files=True, cwd=self.run_dir,
+                                                       exit_status_file=exit_status_file)
+        except:
+            logger.error("There was an error running bcl2fasq")
+            raise
         
 
 
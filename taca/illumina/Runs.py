@@ -1,15 +1,171 @@
+import fnmatch
+import heapq
 import os
 import re
-import csv
 import logging
-import subprocess
 import shutil
+import sqlite3
+import subprocess
+import tempfile
+import time
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
-from taca.utils import misc
+from taca.utils import bandwidth, filesystem, rsync, ssh
+from taca.utils.ledger import TransferLedger, TransferMetrics
 
 logger = logging.getLogger(__name__)
 
+# List of the files sent by transfer_run, kept in the run folder
+TRANSFER_MANIFEST = 'transfer_manifest.txt'
+
+# Suffix of the demultiplexing folders of failed attempts, followed by the attempt number
+FAILED_DEMUX_SUFFIX = '.failed.'
+
+# Lane of a FASTQ file, i.e. Sample_S1_L001_R1_001.fastq.gz
+LANE_RE = re.compile(r'_L(\d{3})_')
+
+def _rsync_pattern(pattern):
+    """ Translate an rsync filter pattern into a regular expression
+        :param str pattern: The pattern, as given to --include or --exclude
+        :returns tuple: The compiled expression, matched against paths relative to the
+                        transfer root, and whether the pattern only applies to directories
+    """
+    dirs_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # Anchored patterns match from the transfer root, the others any trailing part of the path
+    regex = '^' if pattern.startswith('/') else '(^|/)'
+    pattern = pattern.lstrip('/')
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        c = pattern[i]
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end]
+            regex += '[{}]'.format('^' + chars[1:] if chars.startswith('!') else chars)
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return re.compile(regex + '$'), dirs_only
+
+def _rsync_included(rules, path, is_dir):
+    """ Check a path against a list of rsync filter rules, the first matching rule wins
+        :param list rules: (included, regex, dirs_only) tuples
+        :param str path: Path relative to the transfer root
+        :param bool is_dir: Whether the path is a directory
+    """
+    for included, regex, dirs_only in rules:
+        if (is_dir or not dirs_only) and regex.search(path):
+            return included
+    return True
+
+def _shard_files(files, shards, shard_by='size', demux_dir='Demultiplexing'):
+    """ Split the files to transfer in balanced shards
+        :param list files: (path, size) tuples, paths relative to the transfer root
+        :param int shards: Maximum number of shards
+        :param str shard_by: Keep together the files of the same 'lane' or 'project'
+                             (folder in the demultiplexing folder), or balance the
+                             files individually ('size')
+        :param str demux_dir: Name of the demultiplexing folder
+        :returns list: Sorted lists of paths, one per non empty shard
+    """
+    groups = {}
+    for path, size in files:
+        if shard_by == 'lane':
+            match = LANE_RE.search(os.path.basename(path))
+            key = match.group(1) if match else ''
+        elif shard_by == 'project':
+            parts = path.split(os.sep)
+            key = parts[2] if len(parts) > 3 and parts[1] == demux_dir else ''
+        else:
+            key = path
+        group = groups.setdefault(key, [0, []])
+        group[0] += size
+        group[1].append(path)
+    # Biggest groups first, each one to the shard with the least data so far
+    heap = [(0, i, []) for i in range(shards)]
+    for size, paths in sorted(groups.values(), key=lambda group: group[0], reverse=True):
+        total, i, shard = heapq.heappop(heap)
+        shard.extend(paths)
+        heapq.heappush(heap, (total + size, i, shard))
+    return [sorted(shard) for _, _, shard in sorted(heap, key=lambda s: s[1]) if shard]
+
+def _transfer_metrics(shard_metrics, elapsed):
+    """ Combine the metrics of the rsync processes of a transfer
+        :param list shard_metrics: Metrics returned by rsync.call_rsync, one per process
+        :param float elapsed: Seconds the whole transfer took
+        :returns dict: Metrics of the transfer, see ledger.TransferMetrics
+    """
+    metrics = {'shards': len(shard_metrics), 'elapsed': elapsed}
+    for key in ['files', 'bytes_sent', 'total_size']:
+        metrics[key] = sum(m.get(key, 0) for m in shard_metrics)
+    # The file lists are built concurrently
+    metrics['file_list_time'] = max([m.get('file_list_time', 0) for m in shard_metrics] or [0])
+    metrics['mb_per_s'] = metrics['bytes_sent'] / elapsed / 1e6 if elapsed else None
+    # Same definition as the speedup reported by rsync
+    traffic = sum(m.get('bytes_sent', 0) + m.get('bytes_received', 0) for m in shard_metrics)
+    metrics['speedup'] = float(metrics['total_size']) / traffic if traffic else None
+    return metrics
+
+class RunStatusSnapshot(object):
+    """
+    Status markers of a run, gathered with a single listing of the run folder
+    (plus one stat for DemultiplexingStats.xml if demultiplexing started) so
+    that they can be reused instead of checking every file again
+    """
+    def __init__(self, run_dir, demux_dir='Demultiplexing'):
+        self.run_dir = run_dir
+        self.demux_dir = demux_dir
+        names = set(entry.name for entry in filesystem.scandir(run_dir))
+        self.sequencing_done = 'RTAComplete.txt' in names
+        self.demux_started = demux_dir in names
+        self.transferring = 'transferring' in names
+        self.demux_done = self.demux_started and os.path.exists(os.path.join(run_dir, demux_dir,
+                                                                             'Stats',
+                                                                             'DemultiplexingStats.xml'))
+
+    @property
+    def status(self):
+        """ Status of the run, as returned by Run.get_run_status
+        """
+        if self.sequencing_done and self.demux_done:
+            return 'COMPLETED' # run is done, transfer might be ongoing.
+        elif self.sequencing_done and self.demux_started and not self.demux_done:
+            return 'IN_PROGRESS'
+        elif self.sequencing_done and not self.demux_started:
+            return 'TO_START'
+        elif not self.sequencing_done:
+            return 'SEQUENCING'
+        else:
+            raise RuntimeError('Unexpected status in get_run_status')
+
+    @classmethod
+    def for_data_dir(cls, data_dir, demux_dir='Demultiplexing', pattern='[1-9]*_*_*_*'):
+        """ Snapshot all the runs in a data directory at once
+            :param str data_dir: Directory containing run folders
+            :param str demux_dir: Name of the demultiplexing folder inside the runs
+            :param str pattern: Shell pattern matching the run folder names
+            :returns dict: Snapshots by run folder path
+        """
+        snapshots = {}
+        for entry in filesystem.scandir(data_dir):
+            if fnmatch.fnmatch(entry.name, pattern) and entry.is_dir():
+                try:
+                    snapshots[entry.path] = cls(entry.path, demux_dir)
+                except OSError:
+                    # The run was moved away in the meantime
+                    continue
+        return snapshots
+
 class Run(object):
     """ 
     Defines an Illumina run
@@ -43,9 +199,23 @@ class Run(object):
         # This flag tells TACA to move demultiplexed files to the analysis server
         self.transfer_to_analysis_server = True
         
-    def demultiplex_run(self):
+    def demultiplex_run(self, threads=None, exit_status_file=None):
         raise NotImplementedError("Please Implement this method")
 
+    def reset_demultiplexing(self):
+        """ Move the demultiplexing folder of a failed demultiplexing aside, so that
+            it can be started again. It is kept (and not transferred) for inspection.
+            :returns str: Path the folder was moved to
+        """
+        demux_dir = os.path.join(self.run_dir, self._get_demux_folder())
+        attempt = 1
+        while os.path.exists('{}{}{}'.format(demux_dir, FAILED_DEMUX_SUFFIX, attempt)):
+            attempt += 1
+        failed_dir = '{}{}{}'.format(demux_dir, FAILED_DEMUX_SUFFIX, attempt)
+        os.rename(demux_dir, failed_dir)
+        logger.info('Moved {} to {}'.format(demux_dir, failed_dir))
+        return failed_dir
+
     def check_run_status(self):
         raise NotImplementedError("Please Implement this method")
 
@@ -82,45 +252,164 @@ class Run(object):
     def _is_sequencing_done(self):
         return os.path.exists(os.path.join(self.run_dir, 'RTAComplete.txt'))
 
-    def get_run_status(self):
+    def get_status_snapshot(self):
+        """ Gather all the status markers of the run at once
+            :rtype: RunStatusSnapshot
+        """
+        return RunStatusSnapshot(self.run_dir, self._get_demux_folder())
+
+    def get_run_status(self, snapshot=None):
         """ Return the status of the run
+            :param RunStatusSnapshot snapshot: Status markers to use instead of checking them again
         """
-        demux_started = self._is_demultiplexing_started() # True if demux is ongoing
-        demux_done = self._is_demultiplexing_done() # True if demux is done
-        sequencing_done = self._is_sequencing_done() # True if sequencing is done
-        if sequencing_done and demux_done:
-            return 'COMPLETED' # run is done, transfer might be ongoing.
-        elif sequencing_done and demux_started and not demux_done:
-            return 'IN_PROGRESS'
-        elif sequencing_done and not demux_started:
-            return 'TO_START'
-        elif not sequencing_done:
-            return 'SEQUENCING'
-        else:
-            raise RuntimeError('Unexpected status in get_run_status')
+        return (snapshot or self.get_status_snapshot()).status
 
-    def transfer_run(self, t_file):
-        """ Transfer a run to the analysis server. Will add group R/W permissions to
-            the run directory in the destination server so that the run can be processed
-            by any user/account in that group (i.e a functional account...). 
-            :param str t_file: File where to put the transfer information
+    def _transfer_rules(self):
+        """ The rsync filter rules used to select what is transferred, in order
+            :returns list: (included, pattern) tuples
+        """
+        sync = self.CONFIG['analysis_server']['sync']
+        rules = [(False, '/{}/{}'.format(self.id, TRANSFER_MANIFEST))]
+        # Folders that cannot contain anything to transfer (i.e. Data/Intensities) are not even walked
+        rules.extend((False, '{}/'.format(skip_dir.rstrip('/'))) for skip_dir in sync.get('skip_dirs', []))
+        # Demultiplexing attempts that failed, see reset_demultiplexing
+        rules.append((False, '/{}/{}{}*/'.format(self.id, self._get_demux_folder(), FAILED_DEMUX_SUFFIX)))
+        # This horrible thing here avoids data dup when we use multiple indexes in a lane/FC
+        rules.extend([(False, 'Demultiplexing_*/*_*'), (True, '*/')])
+        rules.extend((True, to_include) for to_include in sync['include'])
+        rules.append((False, '*'))
+        return rules
+
+    def _transfer_files(self):
+        """ List the files that transfer_run sends, applying the same filter rules as rsync
+            would. Only the matching files are stat'ed, the folder listings are enough for the rest.
+            :returns list: (path, size) tuples, paths relative to the folder containing the run
+        """
+        rules = [(included,) + _rsync_pattern(pattern) for included, pattern in self._transfer_rules()]
+        root = os.path.dirname(self.run_dir)
+        files = []
+        pending = [self.id]
+        while pending:
+            rel_dir = pending.pop()
+            for entry in filesystem.scandir(os.path.join(root, rel_dir)):
+                path = os.path.join(rel_dir, entry.name)
+                # Symlinks are followed, rsync is called with -L
+                if entry.is_dir():
+                    if _rsync_included(rules, path, True):
+                        pending.append(path)
+                elif _rsync_included(rules, path, False):
+                    files.append((path, os.stat(entry.path).st_size))
+        return sorted(files)
+
+    def _transfer_remote(self):
+        """ The rsync destination, a local directory if no analysis server host is configured
+        """
+        r_host = self.CONFIG['analysis_server']['host']
+        r_dir = self.CONFIG['analysis_server']['sync']['data_archive']
+        if not r_host:
+            return r_dir
+        r_user = self.CONFIG['analysis_server']['user']
+        return "{}@{}:{}".format(r_user, r_host, r_dir) if r_user else "{}:{}".format(r_host, r_dir)
+
+    def _rsync_command(self, bwlimit=None):
+        """ The rsync command line common to all the transfers, without sources and destination
+            :param float bwlimit: Bandwidth limit in MB/s
         """
         # TODO: check the run type and build the correct rsync command
         # The option -a implies -o and -g which is not the desired behaviour
         command_line = ['rsync', '-Lav', '--no-o', '--no-g']
         # Add R/W permissions to the group
         command_line.append('--chmod=g+rw')
-        # This horrible thing here avoids data dup when we use multiple indexes in a lane/FC
-        command_line.append("--exclude=Demultiplexing_*/*_*") 
-        command_line.append("--include=*/")
-        for to_include in self.CONFIG['analysis_server']['sync']['include']:
-            command_line.append("--include={}".format(to_include))
-        command_line.extend(["--exclude=*", "--prune-empty-dirs"])
-        r_user = self.CONFIG['analysis_server']['user']
-        r_host = self.CONFIG['analysis_server']['host']
-        r_dir = self.CONFIG['analysis_server']['sync']['data_archive']
-        remote = "{}@{}:{}".format(r_user, r_host, r_dir)
-        command_line.extend([self.run_dir, remote])
+        # Parsed by rsync.call_rsync
+        command_line.extend(['--stats', '--info=progress2'])
+        # Reuse the connection to the analysis server instead of opening a new one every time
+        master = ssh.get_master(self.CONFIG['analysis_server']['host'],
+                                user=self.CONFIG['analysis_server']['user'],
+                                config=self.CONFIG['analysis_server'].get('ssh'))
+        if master:
+            command_line.extend(['-e', master.rsync_shell()])
+        if bandwidth.rsync_option(bwlimit):
+            command_line.append(bandwidth.rsync_option(bwlimit))
+        return command_line
+
+    def _transfer_sharded(self, shards, remote, bwlimit=None):
+        """ Transfer the run with one rsync process per shard of the files to send
+            :param list shards: Lists of paths relative to the folder containing the run
+            :param str remote: rsync destination
+            :param float bwlimit: Bandwidth limit in MB/s, shared by all the processes
+            :returns list: The metrics of each rsync process
+        """
+        list_dir = tempfile.mkdtemp(prefix='taca_{}_'.format(self.id))
+        commands = []
+        try:
+            for i, shard in enumerate(shards, 1):
+                files_from = os.path.join(list_dir, 'shard{}.txt'.format(i))
+                with open(files_from, 'w') as fh:
+                    fh.write(''.join('{}\n'.format(path) for path in shard))
+                commands.append((i, self._rsync_command(bwlimit / len(shards) if bwlimit else None) + ['--files-from={}'.format(files_from),
+                                                             os.path.dirname(self.run_dir), remote]))
+
+            def _transfer_shard(command):
+                i, command_line = command
+                try:
+                    return rsync.call_rsync(command_line, prefix="shard{}".format(i), log_dir=self.run_dir,
+                                            label="run {} (shard {})".format(self.id, i))
+                except subprocess.CalledProcessError as e:
+                    logger.error("Shard {} of {} of run {} failed".format(i, len(commands), self.id))
+                    return e
+
+            pool = ThreadPool(len(commands))
+            try:
+                results = pool.map(_transfer_shard, commands)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(list_dir, ignore_errors=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            raise errors[0]
+        return results
+
+    def transfer_run(self, t_file):
+        """ Transfer a run to the analysis server. Will add group R/W permissions to
+            the run directory in the destination server so that the run can be processed
+            by any user/account in that group (i.e a functional account...). 
+            The files to send are listed by TACA and handed to rsync with --files-from,
+            the list is kept in the run folder (see TRANSFER_MANIFEST).
+            If analysis_server.sync.shards is more than 1, the files are split in that
+            many shards (see analysis_server.sync.shard_by) sent by concurrent rsync processes,
+            and the run is only recorded as transferred when all of them succeed.
+            The throughput of the transfer is recorded in transfer_metrics.db next to t_file.
+            The bandwidth is limited according to analysis_server.sync.bandwidth,
+            see bandwidth.BandwidthController (the adapted limits are kept in bandwidth.json next to t_file).
+            The latency of the storage is measured in analysis_server.sync.bandwidth.probe_dir,
+            by default in the data directory holding the run, never inside the run folder being sent.
+            :param str t_file: File where to put the transfer information
+        """
+        sync = self.CONFIG['analysis_server']['sync']
+        remote = self._transfer_remote()
+        listing_start = time.time()
+        files = self._transfer_files()
+        listing_time = time.time() - listing_start
+        manifest = os.path.join(self.run_dir, TRANSFER_MANIFEST)
+        with open(manifest + '.partial', 'w') as fh:
+            fh.write(''.join('{}\n'.format(path) for path, _ in files))
+        os.rename(manifest + '.partial', manifest)
+        logger.info('{} files to transfer for run {}'.format(len(files), self.id))
+        shards = []
+        if sync.get('shards', 1) > 1:
+            shards = _shard_files(files, sync['shards'],
+                                  shard_by=sync.get('shard_by', 'size'), demux_dir=self._get_demux_folder())
+        controller = bandwidth.BandwidthController(sync.get('bandwidth'),
+                                                   os.path.join(os.path.dirname(t_file), 'bandwidth.json'))
+        probe_dir = (sync.get('bandwidth') or {}).get('probe_dir') or os.path.dirname(self.run_dir)
+        bwlimit = controller.limit(probe_dir=probe_dir)
+        if bwlimit:
+            logger.info('Limiting the transfer of run {} to {:.0f} MB/s'.format(self.id, bwlimit))
+        # --files-from implies -R, the paths keep the run folder as first component
+        command_line = self._rsync_command(bwlimit)
+        command_line.extend(['--files-from={}'.format(manifest), os.path.dirname(self.run_dir), remote])
 
         # Create temp file indicating that the run is being transferred
         try:
@@ -129,22 +418,38 @@ class Run(object):
             logger.error("Cannot create a file in {}. "
                          "Check the run name, and the permissions.".format(self.id))
             raise e
-        started = ("Started transfer of run {} on {}".format(self.id, datetime.now()))
+        started_at = datetime.now()
+        started = ("Started transfer of run {} on {}".format(self.id, started_at))
         logger.info(started)
         # In this particular case we want to capture the exception because we want
         # to delete the transfer file
         try:
-            misc.call_external_command(command_line, with_log_files=True, 
-                                       prefix="", log_dir=self.run_dir)
+            if len(shards) > 1:
+                logger.info('Transferring run {} in {} shards'.format(self.id, len(shards)))
+                shard_metrics = self._transfer_sharded(shards, remote, bwlimit)
+            else:
+                shard_metrics = [rsync.call_rsync(command_line, log_dir=self.run_dir, label="run {}".format(self.id))]
         except subprocess.CalledProcessError as exception:
             os.remove(os.path.join(self.run_dir, 'transferring'))
             raise exception
+        metrics = _transfer_metrics(shard_metrics, (datetime.now() - started_at).total_seconds())
+        metrics['listing_time'] = listing_time
+        logger.info('Transferred run {}: {} files, {:.2f} GB sent in {:.0f} seconds ({:.1f} MB/s)'.format(
+                    self.id, metrics['files'], metrics['bytes_sent'] / 1e9, metrics['elapsed'],
+                    metrics['mb_per_s'] or 0))
 
         logger.info('Adding run {} to {}'.format(self.id, t_file))
-        with open(t_file, 'a') as tranfer_file:
-            tsv_writer = csv.writer(tranfer_file, delimiter='\t')
-            tsv_writer.writerow([self.id, str(datetime.now())])
+        TransferLedger(t_file).add(self.id)
         os.remove(os.path.join(self.run_dir, 'transferring'))
+        try:
+            controller.record(metrics['mb_per_s'])
+        except Exception as e:
+            logger.warning('Could not record the throughput of the transfer of run {}: {}'.format(self.id, e))
+        try:
+            TransferMetrics(os.path.join(os.path.dirname(t_file), 'transfer_metrics.db')).add(
+                self.id, metrics, started=started_at)
+        except sqlite3.Error as e:
+            logger.warning('Could not record the metrics of the transfer of run {}: {}'.format(self.id, e))
         
     def archive_run(self, destination):
         """ Move run to the archive folder
@@ -152,25 +457,22 @@ class Run(object):
         """
         if destination and os.path.isdir(destination):
             logger.info('archiving run {}'.format(self.id))
-            shutil.move(self.run_dir, os.path.join(destination, self.id))
+            # Just a rename on the same file system, a parallel copy otherwise
+            filesystem.move_tree(self.run_dir, os.path.join(destination, self.id))
         else:
             logger.warning("Cannot move run to archive, destination does not exist")
 
-    def is_transferred(self, transfer_file):
+    def is_transferred(self, transfer_file, snapshot=None):
         """ Checks wether a run has been transferred to the analysis server or not.
             Returns true in the case in which the tranfer is ongoing.
-            :param str run: Run directory
+            The lookup is done in the indexed ledger kept next to the transfer file.
             :param str transfer_file: Path to file with information about transferred runs
+            :param RunStatusSnapshot snapshot: Status markers to use instead of checking them again
         """
-        try:
-            with open(transfer_file, 'r') as file_handle:
-                t_f = csv.reader(file_handle, delimiter='\t')
-                for row in t_f:
-                    # Rows have two columns: run and transfer date
-                    if row[0] == os.path.basename(self.id):
-                        return True
-            if os.path.exists(os.path.join(self.run_dir, 'transferring')):
-                return True
-            return False
-        except IOError:
+        if not os.path.exists(transfer_file):
             return False
+        if TransferLedger(transfer_file).is_transferred(os.path.basename(self.id)):
+            return True
+        if snapshot:
+            return snapshot.transferring
+        return os.path.exists(os.path.join(self.run_dir, 'transferring'))
@@ -27,3 +27,20 @@ def cleanup(ctx, days, hours, site, dry_run):
         st.cleanup_nas(seconds)
     if site == 'processing-server':
         st.cleanup_processing(seconds)
+
+@storage.command()
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+@click.option('-a', '--algorithm', type=click.Choice(['md5', 'sha1', 'sha256']), multiple=True,
+              default=['md5'], help="Checksum algorithm, can be given several times")
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=4, help="Number of files to hash at the same time")
+@click.option('--invalidate', is_flag=True, help="Forget the cached checksums of the directory and hash everything")
+@click.option('--verify-cache', type=click.IntRange(min=1),
+              help="Only audit the cache, hashing again this many random cached files")
+@click.pass_context
+def checksums(ctx, path, algorithm, workers, invalidate, verify_cache):
+    """ Write md5sum/sha256sum style manifests for all files in a directory """
+    if verify_cache:
+        if not st.verify_checksum_cache(path, verify_cache):
+            raise SystemExit("Some cached checksums do not match the files")
+    else:
+        st.write_checksums(path, list(algorithm), workers=workers, invalidate=invalidate)
@@ -4,16 +4,29 @@ Storage methods and utilities
 import logging
 import os
 import re
-import shutil
 import time
 from taca.utils.config import CONFIG
-from taca.utils import filesystem
+from taca.utils import filesystem, misc
+from taca.utils.checksums import ChecksumCache
 
 logger = logging.getLogger(__name__)
 
 # This is used by many of the functions in this module
 finished_run_indicator = CONFIG.get('storage', {}).get('finished_run_indicator', 'RTAComplete.txt')
 
+def _move_to_nosync(data_dir, run):
+    """
+    Move a run into the nosync directory with filesystem.move_tree, which is just a
+    rename unless nosync is on another file system.
+    :param str data_dir: Data directory the run is in
+    :param str run: Name of the run
+    """
+    logger.info('Moving run {} to nosync directory'.format(run))
+    start = time.time()
+    workers = CONFIG.get('storage', {}).get('move_workers', 8)
+    if not filesystem.move_tree(os.path.join(data_dir, run), os.path.join(data_dir, 'nosync', run), workers=workers):
+        logger.info('nosync is on another file system, run {} was copied in {:.0f}s'.format(run, time.time() - start))
+
 def cleanup_nas(seconds):
     """
     Will move the finished runs in NASes to nosync directory.
@@ -29,16 +42,37 @@ def cleanup_nas(seconds):
                 rta_file = os.path.join(run, finished_run_indicator)
                 if os.path.exists(rta_file):
                     if check_demux:
-                        logger.info('Moving run {} to nosync directory'.format(os.path.basename(run)))
-                        shutil.move(run, 'nosync')
+                        _move_to_nosync(data_dir, run)
                     else:
                         if os.stat(rta_file).st_mtime < time.time() - seconds:
-                            logger.info('Moving run {} to nosync directory'.format(os.path.basename(run)))
-                            shutil.move(run, 'nosync')
+                            _move_to_nosync(data_dir, run)
                         else:
                             logger.info('{} file exists but is not older than given time, skipping run {}'
                                         .format(finished_run_indicator, run))
 
+def _remove_run(path, trash_dir):
+    """
+    Move a run (or anything else) into the trash and remove it from there with
+    filesystem.remove_tree, using storage.delete_workers threads and removing at
+    most storage.delete_rate files per second if given.
+    :param str path: Path to the run
+    :param str trash_dir: Trash directory on the same file system
+    """
+    workers = CONFIG.get('storage', {}).get('delete_workers', 8)
+    max_rate = CONFIG.get('storage', {}).get('delete_rate')
+    start = time.time()
+    if os.path.dirname(os.path.abspath(path)) != os.path.abspath(trash_dir):
+        path = filesystem.move_to_trash(path, trash_dir)
+    if os.path.isdir(path) and not os.path.islink(path):
+        files, size = filesystem.remove_tree(path, workers=workers, max_rate=max_rate)
+    else:
+        files, size = 1, os.lstat(path).st_size
+        os.unlink(path)
+    elapsed = max(time.time() - start, 0.001)
+    logger.info('Removed {} files ({:.1f}GB) of {} in {:.0f}s, {:.0f} files/s and {:.1f}MB/s'.format(
+                files, size / float(1024**3), os.path.basename(path), elapsed, files / elapsed,
+                size / float(1024**2) / elapsed))
+
 def cleanup_processing(seconds):
     """
     Cleanup runs in processing server.
@@ -49,14 +83,21 @@ def cleanup_processing(seconds):
         dirs = CONFIG.get('storage').get('archive_dirs')
         dirs = dirs if isinstance(dirs, list) else [dirs]
         for archive_dir in dirs:
+            # Runs are renamed into the trash first, so they are gone at once for
+            # everybody else; finish what an interrupted cleanup left there
+            trash_dir = os.path.join(archive_dir, filesystem.TRASH_DIR)
+            if os.path.isdir(trash_dir):
+                for item in os.listdir(trash_dir):
+                    logger.info('Removing {} left in {}'.format(item, trash_dir))
+                    _remove_run(os.path.join(trash_dir, item), trash_dir)
             logger.info('Removing old runs in {}'.format(archive_dir))
             with filesystem.chdir(archive_dir):
                 for run in [r for r in os.listdir(archive_dir) if re.match(filesystem.RUN_RE, r)]:
                     rta_file = os.path.join(run, finished_run_indicator)
                     if os.path.exists(rta_file):
                         if os.stat(rta_file).st_mtime < time.time() - seconds:
-                            logger.info('Removing run {} to nosync directory'.format(os.path.basename(run)))
-                            shutil.rmtree(run)
+                            logger.info('Removing run {}'.format(os.path.basename(run)))
+                            _remove_run(os.path.join(archive_dir, run), trash_dir)
                         else:
                             logger.info('{} file exists but is not older than given time, skipping run {}'.format(
                                         finished_run_indicator, run))
@@ -64,3 +105,40 @@ def cleanup_processing(seconds):
         logger.error("Could not find transfer.tsv file, so I cannot decide if I should "
                      "archive any run or not.")
 
+def get_checksum_cache(path):
+    """
+    Return the checksum cache to use for a directory, the central one in
+    storage.checksum_cache if configured or the one kept in the directory.
+    :param str path: Directory with the files to checksum
+    """
+    cache_file = CONFIG.get('storage', {}).get('checksum_cache')
+    return ChecksumCache(cache_file) if cache_file else ChecksumCache.for_dir(path)
+
+def write_checksums(path, hashers, workers=4, invalidate=False):
+    """
+    Write checksum manifests for all the files in a directory, only hashing the
+    files that are new or were modified since they were last hashed.
+    :param str path: Directory with the files to checksum, i.e. a run or demux folder
+    :param list hashers: Algorithms to write manifests for
+    :param int workers: Number of files to hash at the same time
+    :param bool invalidate: Forget the cached checksums of the directory first
+    """
+    cache = get_checksum_cache(path)
+    if invalidate:
+        logger.info('Removed {} cached checksums for {}'.format(cache.invalidate(path), path))
+    manifests = misc.write_checksum_manifests(path, hashers=hashers, workers=workers, cache=cache)
+    for hasher in hashers:
+        logger.info('Wrote {} checksums of {} to {}'.format(hasher, path, manifests[hasher]))
+
+def verify_checksum_cache(path, sample):
+    """
+    Hash again a random sample of the files in the checksum cache of a directory
+    and report the ones whose content does not match their cached checksum.
+    :param str path: Directory whose cache should be audited
+    :param int sample: Number of files to check
+    :returns bool: True if all checked files matched
+    """
+    # A central cache holds the entries of other directories too
+    checked, mismatches = get_checksum_cache(path).verify(sample=sample, path=path)
+    logger.info('Verified {} cached checksums, {} mismatch(es)'.format(checked, len(mismatches)))
+    return not mismatches
@@ -0,0 +1,159 @@
+""" Bandwidth limits of the transfers, by time of day and adapted to the load of the storage
+"""
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+def _parse_time(value):
+    return datetime.strptime(str(value), '%H:%M').time()
+
+def current_window(windows, now=None):
+    """ Return the bandwidth window in effect
+        :param list windows: Windows as dicts with start and end ("HH:MM", a window can
+                             span midnight), limit (MB/s, 0 for unlimited) and optionally
+                             days (i.e. [Mon, Tue]), the first matching window wins
+        :param datetime now: Defaults to now
+        :returns dict: The window, None if no window matches
+    """
+    now = now or datetime.now()
+    for window in windows or []:
+        start, end = _parse_time(window['start']), _parse_time(window['end'])
+        if start <= end:
+            inside = start <= now.time() < end
+            day = now
+        else:
+            inside = now.time() >= start or now.time() < end
+            # The part after midnight belongs to the day the window started
+            day = now if now.time() >= start else datetime.fromordinal(now.toordinal() - 1)
+        days = [d.lower()[:3] for d in window.get('days', [])]
+        if inside and (not days or day.strftime('%a').lower() in days):
+            return window
+    return None
+
+def storage_latency(path, probes=3):
+    """ Measure the latency of the storage, writing and syncing a small file
+        :param str path: Directory on the storage, it should not be one being transferred
+                         since the probe file could be picked up by the transfer
+        :param int probes: Number of measurements
+        :returns float: Median latency in seconds
+    """
+    # Unique name, several transfers can probe the same directory at the same time
+    fd, probe_file = tempfile.mkstemp(prefix='.taca_latency_probe', dir=path)
+    os.close(fd)
+    latencies = []
+    for _ in range(probes):
+        start = time.time()
+        fd = os.open(probe_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.write(fd, '\0' * 4096)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        latencies.append(time.time() - start)
+    os.remove(probe_file)
+    return sorted(latencies)[len(latencies) // 2]
+
+class BandwidthController(object):
+    """ Decides the bandwidth limit of the next transfer.
+
+    The limit comes from the window in effect (see current_window). If adaptive,
+    it is halved whenever the storage latency goes over max_latency (i.e. the
+    sequencers are busy writing to it), and increased by a quarter, up to the
+    limit of the window, when the previous transfer used all of it. The adapted
+    limits are kept in a state file, so they carry over between invocations.
+    """
+    def __init__(self, config, state_file):
+        """
+        :param dict config: The bandwidth section of the configuration, with the keys windows,
+                            default_limit (MB/s outside the windows, unlimited if not given),
+                            adaptive, min_limit (MB/s, default 10) and max_latency (seconds, default 0.1)
+        :param str state_file: Path to the file where the adapted limits are kept
+        """
+        self.config = config or {}
+        self.state_file = state_file
+        self._key = None
+
+    def _load(self):
+        try:
+            with open(self.state_file) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, key, **values):
+        # Several transfers may update the state at the same time, do not lose their changes
+        with open(self.state_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = self._load()
+                state.setdefault(key, {}).update(values, updated=str(datetime.now()))
+                fd, tmp_file = tempfile.mkstemp(prefix='.{}.'.format(os.path.basename(self.state_file)),
+                                                dir=os.path.dirname(os.path.abspath(self.state_file)))
+                try:
+                    with os.fdopen(fd, 'w') as fh:
+                        json.dump(state, fh, indent=2, sort_keys=True)
+                    os.rename(tmp_file, self.state_file)
+                except:
+                    os.remove(tmp_file)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def limit(self, probe_dir=None, now=None):
+        """ Return the limit for the next transfer
+            :param str probe_dir: Directory on the storage the data is read from, to measure its latency,
+                                  outside of the data being transferred
+            :param datetime now: Defaults to now
+            :returns float: Limit in MB/s, None if unlimited
+        """
+        window = current_window(self.config.get('windows'), now=now)
+        cap = (window.get('limit') if window else self.config.get('default_limit')) or None
+        if not self.config.get('adaptive') or not probe_dir:
+            return cap
+        self._key = '{}-{}'.format(window['start'], window['end']) if window else 'default'
+        state = self._load().get(self._key, {})
+        limit = state.get('limit', cap)
+        if cap and (not limit or limit > cap):
+            limit = cap
+        try:
+            latency = storage_latency(probe_dir)
+        except OSError as e:
+            logger.warning('Could not measure the latency of the storage in {}: {}'.format(probe_dir, e))
+            return limit
+        min_limit = self.config.get('min_limit', 10)
+        throughput = state.get('throughput')
+        if latency > self.config.get('max_latency', 0.1):
+            base = limit or throughput
+            if base:
+                limit = max(min_limit, base * 0.5)
+                logger.info('Storage latency is {:.3f} seconds, lowering the bandwidth limit '
+                            'to {:.0f} MB/s'.format(latency, limit))
+        elif limit and throughput and throughput >= 0.9 * limit:
+            # The limit was the bottleneck and the storage copes, allow more
+            limit = min(cap, limit * 1.25) if cap else limit * 1.25
+        self._save(self._key, limit=limit, latency=latency)
+        return limit
+
+    def record(self, throughput):
+        """ Record the throughput of the transfer made with the last limit
+            :param float throughput: Measured throughput in MB/s
+        """
+        if self._key and throughput:
+            self._save(self._key, throughput=throughput)
+
+def rsync_option(limit):
+    """ The rsync option applying a limit
+        :param float limit: Limit in MB/s
+        :returns str: The option, None if unlimited
+    """
+    if not limit:
+        return None
+    # --bwlimit takes units of 1024 bytes per second
+    return '--bwlimit={}'.format(max(1, int(limit * 1e6 / 1024)))
@@ -0,0 +1,142 @@
+""" Persistent cache of file checksums
+"""
+import logging
+import os
+import random
+import sqlite3
+
+from datetime import datetime
+
+from taca.utils import misc
+
+logger = logging.getLogger(__name__)
+
+# Name of the cache database when it is kept in the directory it describes
+CACHE_NAME = '.checksums.db'
+
+class ChecksumCache(object):
+    """ SQLite cache of file digests keyed on path, size, mtime and inode, so
+        that unchanged files do not need to be hashed again. It can be kept
+        per directory (i.e. in a run folder) or shared in a central place.
+    """
+    def __init__(self, db_file, timeout=60):
+        """
+        :param str db_file: Path to the SQLite database
+        :param int timeout: Seconds to wait for a concurrent writer to release the database
+        """
+        self.db_file = db_file
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS checksums (path TEXT, algorithm TEXT, size INTEGER, "
+                             "mtime_ns INTEGER, inode INTEGER, digest TEXT, updated TEXT, "
+                             "PRIMARY KEY (path, algorithm))")
+        finally:
+            conn.close()
+
+    @classmethod
+    def for_dir(cls, root):
+        """ Return the cache kept inside a directory
+            :param str root: Path to the directory
+        """
+        return cls(os.path.join(root, CACHE_NAME))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def _under(self, path):
+        """ The condition and parameters selecting the entries of a file or of
+            everything under a directory
+        """
+        path = os.path.abspath(path)
+        return "path = ? OR substr(path, 1, ?) = ?", (path, len(path) + 1, os.path.join(path, ''))
+
+    def get(self, afile, hashers, key=None):
+        """ Return the cached digests of a file that are still valid
+            :param str afile: Path to the file
+            :param list hashers: Algorithms to look for
+            :param tuple key: The current misc.cache_key of the file, if already known
+            :returns dict: Digest by algorithm, only for the algorithms found
+        """
+        key = key or misc.cache_key(afile)
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT algorithm, digest FROM checksums WHERE path = ? AND size = ? "
+                                "AND mtime_ns = ? AND inode = ?",
+                                (os.path.abspath(afile),) + key).fetchall()
+        finally:
+            conn.close()
+        found = dict((algorithm.lower(), digest) for algorithm, digest in rows)
+        return dict((hasher, found[hasher.lower()]) for hasher in hashers if hasher.lower() in found)
+
+    def put(self, afile, digests, key):
+        """ Store the digests of a file
+            :param str afile: Path to the file
+            :param dict digests: Digest by algorithm
+            :param tuple key: The misc.cache_key of the file when it was hashed
+        """
+        now = str(datetime.now())
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                 [(os.path.abspath(afile), hasher.lower()) + key + (digest, now)
+                                  for hasher, digest in digests.items()])
+        finally:
+            conn.close()
+
+    def invalidate(self, path=None):
+        """ Forget the cached digests of a file, of everything under a directory
+            or of everything if no path is given
+            :param str path: Path to a file or directory
+            :returns int: Number of removed entries
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                if not path:
+                    cursor = conn.execute("DELETE FROM checksums")
+                else:
+                    condition, params = self._under(path)
+                    cursor = conn.execute("DELETE FROM checksums WHERE {}".format(condition), params)
+                return cursor.rowcount
+        finally:
+            conn.close()
+
+    def verify(self, sample=10, blocksize=8388608, path=None):
+        """ Audit the cache, hashing again a random sample of the entries whose
+            files did not change. A mismatch means the content changed without
+            its metadata changing (i.e. silent corruption).
+            :param int sample: Number of entries to check
+            :param int blocksize: The blocksize used to read the files
+            :param str path: Only audit the entries of this file or directory
+            :returns tuple: Number of checked entries and list of (path, algorithm)
+                            that did not match
+        """
+        query = "SELECT path, algorithm, size, mtime_ns, inode, digest FROM checksums"
+        params = ()
+        if path:
+            condition, params = self._under(path)
+            query += " WHERE {}".format(condition)
+        conn = self._connect()
+        try:
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        checked = 0
+        mismatches = []
+        random.shuffle(rows)
+        for path, algorithm, size, mtime_ns, inode, digest in rows:
+            if checked >= sample:
+                break
+            try:
+                if misc.cache_key(path) != (size, mtime_ns, inode):
+                    continue
+            except OSError:
+                continue
+            checked += 1
+            if misc.hashfile_multi(path, hashers=[algorithm], blocksize=blocksize)[algorithm] != digest:
+                logger.error("Cached {} digest of {} does not match its content".format(algorithm, path))
+                mismatches.append((path, algorithm))
+        return checked, mismatches
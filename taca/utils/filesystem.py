@@ -1,11 +1,86 @@
 """ Filesystem utilities
 """
 import contextlib
+import errno
+import fcntl
+import json
 import os
 import re
+import shutil
+import sqlite3
+import stat
+import threading
+import time
+
+from datetime import datetime
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 RUN_RE = '^\d{6}_[a-zA-Z\d\-]+_\d{4}_[AB0][A-Z\d\-]+$'
 PROJECT_RE = '[a-zA-Z]+\.[a-zA-Z]+_\d{2}_\d{2}'
+# Directory things are renamed into before being removed, see move_to_trash
+TRASH_DIR = '.deleting'
+
+class _DirEntry(object):
+    """ Minimal replacement of os.DirEntry used when scandir is not available
+    """
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+def scandir(path):
+    """ Iterate over the entries of a directory like os.scandir does, so the file
+        type comes for free with the listing on the filesystems that support it.
+        On Python 2 this needs the scandir package (see requirements.txt). Without
+        it, this is a plain os.listdir walk with a stat call per entry, as slow as
+        before scandir was used.
+
+    :param str path: Directory to list
+    :returns: Iterator of DirEntry like objects
+    """
+    if _scandir is not None:
+        return _scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
 
 @contextlib.contextmanager
 def chdir(new_dir):
@@ -20,6 +95,27 @@ def chdir(new_dir):
     finally:
         os.chdir(cur_dir)
 
+@contextlib.contextmanager
+def locked(lock_file):
+    """Context manager to hold an exclusive lock on a file while running a block.
+
+    The lock is requested without blocking, so the caller can decide what to do
+    when somebody else (another process or thread) is already holding it.
+
+    :param str lock_file: Path to the lock file, it will be created if needed
+    :returns bool: True if the lock was acquired, False otherwise
+    """
+    with open(lock_file, 'a') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
 def create_folder(target_folder):
     """ Ensure that a folder exists and create it if it doesn't, including any
         parent folders, as necessary.
@@ -34,6 +130,276 @@ def create_folder(target_folder):
         pass
     return os.path.exists(target_folder)
 
+def disk_free(path):
+    """ Return the space available to non-root users on the file system of a path
+    
+    :param str path: Any path in the file system
+    :returns int: The free space in bytes
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def _dir_stats(path, cached=None):
+    """ Return the mtime of a directory, the size, number and newest mtime of the
+        files directly in it, and its subdirectories. If 'cached' has the same
+        mtime, the directory did not change and it is returned instead.
+    """
+    mtime = os.lstat(path).st_mtime
+    if cached and cached[0] == mtime:
+        return cached
+    size, files, newest, subdirs = 0, 0, mtime, []
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+            continue
+        st = entry.stat(follow_symlinks=False)
+        size += st.st_size
+        files += 1
+        newest = max(newest, st.st_mtime)
+    return (mtime, size, files, newest, subdirs)
+
+def _load_tree_cache(db_file, path):
+    conn = sqlite3.connect(db_file, timeout=60)
+    try:
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+                         "files INTEGER, newest REAL, subdirs TEXT)")
+        rows = conn.execute("SELECT path, mtime, size, files, newest, subdirs FROM dirs WHERE path = ? "
+                            "OR substr(path, 1, ?) = ?", (path, len(path) + 1, os.path.join(path, ''))).fetchall()
+    finally:
+        conn.close()
+    return dict((row[0], tuple(row[1:5]) + (json.loads(row[5]),)) for row in rows)
+
+def _save_tree_cache(db_file, path, stats, previous):
+    conn = sqlite3.connect(db_file, timeout=60)
+    try:
+        with conn:
+            conn.executemany("DELETE FROM dirs WHERE path = ?", [(d,) for d in previous if d not in stats])
+            conn.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                             [(d, st[0], st[1], st[2], st[3], json.dumps(st[4]))
+                              for d, st in stats.items() if previous.get(d) != st])
+    finally:
+        conn.close()
+
+def tree_stats(path, workers=8, cache=None, settle=None):
+    """ Return the total size, the number of files and the newest mtime of everything
+        under a directory, without following symlinks. Subdirectories are listed by
+        a pool of threads, which pays off on network filesystems.
+
+        The stats of each directory can be kept in a cache, keyed on the mtime of the
+        directory, so that directories that did not change are not listed again. As
+        the mtime of a directory only changes when entries are added, removed or renamed,
+        this is only safe for trees whose files are not modified in place, like
+        finished runs. For trees still being written, like runs being sequenced,
+        give 'settle': only the directories none of whose files was modified in the
+        last 'settle' seconds are then kept in the cache, so the directories still
+        being written to are always listed again.
+
+    :param str path: Path to the directory
+    :param int workers: Number of directories listed at the same time
+    :param str cache: Path to a SQLite database to keep the stats of the directories
+    :param int settle: Seconds after which a directory is considered not written anymore
+    :returns tuple: Size in bytes, number of files and newest mtime
+    """
+    path = os.path.abspath(path)
+    previous = _load_tree_cache(cache, path) if cache else {}
+    stats = {}
+    pool = ThreadPool(workers)
+    try:
+        # one level of the tree at a time, run folders are wide rather than deep
+        level = [path]
+        while level:
+            results = pool.map(lambda d: _dir_stats(d, previous.get(d)), level)
+            stats.update(zip(level, results))
+            level = [subdir for result in results for subdir in result[4]]
+    finally:
+        pool.close()
+        pool.join()
+    if cache:
+        settled = time.time() - settle if settle is not None else None
+        _save_tree_cache(cache, path, dict((d, st) for d, st in stats.items()
+                                           if settled is None or st[3] < settled), previous)
+    return (sum(st[1] for st in stats.values()), sum(st[2] for st in stats.values()),
+            max(st[3] for st in stats.values()))
+
+def move_to_trash(path, trash_dir=None):
+    """ Rename a file or directory into a trash directory, so that it is gone at
+        once from where it was even if removing it takes long. The trash directory
+        must be on the same file system.
+
+    :param str path: Path to the file or directory
+    :param str trash_dir: Trash directory, by default TRASH_DIR next to the path
+    :returns str: The new path
+    """
+    path = os.path.abspath(path)
+    trash_dir = trash_dir or os.path.join(os.path.dirname(path), TRASH_DIR)
+    create_folder(trash_dir)
+    target = os.path.join(trash_dir, "{}.{}".format(os.path.basename(path), datetime.now().strftime("%Y%m%d%H%M%S%f")))
+    os.rename(path, target)
+    return target
+
+class _Throttle(object):
+    """ Spread calls from several threads so they do not go over a rate
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_call = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(self.next_call, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def _empty_dir(path, throttle=None):
+    """ Remove the files directly in a directory
+        :returns tuple: Number and size of the removed files, and the subdirectories
+    """
+    files, size, subdirs = 0, 0, []
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+            continue
+        size += entry.stat(follow_symlinks=False).st_size
+        if throttle:
+            throttle.wait()
+        os.unlink(entry.path)
+        files += 1
+    return files, size, subdirs
+
+def remove_tree(path, workers=8, max_rate=None):
+    """ Remove a directory and everything under it, like shutil.rmtree but with a
+        pool of threads removing the files of different subdirectories at the same
+        time, which is much faster for trees with millions of small files.
+
+    :param str path: Path to the directory
+    :param int workers: Number of directories emptied at the same time
+    :param float max_rate: Maximum number of files removed per second, to leave
+                           some IO to others (i.e. sequencers writing to the same disks)
+    :returns tuple: Number and size in bytes of the removed files
+    """
+    throttle = _Throttle(max_rate) if max_rate else None
+    files, size, levels = 0, 0, []
+    pool = ThreadPool(workers)
+    try:
+        level = [path]
+        while level:
+            levels.append(level)
+            results = pool.map(lambda d: _empty_dir(d, throttle), level)
+            files += sum(result[0] for result in results)
+            size += sum(result[1] for result in results)
+            level = [subdir for result in results for subdir in result[2]]
+        # directories are empty now, remove them from the deepest up
+        for level in reversed(levels):
+            pool.map(os.rmdir, level)
+    finally:
+        pool.close()
+        pool.join()
+    return files, size
+
+def _list_dir(path):
+    """ Return the entries directly in a directory as (path, type, size) tuples, where
+        type is 'd' for directories, 'l' for symlinks and 'f' for anything else
+    """
+    entries = []
+    for entry in scandir(path):
+        if entry.is_symlink():
+            entries.append((entry.path, 'l', 0))
+        elif entry.is_dir(follow_symlinks=False):
+            entries.append((entry.path, 'd', 0))
+        else:
+            entries.append((entry.path, 'f', entry.stat(follow_symlinks=False).st_size))
+    return entries
+
+def _list_tree(path, pool):
+    """ Return everything under a directory as a dict with (type, size) by relative path,
+        listing the directories of each level of the tree with the given thread pool
+    """
+    tree = {}
+    level = [path]
+    while level:
+        entries = [entry for result in pool.map(_list_dir, level) for entry in result]
+        tree.update((os.path.relpath(p, path), (kind, size)) for p, kind, size in entries)
+        level = [p for p, kind, _ in entries if kind == 'd']
+    return tree
+
+def _copy_file(src, dst, blocksize=16777216):
+    """ Copy a file and its permissions and times, unless a previous copy is there
+        already (same size and mtime, as the times are copied only once it is done)
+    """
+    st = os.lstat(src)
+    try:
+        dst_st = os.lstat(dst)
+        if dst_st.st_size == st.st_size and int(dst_st.st_mtime) == int(st.st_mtime):
+            return
+    except OSError:
+        pass
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, blocksize)
+    shutil.copystat(src, dst)
+
+def move_tree(src, dst, workers=8):
+    """ Move a directory like shutil.move does, trying to rename it first. When the
+        destination is on another file system, the tree is copied by a pool of threads
+        into a hidden staging directory next to the destination, the copy is checked
+        against the source (same entries and file sizes) and renamed into place, and
+        only then the source is removed.
+
+        An interrupted move is resumed by calling it again: files already copied are
+        not copied again, and if the destination is complete what is left of the source
+        is just removed.
+
+    :param str src: Path to the directory
+    :param str dst: New path of the directory (not its parent)
+    :param int workers: Number of files copied at the same time
+    :raises OSError: If the destination exists and is not a copy of the source
+    :returns bool: True if the directory was renamed, False if it was copied
+    """
+    src, dst = os.path.abspath(src), os.path.abspath(dst)
+    pool = ThreadPool(workers)
+    try:
+        if os.path.exists(dst):
+            if not os.path.exists(src):
+                return False
+            # a previous move was interrupted while removing the source, what is
+            # left of it must be in the destination already
+            dst_tree = _list_tree(dst, pool)
+            if any(dst_tree.get(rel) != entry for rel, entry in _list_tree(src, pool).items()):
+                raise OSError(errno.EEXIST, "Destination path already exists", dst)
+            remove_tree(src, workers=workers)
+            return False
+        try:
+            os.rename(src, dst)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        staging = os.path.join(os.path.dirname(dst), ".{}.moving".format(os.path.basename(dst)))
+        tree = _list_tree(src, pool)
+        create_folder(staging)
+        for rel in sorted(rel for rel, (kind, _) in tree.items() if kind == 'd'):
+            create_folder(os.path.join(staging, rel))
+        for rel in [rel for rel, (kind, _) in tree.items() if kind == 'l']:
+            if not os.path.lexists(os.path.join(staging, rel)):
+                os.symlink(os.readlink(os.path.join(src, rel)), os.path.join(staging, rel))
+        # the biggest files first, so that the pool is not left waiting on one of them at the end
+        files = sorted([rel for rel, (kind, _) in tree.items() if kind == 'f'], key=lambda rel: -tree[rel][1])
+        pool.map(lambda rel: _copy_file(os.path.join(src, rel), os.path.join(staging, rel)), files, chunksize=1)
+        if _list_tree(staging, pool) != tree:
+            raise IOError("Copy of {} in {} does not match the source".format(src, staging))
+        for rel in sorted([rel for rel, (kind, _) in tree.items() if kind == 'd'], reverse=True) + ['.']:
+            shutil.copystat(os.path.join(src, rel), os.path.join(staging, rel))
+        os.rename(staging, dst)
+    finally:
+        pool.close()
+        pool.join()
+    remove_tree(src, workers=workers)
+    return False
+
 def is_in_file(file_path, text):
     """
     Looks for text appearing in a file.
@@ -0,0 +1,166 @@
+""" Indexed ledger of the runs transferred to the analysis server
+"""
+import csv
+import fcntl
+import logging
+import os
+import sqlite3
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+class TransferLedger(object):
+    """ SQLite index on top of a transfer.tsv file.
+
+    The TSV file (one row per run with the run name and the transfer date) is
+    still the reference record and is appended to as before, the SQLite database
+    next to it only indexes it. Rows appended to the TSV file since the last
+    lookup (by TACA or by anything else) are imported incrementally, and the
+    whole file is imported again if it shrinks, i.e. it was edited by hand.
+    """
+    def __init__(self, transfer_file, db_file=None, timeout=60):
+        """
+        :param str transfer_file: Path to the transfer.tsv file
+        :param str db_file: Path to the SQLite database, defaults to the transfer
+                            file with a .db extension
+        :param int timeout: Seconds to wait for a concurrent writer to release the database
+        """
+        self.transfer_file = transfer_file
+        self.db_file = db_file or '{}.db'.format(os.path.splitext(transfer_file)[0])
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, date TEXT)")
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def _sync(self, conn):
+        """ Import the rows appended to the transfer file since the last sync
+            :param sqlite3.Connection conn: Open connection to the ledger database
+        """
+        try:
+            size = os.path.getsize(self.transfer_file)
+        except OSError:
+            return
+        row = conn.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+        offset = int(row[0]) if row else 0
+        if size == offset:
+            return
+        if size < offset:
+            logger.info('{} has been modified, importing it again'.format(self.transfer_file))
+            conn.execute("DELETE FROM runs")
+            offset = 0
+        with open(self.transfer_file, 'rb') as fh:
+            fh.seek(offset)
+            content = fh.read(size - offset)
+        # Only import complete lines, someone may be writing the last one right now
+        content = content[:content.rfind('\n') + 1]
+        rows = [row for row in csv.reader(content.splitlines(), delimiter='\t') if row]
+        conn.executemany("INSERT OR IGNORE INTO runs (run, date) VALUES (?, ?)",
+                         [(row[0], row[1] if len(row) > 1 else '') for row in rows])
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('offset', ?)",
+                     (str(offset + len(content)),))
+
+    def is_transferred(self, run_id):
+        """ Checks if a run is recorded in the ledger
+            :param str run_id: Run name
+            :returns bool: True if the run has been transferred
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                self._sync(conn)
+                return conn.execute("SELECT 1 FROM runs WHERE run = ?", (run_id,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def add(self, run_id, date=None):
+        """ Record a run as transferred, both in the transfer file and in the index
+            :param str run_id: Run name
+            :param datetime date: Transfer date, defaults to now
+        """
+        with open(self.transfer_file, 'a') as transfer_file:
+            # Do not interleave rows with other TACA instances writing at the same time
+            fcntl.flock(transfer_file, fcntl.LOCK_EX)
+            try:
+                tsv_writer = csv.writer(transfer_file, delimiter='\t')
+                tsv_writer.writerow([run_id, str(date or datetime.now())])
+            finally:
+                transfer_file.flush()
+                fcntl.flock(transfer_file, fcntl.LOCK_UN)
+        conn = self._connect()
+        try:
+            with conn:
+                self._sync(conn)
+        finally:
+            conn.close()
+
+class TransferMetrics(object):
+    """ SQLite store of the throughput of the transfers to the analysis server,
+        one row per transfer of a run
+    """
+    COLUMNS = ['run', 'started', 'shards', 'files', 'bytes_sent', 'total_size',
+               'elapsed', 'listing_time', 'file_list_time', 'mb_per_s', 'speedup']
+
+    def __init__(self, db_file, timeout=60):
+        """
+        :param str db_file: Path to the SQLite database
+        :param int timeout: Seconds to wait for a concurrent writer to release the database
+        """
+        self.db_file = db_file
+        self.timeout = timeout
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS transfers (run TEXT, started TEXT, shards INTEGER, "
+                             "files INTEGER, bytes_sent INTEGER, total_size INTEGER, elapsed REAL, "
+                             "listing_time REAL, file_list_time REAL, mb_per_s REAL, speedup REAL)")
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_file, timeout=self.timeout)
+
+    def add(self, run_id, metrics, started=None):
+        """ Record the transfer of a run
+            :param str run_id: Run name
+            :param dict metrics: Transfer metrics, by column name
+            :param datetime started: When the transfer started, defaults to now
+        """
+        row = dict(metrics, run=run_id, started=str(started or datetime.now()))
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT INTO transfers VALUES ({})".format(', '.join('?' * len(self.COLUMNS))),
+                             [row.get(column) for column in self.COLUMNS])
+        finally:
+            conn.close()
+
+    def query(self, run_id=None, since=None):
+        """ Return the recorded transfers, oldest first
+            :param str run_id: Only the transfers of this run
+            :param datetime since: Only the transfers started after this date
+            :returns list: Transfers as dicts, by column name
+        """
+        conditions, params = [], []
+        if run_id:
+            conditions.append("run = ?")
+            params.append(run_id)
+        if since:
+            conditions.append("started >= ?")
+            params.append(str(since))
+        sql = "SELECT {} FROM transfers".format(', '.join(self.COLUMNS))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql + " ORDER BY started", params).fetchall()
+        finally:
+            conn.close()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
@@ -1,15 +1,18 @@
 """ 
 Miscellaneous or general-use methods
 """
+import fnmatch
 import hashlib
 import os
 import smtplib
 import subprocess
 import sys
 import glob
+import time
 
 from datetime import datetime
 from email.mime.text import MIMEText
+from multiprocessing.pool import ThreadPool
 
 def send_mail(subject, content, receiver):
     """
@@ -65,21 +68,32 @@ def call_external_command(cl, with_log_files=False, prefix=None, log_dir=""):
             stdout.close()
             stderr.close()
 
-def call_external_command_detached(cl, with_log_files=False, prefix=None):
+def call_external_command_detached(cl, with_log_files=False, prefix=None, cwd=None, exit_status_file=None):
     """
     Executes an external command
     :param string cl: Command line to be executed (command + options and parameters)
     :param bool with_log_files: Create log files for stdout and stderr
+    :param string prefix: the prefics to add to log file
+    :param string cwd: directory to run the command in (and to write the log files to),
+                       the current working directory if not given
+    :param string exit_status_file: file where to write the exit status of the command when
+                                    it finishes, so that it can be checked by another process
     """
     if type(cl) == str:
         cl = cl.split(' ')
     command = os.path.basename(cl[0])
+    if exit_status_file:
+        # Wrap the command in a shell that records how it ended
+        cl = ['sh', '-c', 'exit_status_file=$1; shift; "$@"; echo $? > "$exit_status_file"',
+              'taca-wrapper', exit_status_file] + cl
     stdout = sys.stdout
     stderr = sys.stderr
 
     if with_log_files:
         if prefix:
             command = '{}_{}'.format(prefix, command)
+        if cwd:
+            command = os.path.join(cwd, command)
         stdout = open(command + '.out', 'wa')
         stderr = open(command + '.err', 'wa')
         started = "Started command {} on {}".format(' '.join(cl), datetime.now())
@@ -87,7 +101,7 @@ def call_external_command_detached(cl, with_log_files=False, prefix=None):
         stdout.write(''.join(['=']*len(cl)) + '\n')
 
     try:
-        p_handle = subprocess.Popen(cl, stdout=stdout, stderr=stderr)
+        p_handle = subprocess.Popen(cl, stdout=stdout, stderr=stderr, cwd=cwd)
     except subprocess.CalledProcessError, e:
         e.message = "The command {} failed.".format(' '.join(cl))
         raise e
@@ -127,7 +141,26 @@ def to_seconds(days=None, hours=None):
         # 1 hour == 60*60 seconds --> 3600
         return 3600 * hours
 
-def hashfile(afile, hasher='sha1', blocksize=65536):
+def retry(func, attempts=3, delay=5, backoff=2, max_delay=600):
+    """
+    Call a function until it returns a true value, waiting exponentially
+    longer after each failed attempt
+    :param func: function to call, without arguments
+    :param int attempts: maximum number of calls
+    :param int delay: seconds to wait after the first failed call
+    :param int backoff: factor the waiting time is multiplied by after each failed call
+    :param int max_delay: maximum number of seconds to wait between two calls
+    :returns: the value returned by the last call
+    """
+    result = None
+    for attempt in range(attempts):
+        result = func()
+        if result or attempt == attempts - 1:
+            break
+        time.sleep(min(delay * backoff ** attempt, max_delay))
+    return result
+
+def hashfile(afile, hasher='sha1', blocksize=65536, cache=None):
     """
     Calculate the hash digest of a file with the specified algorithm and 
     return it.
@@ -135,17 +168,138 @@ def hashfile(afile, hasher='sha1', blocksize=65536):
     :param string afile: the file to calculate the digest for
     :param string hasher: the hashing algorithm to be used, default is sha1
     :param int blocksize: the blocksize to use, default is 65536 bytes
+    :param cache: a taca.utils.checksums.ChecksumCache to get the digest from
+                  if the file did not change since it was last hashed
     :returns: the hexadecimal hash digest or None if input was not a file
     """ 
+    digests = hashfile_multi(afile, hashers=[hasher], blocksize=blocksize, cache=cache)
+    return digests[hasher] if digests else None
+
+def hashfile_multi(afile, hashers=('md5', 'sha1', 'sha256'), blocksize=8388608, cache=None):
+    """
+    Calculate several hash digests of a file reading it only once
+    :param string afile: the file to calculate the digests for
+    :param list hashers: the hashing algorithms to be used
+    :param int blocksize: the blocksize to use, default is 8 MB
+    :param cache: a taca.utils.checksums.ChecksumCache, only the digests not
+                  found in it are calculated (and then added to it)
+    :returns: dict with the hexadecimal digest by algorithm or None if
+              input was not a file
+    """
     if not os.path.isfile(afile):
         return None
-    hashobj = hashlib.new(hasher)
-    with open(afile,'rb') as fh:
+    digests = {}
+    if cache:
+        key = cache_key(afile)
+        digests = cache.get(afile, hashers, key=key)
+    missing = [hasher for hasher in hashers if hasher not in digests]
+    if not missing:
+        return digests
+    hashobjs = [hashlib.new(hasher) for hasher in missing]
+    with open(afile, 'rb') as fh:
         buf = fh.read(blocksize)
         while len(buf) > 0:
-            hashobj.update(buf)
+            for hashobj in hashobjs:
+                hashobj.update(buf)
             buf = fh.read(blocksize)
-    return hashobj.hexdigest()
+    calculated = dict((hasher, hashobj.hexdigest()) for hasher, hashobj in zip(missing, hashobjs))
+    if cache:
+        cache.put(afile, calculated, key)
+    digests.update(calculated)
+    return digests
+
+def cache_key(afile):
+    """
+    Return the metadata identifying the content of a file for a checksum cache
+    :param string afile: the file
+    :returns: tuple with the size, the mtime in nanoseconds and the inode
+    """
+    st = os.stat(afile)
+    mtime_ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 10**9))
+    return (st.st_size, mtime_ns, st.st_ino)
+
+def hash_files(files, hashers=('md5',), workers=4, blocksize=8388608, cache=None):
+    """
+    Calculate the hash digests of many files in parallel. hashlib releases
+    the GIL while hashing, so threads are enough to use several cores (and
+    to keep several reads in flight on network file systems)
+    :param list files: the files to calculate the digests for
+    :param list hashers: the hashing algorithms to be used
+    :param int workers: number of files to hash at the same time
+    :param int blocksize: the blocksize to use, default is 8 MB
+    :param cache: a taca.utils.checksums.ChecksumCache to reuse digests from
+    :returns: dict with the digests (as returned by hashfile_multi) by file
+    """
+    files = list(files)
+    if not files:
+        return {}
+    pool = ThreadPool(min(workers, len(files)))
+    try:
+        digests = pool.map(lambda afile: hashfile_multi(afile, hashers, blocksize, cache=cache), files)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(files, digests))
+
+def write_checksum_manifests(root, hashers=('md5',), pattern='*', workers=4, name='checksums', cache=None):
+    """
+    Hash all the files under a directory and write one manifest per algorithm
+    in the directory itself, i.e. checksums.md5, in the format of md5sum/sha256sum,
+    so that they can be checked with 'cd root && md5sum -c checksums.md5'
+    :param string root: the directory to calculate the checksums for (i.e. a run
+                        or a demultiplexing folder)
+    :param list hashers: the hashing algorithms to be used
+    :param string pattern: only files whose name matches this shell pattern are hashed
+    :param int workers: number of files to hash at the same time
+    :param string name: the name of the manifests, the algorithm is used as extension
+    :param cache: a taca.utils.checksums.ChecksumCache, only new or modified
+                  files are hashed
+    :returns: dict with the path to the manifest by algorithm
+    """
+    manifests = dict((hasher, os.path.join(root, '{}.{}'.format(name, hasher.lower()))) for hasher in hashers)
+    # Neither the manifests nor the cache (if kept in root) describe the content
+    skip = []
+    if cache:
+        skip = [os.path.abspath(cache.db_file), os.path.abspath(cache.db_file) + '-journal']
+    files = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            afile = os.path.join(dirpath, filename)
+            if dirpath == root and fnmatch.fnmatch(filename, '{}.*'.format(name)):
+                # manifests, also those written for other algorithms
+                continue
+            if fnmatch.fnmatch(filename, pattern) and os.path.abspath(afile) not in skip:
+                files.append(afile)
+    digests = hash_files(files, hashers=hashers, workers=workers, cache=cache)
+    for hasher, manifest in manifests.items():
+        with open(manifest, 'w') as fh:
+            for afile in sorted(files):
+                fh.write('{}  {}\n'.format(digests[afile][hasher], os.path.relpath(afile, root)))
+    return manifests
+
+def copy_stream(src, dst, hashers=[], blocksize=4194304, size=None):
+    """
+    Copy everything from a file object into another one, updating the given
+    hash objects with the data on the way (like piping through tee and md5sum)
+    :param file src: the file object to read from
+    :param file dst: the file object to write to, None to only hash the data
+    :param list hashers: hashlib objects to update with the copied data
+    :param int blocksize: the blocksize to use, default is 4 MB
+    :param int size: copy at most this number of bytes, default is until the end
+    :returns: the number of bytes copied
+    """
+    copied = 0
+    buf = src.read(blocksize if size is None else min(blocksize, size))
+    while len(buf) > 0:
+        for hashobj in hashers:
+            hashobj.update(buf)
+        if dst is not None:
+            dst.write(buf)
+        copied += len(buf)
+        if size is not None and copied >= size:
+            break
+        buf = src.read(blocksize if size is None else min(blocksize, size - copied))
+    return copied
 
 def return_unique(seq):
     seen = set()
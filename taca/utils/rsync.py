@@ -0,0 +1,93 @@
+""" Running rsync and parsing its output
+"""
+import logging
+import os
+import re
+import subprocess
+import time
+
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Lines printed by --info=progress2, i.e. "  1,234,567  45%   10.00MB/s    0:00:12 (xfr#3, to-chk=10/20)"
+PROGRESS_RE = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d{2}:\d{2})')
+SPEEDUP_RE = re.compile(r'total size is ([\d,]+)\s+speedup is ([\d.,]+)')
+# Lines printed by --stats and the metric they are parsed into
+STATS = {'Number of regular files transferred': 'files',
+         'Total file size': 'total_size',
+         'Total transferred file size': 'transferred_size',
+         'Total bytes sent': 'bytes_sent',
+         'Total bytes received': 'bytes_received',
+         'File list generation time': 'file_list_time'}
+
+def _number(text):
+    value = float(text.split()[0].replace(',', ''))
+    return int(value) if value.is_integer() else value
+
+def parse_stats(lines):
+    """ Parse the summary printed by rsync --stats
+        :param list lines: Lines of rsync output
+        :returns dict: The metrics found, see STATS, and speedup
+    """
+    metrics = {}
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key.strip() in STATS and value.strip():
+            metrics[STATS[key.strip()]] = _number(value.strip())
+            continue
+        match = SPEEDUP_RE.search(line)
+        if match:
+            metrics['speedup'] = _number(match.group(2))
+    return metrics
+
+def call_rsync(cl, prefix=None, log_dir="", label=None, progress_interval=60):
+    """ Run rsync, writing its output to log files like misc.call_external_command
+        does, and parse it while it runs. The command line should include --stats,
+        and --info=progress2 to log the progress of the transfer.
+        :param list cl: rsync command line
+        :param str prefix: Prefix of the log files
+        :param str log_dir: Where to write the log files
+        :param str label: What is being transferred, for the progress messages
+        :param int progress_interval: Minimum seconds between two progress messages
+        :returns dict: The metrics parsed from the --stats output and the elapsed seconds
+        :raises subprocess.CalledProcessError: If rsync fails
+    """
+    log_file = os.path.join(log_dir, '{}_rsync'.format(prefix) if prefix else 'rsync')
+    label = label or ' '.join(cl[-2:])
+    lines = []
+    last_progress = time.time()
+    start = time.time()
+    with open(log_file + '.out', 'a') as stdout, open(log_file + '.err', 'a') as stderr:
+        stdout.write("Started command {} on {}\n".format(' '.join(cl), datetime.now()))
+        stdout.write(''.join(['=']*len(cl)) + '\n')
+        p_handle = subprocess.Popen(cl, stdout=subprocess.PIPE, stderr=stderr)
+        pending = ''
+        while True:
+            chunk = os.read(p_handle.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            # Progress lines end with a carriage return, the rest with a new line
+            parts = re.split(r'[\r\n]', pending + chunk)
+            pending = parts.pop()
+            for line in parts:
+                match = PROGRESS_RE.match(line)
+                if not match:
+                    if line:
+                        stdout.write(line + '\n')
+                        lines.append(line)
+                elif time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    logger.info('Transfer of {}: {}% done at {}, {} elapsed'.format(
+                        label, match.group(2), match.group(3), match.group(4)))
+        if pending:
+            stdout.write(pending + '\n')
+            lines.append(pending)
+        returncode = p_handle.wait()
+    if returncode:
+        e = subprocess.CalledProcessError(returncode, cl)
+        e.message = "The command {} failed.".format(' '.join(cl))
+        raise e
+    metrics = parse_stats(lines)
+    metrics['elapsed'] = time.time() - start
+    return metrics
@@ -0,0 +1,133 @@
+""" Shared SSH connections to the remote hosts
+"""
+import atexit
+import hashlib
+import logging
+import os
+import pipes
+import shutil
+import subprocess
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SSHMaster(object):
+    """ SSH master connection (ControlMaster) to a host. The ssh processes started
+        with the options given by command() (i.e. the ones started by rsync) go
+        through it instead of doing their own key exchange and authentication.
+        If the master is not running they just connect as usual.
+    """
+    def __init__(self, host, user=None, control_dir=None, persist=600, options=None):
+        """
+        :param str host: Remote host
+        :param str user: Remote user, the one of the ssh configuration if not given
+        :param str control_dir: Directory for the control socket, a temporary directory if not given
+        :param int persist: Seconds the master stays up without being used
+        :param list options: Additional ssh options, i.e. ServerAliveInterval=30
+        """
+        self.host = host
+        self.user = user
+        self.persist = persist
+        self.options = options or []
+        self._own_dir = not control_dir
+        self.control_dir = control_dir or tempfile.mkdtemp(prefix='taca_ssh_')
+        # Control sockets have a short maximum path length
+        name = hashlib.sha1('{}@{}'.format(user, host)).hexdigest()[:16]
+        self.control_path = os.path.join(self.control_dir, name)
+        self.started = False
+
+    @property
+    def destination(self):
+        return '{}@{}'.format(self.user, self.host) if self.user else self.host
+
+    def _options(self):
+        options = ['-o', 'ControlPath={}'.format(self.control_path)]
+        for option in self.options:
+            options.extend(['-o', option])
+        return options
+
+    def command(self):
+        """ The ssh command line reusing the master connection
+            :returns list: Command line, without the destination
+        """
+        return ['ssh'] + self._options()
+
+    def rsync_shell(self):
+        """ The command line to give to rsync -e
+        """
+        return ' '.join(pipes.quote(arg) for arg in self.command())
+
+    def _control(self, operation):
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(['ssh', '-O', operation] + self._options() + [self.destination],
+                                   stdout=devnull, stderr=devnull) == 0
+
+    def is_alive(self):
+        """ Checks if the master connection is up
+        """
+        return os.path.exists(self.control_path) and self._control('check')
+
+    def start(self):
+        """ Open the master connection unless it is already up
+            :returns bool: True if the master connection is up
+        """
+        if self.is_alive():
+            return True
+        command_line = ['ssh', '-f', '-N', '-o', 'ControlMaster=yes',
+                        '-o', 'ControlPersist={}'.format(self.persist),
+                        '-o', 'BatchMode=yes'] + self._options() + [self.destination]
+        # The master stays in the background, do not leave it holding a pipe
+        with open(os.devnull, 'r+') as devnull:
+            returncode = subprocess.call(command_line, stdin=devnull, stdout=devnull, stderr=devnull)
+        if returncode != 0:
+            logger.warning('Could not open an SSH master connection to {} (exit status {}), '
+                           'connecting without it'.format(self.destination, returncode))
+            return False
+        logger.info('Opened SSH master connection to {}'.format(self.destination))
+        self.started = True
+        return True
+
+    def stop(self):
+        """ Close the master connection, if it was opened by this object
+        """
+        if self.started and self.is_alive():
+            self._control('exit')
+            logger.info('Closed SSH master connection to {}'.format(self.destination))
+        self.started = False
+        if self._own_dir:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+
+_masters = {}
+_lock = threading.Lock()
+
+def get_master(host, user=None, config=None):
+    """ Return the master connection to a host shared by the whole process,
+        opening it (again, i.e. if it timed out) if needed
+        :param str host: Remote host
+        :param str user: Remote user
+        :param dict config: The ssh section of the configuration, with the keys
+                            control_master (default true), control_dir, control_persist
+                            (seconds, default 600) and options (list of ssh options)
+        :returns SSHMaster: The master connection, None if disabled or it could not be opened
+    """
+    config = config or {}
+    if not host or not config.get('control_master', True):
+        return None
+    with _lock:
+        master = _masters.get((user, host))
+        if master is None:
+            master = SSHMaster(host, user, control_dir=config.get('control_dir'),
+                               persist=config.get('control_persist', 600),
+                               options=config.get('options'))
+            _masters[(user, host)] = master
+        return master if master.start() else None
+
+@atexit.register
+def close_all():
+    """ Close all the master connections opened by get_master
+    """
+    with _lock:
+        for master in _masters.values():
+            master.stop()
+        _masters.clear()
@@ -0,0 +1,66 @@
+#!/bin/sh
+# Stand-in for the TSM client 'dsmc' used by the backup tests. Archived files
+# are recorded in $FAKE_PDC_DIR/archive.txt and every call is logged in
+# $FAKE_PDC_DIR/calls.txt
+STORE="$FAKE_PDC_DIR/archive.txt"
+touch "$STORE"
+echo "$@" >> "$FAKE_PDC_DIR/calls.txt"
+case "$1" in
+    query)
+        found=0
+        while read archived; do
+            case "$archived" in
+                $3)
+                    echo "         1,024  B  01/02/2017 10:00:00    $archived Never Archive Date: 01/02/2017"
+                    found=1;;
+            esac
+        done < "$STORE"
+        if [ $found = 0 ]; then
+            echo "ANS1092W No files matching search criteria were found"
+            exit 8
+        fi;;
+    archive)
+        if [ -n "$FAKE_PDC_FAIL" ]; then
+            case "$2" in
+                $FAKE_PDC_FAIL) exit 12;;
+            esac
+        fi
+        case "$2" in
+            /*) path="$2";;
+            *) path="$(pwd)/$2";;
+        esac
+        echo "$path" >> "$STORE"
+        mkdir -p "$FAKE_PDC_DIR/store$(dirname "$path")"
+        cp "$path" "$FAKE_PDC_DIR/store$path";;
+    retrieve)
+        # dsmc retrieve [-options] SOURCE DESTINATION/
+        # dsmc retrieve [-options] -filelist=FILE DESTINATION/
+        shift
+        filelist=""
+        while [ "${1#-}" != "$1" ]; do
+            case "$1" in
+                -filelist=*) filelist="${1#-filelist=}";;
+            esac
+            shift
+        done
+        if [ -n "$filelist" ]; then
+            files=$(cat "$filelist")
+            dest="$1"
+        else
+            files="$1"
+            dest="$2"
+        fi
+        status=0
+        for src in $files; do
+            if grep -qx "$src" "$STORE"; then
+                cp "$FAKE_PDC_DIR/store$src" "$dest"
+                echo "Retrieving          1,024 $src --> $dest$(basename "$src") [Done]"
+            else
+                echo "ANS1092W No files matching search criteria were found"
+                status=8
+            fi
+        done
+        exit $status;;
+    *)
+        exit 12;;
+esac
@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 
+import copy
 import os
 import shutil
+import signal
+import sqlite3
+import subprocess
 import tempfile
+import threading
+import time
 import unittest
 import csv
 
+import mock
+
+from click.testing import CliRunner
+
 from datetime import datetime
+from distutils.spawn import find_executable
 
+from taca.analysis import scheduler
+from taca.analysis.cache import RunMetadataCache
+from taca.analysis.cli import cache as cache_command
 from taca.analysis.analysis import *
-from taca.illumina.Runs import Run
-from taca.illumina.HiSeqX_Runs import HiSeqX_Run
+from taca.analysis.watch import RunWatcher
+from taca.illumina.Runs import Run, RunStatusSnapshot, TRANSFER_MANIFEST, _shard_files
 from taca.utils import config as conf
+from taca.utils import misc, rsync
+from taca.utils.ledger import TransferMetrics
 
 
 # This is only run if TACA is called from the CLI, as this is a test, we need to
@@ -86,18 +102,18 @@ class TestTracker(unittest.TestCase):
         
         # Create run objects
         # Jose : add tests for other sequencers
-        self.running = HiSeqX_Run(os.path.join(self.tmp_dir, 
-                                               '141124_ST-RUNNING1_03_AFCIDXX'), 
-                                  CONFIG["analysis"]["HiSeqX"])
+        self.running = Run(os.path.join(self.tmp_dir, 
+                                        '141124_ST-RUNNING1_03_AFCIDXX'), 
+                           CONFIG["analysis"]["NextSeq"])
         self.to_start = Run(os.path.join(self.tmp_dir, 
                                          '141124_ST-TOSTART1_04_FCIDXXX'), 
-                            CONFIG["analysis"]["HiSeqX"])
+                            CONFIG["analysis"]["NextSeq"])
         self.in_progress = Run(os.path.join(self.tmp_dir, 
                                             '141124_ST-INPROGRESS1_02_AFCIDXX'), 
-                               CONFIG["analysis"]["HiSeqX"])
+                               CONFIG["analysis"]["NextSeq"])
         self.completed = Run(os.path.join(self.tmp_dir, 
                                           '141124_ST-COMPLETED1_01_AFCIDXX'), 
-                             CONFIG["analysis"]["HiSeqX"])
+                             CONFIG["analysis"]["NextSeq"])
         self.finished_runs = [self.to_start, self.in_progress, self.completed]
         self.transfer_file = os.path.join(self.tmp_dir, 'transfer.tsv')
 
@@ -127,5 +143,472 @@ class TestTracker(unittest.TestCase):
         self.assertFalse(self.to_start.is_transferred(self.transfer_file))
         self.assertFalse(self.in_progress.is_transferred( self.transfer_file))
 
+    def test_4_status_snapshot(self):
+        """ A status snapshot should agree with the individual status checks
+        """
+        for run in [self.running] + self.finished_runs:
+            self.assertEqual(run.get_run_status(), run.get_status_snapshot().status)
+        snapshots = RunStatusSnapshot.for_data_dir(self.tmp_dir)
+        self.assertEqual('COMPLETED', snapshots[self.completed.run_dir].status)
+        self.assertEqual('SEQUENCING', snapshots[self.running.run_dir].status)
+
+class TestTransfer(unittest.TestCase):
+    """ Run.transfer_run tests, transferring to a local directory
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, '141124_ST-COMPLETED1_01_AFCIDXX')
+        self.archive = os.path.join(self.tmp_dir, 'archive')
+        self.transfer_file = os.path.join(self.tmp_dir, 'transfer.tsv')
+        os.makedirs(self.archive)
+        for path in ['Demultiplexing/Project_A/Sample_1/S1_S1_L001_R1_001.fastq.gz',
+                     'Demultiplexing/Project_A/Sample_1/S1_S1_L002_R1_001.fastq.gz',
+                     'Demultiplexing/Project_B/Sample_2/S2_S2_L001_R1_001.fastq.gz',
+                     'Demultiplexing_0/Project_A/Sample_1/S1_S1_L001_R1_001.fastq.gz',
+                     'Data/Intensities/BaseCalls/L001/C1.1/s_1_1101.bcl.gz',
+                     'Data/Intensities/BaseCalls/Undetermined_S0_L001_R1_001.fastq.gz']:
+            if not os.path.isdir(os.path.dirname(os.path.join(self.run_dir, path))):
+                os.makedirs(os.path.dirname(os.path.join(self.run_dir, path)))
+            with open(os.path.join(self.run_dir, path), 'w') as fh:
+                fh.write('x' * len(path))
+        shutil.copy('data/runParameters.xml', self.run_dir)
+        self.config = copy.deepcopy(CONFIG['analysis']['NextSeq'])
+        self.config['analysis_server']['sync'] = {'data_archive': self.archive,
+                                                  'include': ['*.fastq.gz', 'runParameters.xml', '*.txt'],
+                                                  'skip_dirs': ['Data/Intensities'],
+                                                  'shards': 2}
+        self.run = Run(self.run_dir, self.config)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_transfer_files(self):
+        """ The files to transfer are selected with the rsync filter rules, without walking skip_dirs
+        """
+        open(os.path.join(self.run_dir, TRANSFER_MANIFEST), 'w').close()
+        self.assertEqual([path for path, _ in self.run._transfer_files()],
+                         [os.path.join(self.run.id, path) for path in
+                          ['Demultiplexing/Project_A/Sample_1/S1_S1_L001_R1_001.fastq.gz',
+                           'Demultiplexing/Project_A/Sample_1/S1_S1_L002_R1_001.fastq.gz',
+                           'Demultiplexing/Project_B/Sample_2/S2_S2_L001_R1_001.fastq.gz',
+                           'runParameters.xml']])
+
+    def test_shard_files(self):
+        """ Shards are balanced by size and keep lanes or projects together
+        """
+        files = [('R/D/P1/a_L001_R1', 10), ('R/D/P1/b_L002_R1', 6), ('R/D/P2/c_L001_R1', 5), ('R/x', 1)]
+        self.assertEqual(_shard_files(files, 2), [['R/D/P1/a_L001_R1', 'R/x'],
+                                                  ['R/D/P1/b_L002_R1', 'R/D/P2/c_L001_R1']])
+        self.assertEqual(_shard_files(files, 3, shard_by='lane'), [['R/D/P1/a_L001_R1', 'R/D/P2/c_L001_R1'],
+                                                                   ['R/D/P1/b_L002_R1'], ['R/x']])
+        self.assertEqual(_shard_files(files, 2, shard_by='project', demux_dir='D'),
+                         [['R/D/P1/a_L001_R1', 'R/D/P1/b_L002_R1'], ['R/D/P2/c_L001_R1', 'R/x']])
+
+    @unittest.skipIf(not find_executable('rsync'), "rsync is not available")
+    def test_transfer_sharded(self):
+        """ A sharded transfer sends every selected file and records the run
+        """
+        self.run.transfer_run(self.transfer_file)
+        for path, _ in self.run._transfer_files():
+            self.assertTrue(os.path.exists(os.path.join(self.archive, path)))
+        self.assertFalse(os.path.exists(os.path.join(self.archive, self.run.id, 'Demultiplexing_0')))
+        self.assertTrue(self.run.is_transferred(self.transfer_file))
+        metrics = TransferMetrics(os.path.join(self.tmp_dir, 'transfer_metrics.db')).query(self.run.id)
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0]['shards'], 2)
+        self.assertFalse(os.path.exists(os.path.join(self.run_dir, 'transferring')))
+
+    def test_reset_demultiplexing(self):
+        """ Failed demultiplexing folders are moved aside and not transferred
+        """
+        self.assertEqual(self.run.reset_demultiplexing(), os.path.join(self.run_dir, 'Demultiplexing.failed.1'))
+        self.assertFalse(os.path.exists(os.path.join(self.run_dir, 'Demultiplexing')))
+        self.assertEqual([path for path, _ in self.run._transfer_files()],
+                         [os.path.join(self.run.id, 'runParameters.xml')])
+
+    @unittest.skipIf(not find_executable('rsync'), "rsync is not available")
+    def test_transfer(self):
+        """ A single rsync process sends the files listed in the run manifest
+        """
+        self.config['analysis_server']['sync']['shards'] = 1
+        self.run.transfer_run(self.transfer_file)
+        with open(os.path.join(self.run_dir, TRANSFER_MANIFEST)) as fh:
+            manifest = fh.read().splitlines()
+        self.assertEqual(manifest, [path for path, _ in self.run._transfer_files()])
+        for path in manifest:
+            self.assertTrue(os.path.exists(os.path.join(self.archive, path)))
+        self.assertFalse(os.path.exists(os.path.join(self.archive, self.run.id, 'Data')))
+        self.assertTrue(self.run.is_transferred(self.transfer_file))
+
+    @unittest.skipIf(not find_executable('rsync'), "rsync is not available")
+    def test_transfer_latency_probe(self):
+        """ The latency of the storage is not measured inside the run folder being transferred
+        """
+        self.config['analysis_server']['sync']['bandwidth'] = {'adaptive': True}
+        with mock.patch('taca.utils.bandwidth.storage_latency', return_value=0.01) as latency:
+            self.run.transfer_run(self.transfer_file)
+        latency.assert_called_once_with(self.tmp_dir)
+        self.config['analysis_server']['sync']['bandwidth']['probe_dir'] = self.archive
+        with mock.patch('taca.utils.bandwidth.storage_latency', return_value=0.01) as latency:
+            self.run.transfer_run(self.transfer_file)
+        latency.assert_called_once_with(self.archive)
+
+    @unittest.skipIf(not find_executable('rsync'), "rsync is not available")
+    def test_transfer_record_failure(self):
+        """ The run is recorded as transferred even if its throughput cannot be recorded
+        """
+        with mock.patch('taca.utils.bandwidth.BandwidthController.record', side_effect=OSError(13, 'denied')):
+            self.run.transfer_run(self.transfer_file)
+        self.assertTrue(self.run.is_transferred(self.transfer_file))
+        self.assertFalse(os.path.exists(os.path.join(self.run_dir, 'transferring')))
+
+    @unittest.skipIf(not find_executable('rsync'), "rsync is not available")
+    def test_transfer_sharded_failure(self):
+        """ The run is not recorded as transferred if any shard fails
+        """
+        call = rsync.call_rsync
+        def fail_second_shard(cl, **kwargs):
+            if kwargs.get('prefix') == 'shard2':
+                raise subprocess.CalledProcessError(23, cl)
+            return call(cl, **kwargs)
+        with mock.patch('taca.utils.rsync.call_rsync', side_effect=fail_second_shard):
+            self.assertRaises(subprocess.CalledProcessError, self.run.transfer_run, self.transfer_file)
+        self.assertFalse(self.run.is_transferred(self.transfer_file))
+        self.assertFalse(os.path.exists(os.path.join(self.run_dir, 'transferring')))
+        self.assertEqual(TransferMetrics(os.path.join(self.tmp_dir, 'transfer_metrics.db')).query(), [])
+
+class FakeDemuxRun(object):
+    """ Stands for a run whose demultiplexing is a shell command """
+    def __init__(self, run_id, command, run_dir):
+        self.id = run_id
+        self.command = command
+        self.run_dir = run_dir
+        self.threads = None
+
+    def demultiplex_run(self, threads=None, exit_status_file=None):
+        self.threads = threads
+        # Log files rather than sys.stdout, which is not a real file while nose captures the output
+        return misc.call_external_command_detached(['sh', '-c', self.command], with_log_files=True,
+                                                   cwd=self.run_dir, exit_status_file=exit_status_file)
+
+class TestDemuxScheduler(unittest.TestCase):
+    """ scheduler.py tests
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scheduler = scheduler.DemuxScheduler(os.path.join(self.tmp_dir, 'demux_jobs.db'),
+                                                  max_jobs=2, cores=16, max_retries=1)
+
+    def tearDown(self):
+        for handle in self.scheduler._handles.values():
+            if handle.poll() is None:
+                handle.kill()
+                handle.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def exit_file(self, run):
+        return os.path.join(self.tmp_dir, '{}.exit'.format(run.id))
+
+    def wait_for(self, run, status):
+        for _ in range(100):
+            if self.scheduler.check(run.id) == status:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_slots(self):
+        """ Jobs only start when there is a free slot, and get their share of the cores
+        """
+        runs = [FakeDemuxRun('run{}'.format(i), 'sleep 30', self.tmp_dir) for i in range(3)]
+        self.assertTrue(self.scheduler.start(runs[0], self.exit_file(runs[0])))
+        self.assertTrue(self.scheduler.start(runs[1], self.exit_file(runs[1])))
+        self.assertFalse(self.scheduler.start(runs[2], self.exit_file(runs[2])))
+        self.assertEqual(runs[0].threads, {'loading-threads': 2, 'processing-threads': 8, 'writing-threads': 2})
+        self.assertEqual(self.scheduler.check('run0'), scheduler.RUNNING)
+        self.assertIsNone(self.scheduler.check('run2'))
+        # A job that is killed is noticed and frees its slot
+        os.kill(self.scheduler.job('run0')['pid'], signal.SIGKILL)
+        self.assertTrue(self.wait_for(runs[0], scheduler.DEAD))
+        self.assertTrue(self.scheduler.can_retry('run0'))
+        self.assertTrue(self.scheduler.start(runs[2], self.exit_file(runs[2])))
+
+    def test_exit_status(self):
+        """ The exit status of the jobs is recorded, failed jobs are retried a limited number of times
+        """
+        done, failed = FakeDemuxRun('done', 'true', self.tmp_dir), FakeDemuxRun('failed', 'exit 3', self.tmp_dir)
+        self.scheduler.start(done, self.exit_file(done))
+        self.scheduler.start(failed, self.exit_file(failed))
+        self.assertTrue(self.wait_for(done, scheduler.DONE))
+        self.assertTrue(self.wait_for(failed, scheduler.FAILED))
+        self.assertEqual(self.scheduler.job('failed')['exit_status'], 3)
+        self.assertFalse(self.scheduler.can_retry('done'))
+        self.assertTrue(self.scheduler.can_retry('failed'))
+        self.scheduler.start(failed, self.exit_file(failed))
+        self.assertTrue(self.wait_for(failed, scheduler.FAILED))
+        self.assertEqual(self.scheduler.job('failed')['attempts'], 2)
+        self.assertFalse(self.scheduler.can_retry('failed'))
+
+class TestWatcher(unittest.TestCase):
+    """ watch.py and watch_runs tests
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.tmp_dir, 'data')
+        os.makedirs(self.data_dir)
+        self.watcher = RunWatcher([self.data_dir], use_inotify=False)
+        self.scheduler = scheduler.DemuxScheduler(os.path.join(self.tmp_dir, 'demux_jobs.db'), max_jobs=1)
+
+    def tearDown(self):
+        for handle in self.scheduler._handles.values():
+            if handle.poll() is None:
+                handle.kill()
+                handle.wait()
+        shutil.rmtree(self.tmp_dir)
+
+    def new_run(self, name='141124_ST-RUNNING1_03_AFCIDXX'):
+        run_dir = os.path.join(self.data_dir, name)
+        os.makedirs(run_dir)
+        return run_dir
+
+    def test_scan(self):
+        """ New runs and runs whose status markers changed are reported
+        """
+        self.assertEqual(self.watcher.scan(), [])
+        run_dir = self.new_run()
+        # Not a run folder
+        os.makedirs(os.path.join(self.data_dir, 'nosync'))
+        self.assertEqual(self.watcher.scan(), [run_dir])
+        self.assertEqual(self.watcher.scan(), [])
+        open(os.path.join(run_dir, 'RTAComplete.txt'), 'w').close()
+        self.assertEqual(self.watcher.scan(), [run_dir])
+        os.makedirs(os.path.join(run_dir, 'Demultiplexing', 'Stats'))
+        self.assertEqual(self.watcher.scan(), [run_dir])
+        self.assertEqual(self.watcher.scan(), [])
+        # Only the Stats folder changes, the mtime of the run folder stays the same
+        run_mtime = os.stat(run_dir).st_mtime
+        open(os.path.join(run_dir, 'Demultiplexing', 'Stats', 'DemultiplexingStats.xml'), 'w').close()
+        self.assertEqual(os.stat(run_dir).st_mtime, run_mtime)
+        self.assertEqual(self.watcher.scan(), [run_dir])
+        self.assertEqual(self.watcher.scan(), [])
+        self.assertEqual(self.watcher.run_dirs(), [run_dir])
+
+    def test_run_moved_away(self):
+        """ Runs moved away are forgotten
+        """
+        run_dir = self.new_run()
+        self.watcher.scan()
+        os.rename(run_dir, os.path.join(self.tmp_dir, os.path.basename(run_dir)))
+        self.assertEqual(self.watcher.scan(), [])
+        self.assertEqual(self.watcher.run_dirs(), [])
+        # Moved between the listing of the data directory and its snapshot
+        run_dir = self.new_run('141124_ST-TOSTART1_04_FCIDXXX')
+        with mock.patch('taca.analysis.watch.RunStatusSnapshot', side_effect=OSError(2, 'No such file')):
+            self.assertEqual(self.watcher.scan(), [])
+
+    def test_without_inotify(self):
+        """ The watcher polls when pyinotify is not available
+        """
+        with mock.patch('taca.analysis.watch.pyinotify', None):
+            watcher = RunWatcher([self.data_dir])
+        self.assertIsNone(watcher._notifier)
+        with mock.patch('time.sleep') as sleep:
+            watcher.wait(30)
+        sleep.assert_called_once_with(30)
+
+    def watch(self, steps, rescan=3600, process=None):
+        """ Run watch_runs with a fake clock, calling steps[i] on the i-th wait
+            :returns list: Run folders processed, in order
+        """
+        processed = []
+        process = process or (lambda run_dir, cache: processed.append(run_dir))
+        clock = [0]
+        def fake_wait(timeout):
+            if not steps:
+                raise KeyboardInterrupt
+            steps.pop(0)()
+            clock[0] += timeout
+        with mock.patch.dict(CONFIG['analysis'], {'data_dirs': [self.data_dir], 'status_dir': self.tmp_dir}), \
+             mock.patch('taca.analysis.analysis._demux_scheduler', self.scheduler), \
+             mock.patch('taca.analysis.analysis._process_run_dir', side_effect=process), \
+             mock.patch('taca.analysis.watch.RunWatcher.wait', side_effect=fake_wait), \
+             mock.patch('time.time', side_effect=lambda: clock[0]):
+            watch_runs(interval=60, workers=1, rescan=rescan)
+        return processed
+
+    def test_watch_rescan(self):
+        """ All runs are processed again after rescan seconds even if they did not change
+        """
+        run_dir = self.new_run()
+        wait = lambda: time.sleep(0.1)
+        self.assertEqual(self.watch([wait, wait, wait, wait], rescan=120), [run_dir, run_dir, run_dir])
+
+    def test_watch_requeue(self):
+        """ Runs that change while being processed are processed again afterwards
+        """
+        run_dir = self.new_run()
+        started, release = threading.Event(), threading.Event()
+        processed = []
+        def process(run_dir, cache):
+            processed.append(run_dir)
+            started.set()
+            release.wait(10)
+        def run_done():
+            started.wait(10)
+            os.makedirs(os.path.join(run_dir, 'Demultiplexing', 'Stats'))
+            open(os.path.join(run_dir, 'Demultiplexing', 'Stats', 'DemultiplexingStats.xml'), 'w').close()
+            open(os.path.join(run_dir, 'RTAComplete.txt'), 'w').close()
+        def finish():
+            release.set()
+            time.sleep(0.2)
+        self.watch([run_done, finish, finish], process=process)
+        self.assertEqual(processed, [run_dir, run_dir])
+
+    def test_watch_error(self):
+        """ Errors processing a run in the background are logged
+        """
+        run_dir = self.new_run()
+        def process(run_dir, cache):
+            raise ValueError('cannot parse runParameters.xml')
+        with mock.patch('taca.analysis.analysis.logger') as log:
+            self.watch([lambda: time.sleep(0.1)], process=process)
+        self.assertEqual(log.error.call_count, 1)
+        self.assertIn(run_dir, log.error.call_args[0][0])
+        self.assertIn('cannot parse runParameters.xml', log.error.call_args[0][0])
+
+    def test_watch_waiting(self):
+        """ Runs waiting for a demultiplexing slot are processed on every scan, and
+            start once the slot frees up
+        """
+        first = self.new_run('141124_ST-TOSTART1_04_FCIDXXX')
+        second = self.new_run('141124_ST-TOSTART2_05_FCIDXXX')
+        for run_dir in (first, second):
+            open(os.path.join(run_dir, 'RTAComplete.txt'), 'w').close()
+        started = []
+        def process(run_dir, cache):
+            run = FakeDemuxRun(os.path.basename(run_dir), 'sleep 0.3', run_dir)
+            if os.path.exists(os.path.join(run_dir, 'Demultiplexing')):
+                self.scheduler.check(run.id)
+            elif self.scheduler.start(run, os.path.join(self.tmp_dir, '{}.exit'.format(run.id))):
+                os.makedirs(os.path.join(run_dir, 'Demultiplexing'))
+                started.append(run_dir)
+        wait = lambda: time.sleep(0.2)
+        self.watch([wait] * 6, process=process)
+        self.assertEqual(started, [first, second])
+        self.assertEqual(self.scheduler.job(os.path.basename(first))['status'], scheduler.DONE)
+        self.assertEqual(self.scheduler.job(os.path.basename(second))['attempts'], 1)
+
+    def test_watch_not_waiting(self):
+        """ Runs sequencing, or whose demultiplexing is done, are not processed again until they change
+        """
+        run_dir = self.new_run()
+        done = self.new_run('141124_ST-COMPLETED1_02_AFCIDXX')
+        os.makedirs(os.path.join(done, 'Demultiplexing'))
+        open(os.path.join(done, 'RTAComplete.txt'), 'w').close()
+        self.scheduler._connect().execute("INSERT INTO jobs (run, status) VALUES (?, ?)",
+                                          (os.path.basename(done), scheduler.DONE))
+        wait = lambda: time.sleep(0.1)
+        self.assertEqual(sorted(self.watch([wait, wait, wait])), sorted([run_dir, done]))
+
+class TestMetadataCache(unittest.TestCase):
+    """ cache.py tests
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.run_dir = os.path.join(self.tmp_dir, '141124_NS500001_01_AFCIDXX')
+        os.makedirs(self.run_dir)
+        shutil.copy('data/runParameters.xml', self.run_dir)
+        with open(os.path.join(self.run_dir, 'SampleSheet.csv'), 'w') as fh:
+            fh.write('[Header]\nDescription,Production\n')
+        self.cache = RunMetadataCache(os.path.join(self.tmp_dir, 'run_metadata.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def change(self, name):
+        # Same size and a later mtime would not do on file systems with coarse mtimes
+        with open(os.path.join(self.run_dir, name), 'a') as fh:
+            fh.write('\n')
 
+    def test_hit(self):
+        """ The cached metadata is returned while the run does not change
+        """
+        self.assertIsNone(self.cache.get(self.run_dir))
+        self.cache.put(self.run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+        self.assertEqual(self.cache.get(self.run_dir), {'sequencer_type': 'NextSeq', 'run_type': 'NGI-RUN'})
+
+    def test_stale(self):
+        """ Entries are not used after runParameters.xml or SampleSheet.csv change
+        """
+        for name in ['runParameters.xml', 'SampleSheet.csv']:
+            self.cache.put(self.run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+            self.change(name)
+            self.assertIsNone(self.cache.get(self.run_dir))
+        self.assertEqual(self.cache.stats(), {'entries': 1, 'valid': 0, 'stale': 1, 'orphan': 0})
 
+    def test_deleted_run(self):
+        """ Entries of runs that are gone are neither used nor valid
+        """
+        self.cache.put(self.run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+        shutil.rmtree(self.run_dir)
+        self.assertIsNone(self.cache.get(self.run_dir))
+        self.assertEqual(self.cache.stats(), {'entries': 1, 'valid': 0, 'stale': 0, 'orphan': 1})
+
+    def test_stats(self):
+        """ Entries are counted as valid, stale or orphan
+        """
+        other = os.path.join(self.tmp_dir, '141125_NS500001_02_AFCIDXX')
+        shutil.copytree(self.run_dir, other)
+        gone = os.path.join(self.tmp_dir, '141126_NS500001_03_AFCIDXX')
+        shutil.copytree(self.run_dir, gone)
+        for run_dir in [self.run_dir, other, gone]:
+            self.cache.put(run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+        self.change('SampleSheet.csv')
+        shutil.rmtree(gone)
+        self.assertEqual(self.cache.stats(), {'entries': 3, 'valid': 1, 'stale': 1, 'orphan': 1})
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(), {'entries': 0, 'valid': 0, 'stale': 0, 'orphan': 0})
+
+    def test_old_database(self):
+        """ Databases with the columns of older versions can still be written
+        """
+        db_file = os.path.join(self.tmp_dir, 'old.db')
+        conn = sqlite3.connect(db_file)
+        conn.execute("CREATE TABLE runs (path TEXT PRIMARY KEY, signature TEXT, sequencer_type TEXT, "
+                     "run_type TEXT, flowcell_id TEXT, demux_dir TEXT, updated TEXT)")
+        conn.close()
+        cache = RunMetadataCache(db_file)
+        cache.put(self.run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+        self.assertEqual(cache.get(self.run_dir), {'sequencer_type': 'NextSeq', 'run_type': 'NGI-RUN'})
+
+    def test_get_runObj(self):
+        """ runParameters.xml and the sample sheet are only parsed when the cache misses
+        """
+        with mock.patch.dict(CONFIG['analysis'], {'NextSeq': {}}), \
+             mock.patch('taca.analysis.analysis._parse_run_type', return_value='NextSeq') as parse, \
+             mock.patch('taca.analysis.analysis.NextSeq_Run') as run_class:
+            run_class.return_value.run_type = 'NGI-RUN'
+            get_runObj(self.run_dir, cache=self.cache)
+            run_class.assert_called_once_with(self.run_dir, {}, run_type=None)
+            self.assertEqual(self.cache.get(self.run_dir), {'sequencer_type': 'NextSeq', 'run_type': 'NGI-RUN'})
+            run_class.reset_mock()
+            get_runObj(self.run_dir, cache=self.cache)
+            run_class.assert_called_once_with(self.run_dir, {}, run_type='NGI-RUN')
+            self.assertEqual(parse.call_count, 1)
+
+    def test_cli(self):
+        """ The cache command shows the statistics and rebuilds the cache
+        """
+        self.cache.put(self.run_dir, sequencer_type='NextSeq', run_type='NGI-RUN')
+        runner = CliRunner()
+        with mock.patch.dict(CONFIG['analysis'], {'metadata_cache': self.cache.db_file}):
+            result = runner.invoke(cache_command, [])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(result.output, 'entries\t1\nvalid\t1\nstale\t0\norphan\t0\n')
+            with mock.patch('taca.analysis.analysis.get_run_dirs', return_value=[]):
+                result = runner.invoke(cache_command, ['--rebuild', '--stats'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('entries\t0\n', result.output)
+        with mock.patch.dict(CONFIG['analysis'], {'metadata_cache': None, 'status_dir': None}):
+            result = runner.invoke(cache_command, ['--rebuild'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('No status_dir or metadata_cache', result.output)
@@ -0,0 +1,669 @@
+""" Unit tests for the backup utilities """
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+
+import mock
+
+from taca.backup.backup import GEN_KEY_CMD, backup_utils, run_vars
+from taca.utils import config as conf
+from taca.utils import filesystem
+
+# This is only run if TACA is called from the CLI, as this is a test, we need to
+# call it explicitely
+CONFIG = conf.load_yaml_config('data/taca_test_cfg.yaml')
+
+def stop_gpg_agent():
+    """ Stop the gpg-agent of the temporary GNUPGHOME before it is removed, the agent
+        removes its sockets when it goes away and that could race the removal """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(['gpgconf', '--kill', 'gpg-agent'], stdout=devnull, stderr=devnull)
+    os.environ.pop('GNUPGHOME')
+
+class TestPdc(unittest.TestCase):
+    """ Test class for the PDC related utilities, using a fake dsmc """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_backup")
+        os.environ['FAKE_PDC_DIR'] = self.rootdir
+        self.archive_dir = os.path.join(self.rootdir, 'archive')
+        self.keys_dir = os.path.join(self.rootdir, 'keys')
+        os.makedirs(self.archive_dir)
+        os.makedirs(self.keys_dir)
+        config = mock.patch.dict(CONFIG['backup'], data_dirs=[], archive_dirs=[self.archive_dir],
+                                 keys_path=self.keys_dir, dsmc=os.path.abspath('data/fake_dsmc.sh'),
+                                 size_cache=os.path.join(self.rootdir, 'dir_sizes.db'),
+                                 pdc_retries=2, pdc_retry_delay=0)
+        config.start()
+        self.addCleanup(config.stop)
+        self.archived = os.path.join(self.archive_dir, '170101_NB501234_0001_AHXXXXBGXX.tar.gz.gpg')
+        self.not_archived = os.path.join(self.archive_dir, '170102_NB501234_0002_AHXXXXBGXX.tar.gz.gpg')
+        with open(os.path.join(self.rootdir, 'archive.txt'), 'w') as fh:
+            fh.write('{}\n'.format(self.archived))
+
+    def tearDown(self):
+        os.environ.pop('FAKE_PDC_FAIL', None)
+        shutil.rmtree(self.rootdir)
+
+    def dsmc_calls(self):
+        with open(os.path.join(self.rootdir, 'calls.txt')) as fh:
+            return fh.readlines()
+
+    def test_query_pdc(self):
+        """ Archived files are parsed from the dsmc output """
+        bk = backup_utils()
+        self.assertEqual(bk.query_pdc(os.path.join(self.archive_dir, '*')),
+                         {self.archived: (1024, '01/02/2017 10:00:00')})
+        self.assertEqual(bk.query_pdc(os.path.join(self.keys_dir, '*')), {})
+
+    def test_file_in_pdc(self):
+        """ Files in the same directory are checked with a single dsmc call """
+        bk = backup_utils()
+        self.assertTrue(bk.file_in_pdc(self.archived))
+        self.assertFalse(bk.file_in_pdc(self.not_archived))
+        self.assertEqual(len(self.dsmc_calls()), 1)
+
+    def test_refresh_pdc_index(self):
+        """ Newly archived files are found after refreshing the index """
+        bk = backup_utils()
+        self.assertFalse(bk.file_in_pdc(self.not_archived))
+        with open(os.path.join(self.rootdir, 'archive.txt'), 'a') as fh:
+            fh.write('{}\n'.format(self.not_archived))
+        self.assertFalse(bk.file_in_pdc(self.not_archived))
+        bk.refresh_pdc_index(self.archive_dir)
+        self.assertTrue(bk.file_in_pdc(self.not_archived))
+
+    def test_verify_in_pdc(self):
+        """ Every poll queries PDC once per directory """
+        bk = backup_utils()
+        self.assertTrue(bk._verify_in_pdc([self.archived]))
+        self.assertEqual(len(self.dsmc_calls()), 1)
+        other = os.path.join(self.archive_dir, '170103_NB501234_0003_AHXXXXBGXX.tar.gz.gpg')
+        self.assertFalse(bk._verify_in_pdc([self.archived, self.not_archived, other]))
+        # pdc_retries + 2 polls
+        self.assertEqual(len(self.dsmc_calls()), 1 + 4)
+        self.assertTrue(bk.file_in_pdc(self.archived))
+        self.assertEqual(len(self.dsmc_calls()), 5)
+
+    def test_pdc_index_threads(self):
+        """ The index can be refreshed and read from several threads at once """
+        bk = backup_utils()
+        def refresh_and_check(_):
+            bk.refresh_pdc_index(self.archive_dir)
+            return bk.file_in_pdc(self.archived)
+        pool = ThreadPool(4)
+        try:
+            self.assertTrue(all(pool.map(refresh_and_check, range(20))))
+        finally:
+            pool.close()
+            pool.join()
+        # Another thread refreshing the index right after the query was stored
+        class RefreshedIndex(dict):
+            def __setitem__(self, directory, archived):
+                dict.__setitem__(self, directory, archived)
+                self.pop(directory)
+        bk.pdc_index = RefreshedIndex()
+        self.assertTrue(bk.file_in_pdc(self.archived))
+
+    def encrypted_run(self, name):
+        """ Create the encrypted archive and key of a run ready to be sent """
+        zip_encrypted = os.path.join(self.archive_dir, '{}.tar.gz.gpg'.format(name))
+        key_encrypted = os.path.join(self.keys_dir, '{}.key.gpg'.format(name))
+        for fl in [zip_encrypted, key_encrypted]:
+            open(fl, 'w').close()
+        return zip_encrypted, key_encrypted
+
+    def test_pdc_put(self):
+        """ Runs are archived concurrently, verified and removed locally """
+        runs = ['170103_NB501234_0003_AHXXXXBGXX', '170104_NB501234_0004_AHXXXXBGXX']
+        files = [self.encrypted_run(name) for name in runs]
+        summary = backup_utils.pdc_put(None, sessions=2)
+        self.assertEqual(sorted(summary.keys()), runs)
+        for name, (zip_encrypted, key_encrypted) in zip(runs, files):
+            self.assertEqual(summary[name][0], 'archived')
+            self.assertFalse(os.path.exists(zip_encrypted))
+            self.assertFalse(os.path.exists(key_encrypted))
+            self.assertFalse(os.path.exists(os.path.join(self.archive_dir, '{}.archiving'.format(name))))
+        self.assertTrue(backup_utils().file_in_pdc(files[0][0]))
+
+    @mock.patch('taca.backup.backup.misc.send_mail')
+    def test_pdc_put_failed(self, send_mail):
+        """ Failed archive calls are retried and the files are kept locally """
+        zip_encrypted, key_encrypted = self.encrypted_run('170103_NB501234_0003_AHXXXXBGXX')
+        os.environ['FAKE_PDC_FAIL'] = zip_encrypted
+        summary = backup_utils.pdc_put(zip_encrypted.replace('.tar.gz.gpg', ''))
+        self.assertTrue(send_mail.called)
+        self.assertEqual(summary['170103_NB501234_0003_AHXXXXBGXX'][0], 'failed')
+        self.assertEqual(len([c for c in self.dsmc_calls() if c.startswith('archive')]), 2)
+        self.assertTrue(os.path.exists(zip_encrypted))
+        self.assertTrue(os.path.exists(key_encrypted))
+
+    def test_pdc_put_already_archived(self):
+        """ Runs already in PDC are skipped """
+        zip_encrypted, key_encrypted = self.encrypted_run('170101_NB501234_0001_AHXXXXBGXX')
+        summary = backup_utils.pdc_put(None)
+        self.assertEqual(summary['170101_NB501234_0001_AHXXXXBGXX'][0], 'skipped')
+        self.assertTrue(os.path.exists(zip_encrypted))
+        self.assertFalse([c for c in self.dsmc_calls() if c.startswith('archive')])
+
+    def test_pdc_put_chunked(self):
+        """ Parts of a chunked run already in PDC are not sent again """
+        run = run_vars(os.path.join(self.archive_dir, '170103_NB501234_0003_AHXXXXBGXX'))
+        chunks_dir = os.path.join(self.archive_dir, run.chunks)
+        os.makedirs(chunks_dir)
+        with open(os.path.join(chunks_dir, run.manifest), 'w') as fh:
+            fh.write('# chunk_size 10\n')
+            for index in range(6):
+                open(os.path.join(chunks_dir, run.part(index)), 'w').close()
+                fh.write('{}\t10\tmd5\n'.format(run.part(index)))
+        open(os.path.join(self.keys_dir, run.key_encrypted), 'w').close()
+        # The first part was sent before an interruption
+        os.remove(os.path.join(chunks_dir, run.part(0)))
+        with open(os.path.join(self.rootdir, 'archive.txt'), 'a') as fh:
+            fh.write('{}\n'.format(os.path.join(chunks_dir, run.part(0))))
+        summary = backup_utils.pdc_put(None, sessions=4)
+        self.assertEqual(summary[run.name][0], 'archived')
+        self.assertFalse(os.path.exists(chunks_dir))
+        self.assertEqual(len([c for c in self.dsmc_calls() if c.startswith('archive')]), 7)
+        # Checking what is there already, verifying the parts, verifying the manifest
+        queries = [c for c in self.dsmc_calls() if c.startswith('query') and chunks_dir in c]
+        self.assertEqual(len(queries), 3)
+
+    def test_restore_space(self):
+        """ Restoring needs room for the retrieved files and the extracted run """
+        bk = backup_utils()
+        date = '01/02/2017 10:00:00'
+        run = run_vars(os.path.join(self.archive_dir, '170103_NB501234_0003_AHXXXXBGXX'))
+        key = (os.path.join(self.keys_dir, run.key_encrypted), (10, date))
+        found = dict([(os.path.join(self.archive_dir, run.zip_encrypted), (1000, date)),
+                      (os.path.join(self.archive_dir, run.zip_md5), (50, date)), key])
+        self.assertEqual(bk._restore_space(found), 1060 + 1000)
+        # Only the part being extracted and the next one are on disk at the same time
+        chunks_dir = os.path.join(self.archive_dir, run.chunks)
+        found = dict([(os.path.join(chunks_dir, run.part(index)), (size, date))
+                      for index, size in enumerate([100, 300, 200])] +
+                     [(os.path.join(chunks_dir, run.manifest), (20, date)), key])
+        self.assertEqual(bk._restore_space(found), 530 + 600)
+        # Unless all of them are retrieved at once
+        self.assertEqual(bk._restore_space(found, batch=True), 630 + 600)
+
+    def test_pdc_get_no_space(self):
+        """ Nothing is retrieved if there is no room for the run once extracted """
+        name = '170101_NB501234_0001_AHXXXXBGXX'
+        with open(os.path.join(self.rootdir, 'archive.txt'), 'a') as fh:
+            fh.write('{}\n'.format(os.path.join(self.keys_dir, '{}.key.gpg'.format(name))))
+        outdir = os.path.join(self.rootdir, 'restore')
+        os.makedirs(outdir)
+        # The retrieved files (2 of 1024 bytes in the fake PDC) would fit, the extracted run not
+        with mock.patch('taca.backup.backup.filesystem.disk_free', return_value=3000):
+            self.assertRaises(SystemExit, backup_utils.pdc_get, name, outdir)
+        self.assertFalse([c for c in self.dsmc_calls() if c.startswith('retrieve')])
+
+
+class TestSpace(unittest.TestCase):
+    """ Test class for the disk space estimations """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_space")
+        self.data_dir = os.path.join(self.rootdir, 'data')
+        self.archive_dir = os.path.join(self.rootdir, 'archive')
+        os.makedirs(self.archive_dir)
+        config = mock.patch.dict(CONFIG['backup'], data_dirs=[self.data_dir], archive_dirs=[self.archive_dir],
+                                 keys_path=self.rootdir, ongoing_run_size=1,
+                                 size_cache=os.path.join(self.rootdir, 'dir_sizes.db'))
+        config.start()
+        self.addCleanup(config.stop)
+        # Sequencing, 31 of the 310 cycles in RunInfo.xml written
+        self.cycling = self.create_run('170101_ST-E00214_0001_AHXXXXBGXX', 1000)
+        shutil.copy('data/RunInfo.xml', self.cycling)
+        for cycle in range(1, 32):
+            os.makedirs(os.path.join(self.cycling, 'Data', 'Intensities', 'BaseCalls', 'L001', 'C{}.1'.format(cycle)))
+        # Finished run and a just started run of the same instrument
+        self.create_run('170102_NB501234_0002_AHXXXXBGXX', 3000, finished=True)
+        self.starting = self.create_run('170103_NB501234_0003_AHXXXXBGXX', 10)
+        # Just started run of an instrument without history
+        self.unknown = self.create_run('170104_M01234_0004_000000000-AXXXX', 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def create_run(self, name, size, finished=False):
+        run_dir = os.path.join(self.data_dir, name)
+        os.makedirs(run_dir)
+        with open(os.path.join(run_dir, 'data.bin'), 'wb') as fh:
+            fh.write('x' * size)
+        if finished:
+            open(os.path.join(run_dir, 'RTAComplete.txt'), 'w').close()
+        return run_dir
+
+    def test_ongoing_runs(self):
+        """ The size of the runs being sequenced is estimated from cycles or history """
+        estimates = dict((run_dir, (current, expected, how)) for run_dir, current, expected, how
+                         in backup_utils()._ongoing_runs())
+        self.assertEqual(sorted(estimates.keys()), sorted([self.cycling, self.starting, self.unknown]))
+        current = 1000 + os.path.getsize('data/RunInfo.xml')
+        self.assertEqual(estimates[self.cycling], (current, current * 10, 'cycles 31/310'))
+        self.assertEqual(estimates[self.starting][1], 3000)
+        self.assertEqual(estimates[self.unknown], (10, 1024**3, 'default'))
+        self.assertEqual(backup_utils()._ongoing_runs_size(), current * 9 + 2990 + 1024**3 - 10)
+
+    def test_ongoing_runs_cached(self):
+        """ Only the directories of the runs being sequenced that are still written are listed again """
+        with mock.patch('taca.utils.filesystem.scandir', side_effect=filesystem.scandir) as scandir:
+            backup_utils()._ongoing_runs()
+            listed = scandir.call_count
+            scandir.reset_mock()
+            backup_utils()._ongoing_runs()
+            # The finished run is not listed again, the runs being sequenced were just written
+            self.assertEqual(scandir.call_count, listed - 1)
+            scandir.reset_mock()
+            # Nothing written in the last hour, the runs being sequenced are cached too
+            with mock.patch('time.time', return_value=time.time() + 7200):
+                backup_utils()._ongoing_runs()
+                scandir.reset_mock()
+                estimates = backup_utils()._ongoing_runs()
+            self.assertEqual(scandir.call_count, 0)
+        self.assertEqual(dict(estimate[:2] for estimate in estimates)[self.cycling],
+                         1000 + os.path.getsize('data/RunInfo.xml'))
+
+    def test_required_space(self):
+        """ The space needed comes from the size of the run and what is already encrypted """
+        run_dir = os.path.join(self.archive_dir, '170105_NB501234_0005_AHXXXXBGXX')
+        os.makedirs(run_dir)
+        with open(os.path.join(run_dir, 'data.bin'), 'wb') as fh:
+            fh.write('x' * 1000)
+        run = run_vars(run_dir)
+        bk = backup_utils()
+        self.assertEqual(bk._required_space(run, False), 2000)
+        self.assertEqual(bk._required_space(run, True), 1000)
+        # Partly encrypted in chunks, only the rest of the tar stream is needed
+        os.makedirs(os.path.join(self.archive_dir, run.chunks))
+        partial = os.path.join(self.archive_dir, run.chunks, '{}.partial'.format(run.manifest))
+        with open(partial, 'w') as fh:
+            fh.write('# chunk_size 400\n{}\t400\tmd5\n'.format(run.part(0)))
+        self.assertEqual(bk._required_space(run, False), 600)
+        os.rename(partial, os.path.join(self.archive_dir, run.chunks, run.manifest))
+        self.assertEqual(bk._required_space(run, False), 0)
+        # Zipped, the encrypted file is at most as big as the archive
+        shutil.rmtree(os.path.join(self.archive_dir, run.chunks))
+        shutil.rmtree(run_dir)
+        with open(os.path.join(self.archive_dir, run.zip), 'wb') as fh:
+            fh.write('x' * 300)
+        self.assertEqual(bk._required_space(run, False), 300)
+
+    def test_space_report(self):
+        """ The report shows the ongoing runs and the runs to encrypt per file system """
+        os.makedirs(os.path.join(self.archive_dir, '170105_NB501234_0005_AHXXXXBGXX'))
+        lines = backup_utils.space_report()
+        self.assertTrue(lines[0].startswith('Reserved for 3 run(s) being sequenced'))
+        self.assertTrue(lines[4].startswith('File system of {}'.format(self.archive_dir)))
+        self.assertIn('1 run(s)', lines[4])
+        self.assertTrue(lines[5].startswith('\t170105_NB501234_0005_AHXXXXBGXX'))
+
+
+class TestEncryptRuns(unittest.TestCase):
+    """ Test class for the scheduling of the encryption of several runs """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_encrypt")
+        config = mock.patch.dict(CONFIG['backup'], data_dirs=[], archive_dirs=[self.rootdir], keys_path=self.rootdir,
+                                 size_cache=os.path.join(self.rootdir, 'dir_sizes.db'))
+        config.start()
+        self.addCleanup(config.stop)
+        # Restored with the rest of the configuration when the patch stops
+        CONFIG['backup'].pop('chunk_size', None)
+        self.sizes = {}
+        self.events = []
+        self.running = []
+        self.max_running = 0
+        self.pigz_threads = set()
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def add_run(self, name, size):
+        os.makedirs(os.path.join(self.rootdir, name))
+        self.sizes[name] = size
+
+    def encrypt(self, free=100, cpus=4, workers=None, duration=0.1):
+        """ Run encrypt_runs with runs taking 'duration' seconds to encrypt and needing the
+            space in self.sizes, on a file system with 'free' bytes free
+            :returns tuple: The mock of send_mail and the seconds it took
+        """
+        test = self
+        def fake_encrypt(self, run, force, stream, pigz_threads, chunk_size=None):
+            with test.lock:
+                test.events.append((run.name, 'start'))
+                test.running.append(run.name)
+                test.max_running = max(test.max_running, len(test.running))
+                test.pigz_threads.add(pigz_threads)
+            time.sleep(duration)
+            with test.lock:
+                test.running.remove(run.name)
+                test.events.append((run.name, 'end'))
+            return True
+        start = time.time()
+        with mock.patch.object(backup_utils, '_encrypt_run_safely', fake_encrypt), \
+             mock.patch.object(backup_utils, '_required_space', lambda self, run, stream: test.sizes[run.name]), \
+             mock.patch('taca.backup.backup.filesystem.disk_free', return_value=free), \
+             mock.patch('taca.backup.backup.multiprocessing.cpu_count', return_value=cpus), \
+             mock.patch('taca.backup.backup.misc.send_mail') as send_mail:
+            backup_utils.encrypt_runs(None, False, workers=workers)
+        return send_mail, time.time() - start
+
+    def test_queue_short_of_space(self):
+        """ Runs that do not fit in the free space wait until the runs being encrypted finish """
+        self.add_run('170101_NB501234_0001_AHXXXXBGXX', 60)
+        self.add_run('170102_NB501234_0002_AHXXXXBGXX', 60)
+        self.add_run('170103_NB501234_0003_AHXXXXBGXX', 30)
+        send_mail, _ = self.encrypt(workers=3)
+        self.assertFalse(send_mail.called)
+        self.assertEqual(len(self.events), 6)
+        # Whatever the order, only one of the big runs fits at a time
+        big = [name for name, event in self.events if self.sizes[name] == 60 and event == 'start']
+        second = self.events.index((big[1], 'start'))
+        self.assertIn((big[0], 'end'), self.events[:second])
+        self.assertIn(('170103_NB501234_0003_AHXXXXBGXX', 'start'), self.events[:second])
+        self.assertLessEqual(self.max_running, 2)
+
+    def test_never_fits(self):
+        """ A run that can not fit even when nothing else is encrypted is skipped and reported """
+        self.add_run('170101_NB501234_0001_AHXXXXBGXX', 60)
+        self.add_run('170102_NB501234_0002_AHXXXXBGXX', 200)
+        send_mail, _ = self.encrypt(workers=2)
+        self.assertEqual(self.events, [('170101_NB501234_0001_AHXXXXBGXX', 'start'),
+                                       ('170101_NB501234_0001_AHXXXXBGXX', 'end')])
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertIn('170102_NB501234_0002_AHXXXXBGXX', send_mail.call_args[0][1])
+
+    def test_cpu_cap(self):
+        """ No more runs than CPUs are encrypted at the same time, and pigz gets its share of them """
+        for index in range(1, 5):
+            self.add_run('17010{}_NB501234_000{}_AHXXXXBGXX'.format(index, index), 1)
+        self.encrypt(cpus=2, workers=8)
+        self.assertEqual(len(self.events), 8)
+        self.assertLessEqual(self.max_running, 2)
+        self.assertEqual(self.pigz_threads, set([1]))
+
+    def test_wake_up(self):
+        """ A run waiting for space starts as soon as the run holding it finishes """
+        for index in range(1, 6):
+            self.add_run('17010{}_NB501234_000{}_AHXXXXBGXX'.format(index, index), 60)
+        _, elapsed = self.encrypt(workers=2, duration=0.05)
+        self.assertEqual(len(self.events), 10)
+        self.assertEqual(self.max_running, 1)
+        # Without the wake-up every run would wait for the 60 seconds timeout
+        self.assertLess(elapsed, 30)
+
+
+@unittest.skipIf(not find_executable('gpg'), "gpg is not available")
+class TestStreamEncrypt(unittest.TestCase):
+    """ Test class for the encryption of a run in a single pass """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_stream")
+        os.environ['GNUPGHOME'] = os.path.join(self.rootdir, 'gnupg')
+        os.makedirs(os.environ['GNUPGHOME'], 0700)
+        self.run = run_vars(os.path.join(self.rootdir, '170103_NB501234_0003_AHXXXXBGXX'))
+        os.makedirs(os.path.join(self.rootdir, self.run.name, 'Data'))
+        self.files = {}
+        for name in ['file0', os.path.join('Data', 'file1')]:
+            self.files[name] = os.urandom(20000)
+            with open(os.path.join(self.rootdir, self.run.name, name), 'wb') as fh:
+                fh.write(self.files[name])
+        with open(os.path.join(self.rootdir, self.run.key), 'w') as fh:
+            fh.write('secret')
+
+    def tearDown(self):
+        stop_gpg_agent()
+        shutil.rmtree(self.rootdir)
+
+    def decrypt(self):
+        """ Decrypt and extract the encrypted run in its own directory
+            :returns str: md5sum of the zipped run
+        """
+        zipped = subprocess.check_output(['gpg', '--batch', '--passphrase-file', self.run.key, '-d',
+                                          self.run.zip_encrypted], cwd=self.rootdir, stderr=open(os.devnull, 'w'))
+        out_dir = os.path.join(self.rootdir, 'out')
+        os.makedirs(out_dir)
+        tar = subprocess.Popen(['tar', '-xzf', '-'], cwd=out_dir, stdin=subprocess.PIPE)
+        tar.communicate(zipped)
+        self.assertEqual(tar.returncode, 0)
+        for name, data in self.files.items():
+            with open(os.path.join(out_dir, self.run.name, name), 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+        return hashlib.md5(zipped).hexdigest()
+
+    def test_stream_encrypt(self):
+        """ tar, the compression and gpg are piped into an encrypted file that decrypts back to the run """
+        md5 = backup_utils()._stream_encrypt(self.run, tmp_files=[self.run.zip_encrypted], pigz_cmd='gzip -c')
+        self.assertEqual(self.decrypt(), md5)
+
+    def test_stream_encrypt_zipped(self):
+        """ An already zipped run is streamed into gpg as it is """
+        subprocess.check_call('tar -cf - {} | gzip -c > {}'.format(self.run.name, self.run.zip),
+                              shell=True, cwd=self.rootdir)
+        shutil.rmtree(os.path.join(self.rootdir, self.run.name))
+        md5 = backup_utils()._stream_encrypt(self.run, pigz_cmd='gzip -c')
+        with open(os.path.join(self.rootdir, self.run.zip), 'rb') as fh:
+            self.assertEqual(md5, hashlib.md5(fh.read()).hexdigest())
+        self.assertEqual(self.decrypt(), md5)
+
+    def test_key(self):
+        """ The random key is a single line, gpg would only use the bytes before a new line """
+        key = subprocess.check_output(GEN_KEY_CMD.split())
+        self.assertEqual(key.count('\n'), 1)
+        self.assertTrue(key.endswith('\n'))
+        self.assertGreater(len(key), 256)
+
+    @mock.patch('taca.backup.backup.misc.send_mail')
+    def test_stream_encrypt_failed(self, send_mail):
+        """ A failing command of the pipeline is reported and no encrypted file is left behind """
+        bk = backup_utils()
+        zip_encrypted = os.path.join(self.rootdir, self.run.zip_encrypted)
+        # The compression fails, gpg still gets an empty stream and succeeds
+        self.assertIsNone(bk._stream_encrypt(self.run, pigz_cmd='gzip -c --no-such-option'))
+        self.assertFalse(os.path.exists(zip_encrypted))
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertIn('gzip -c --no-such-option', send_mail.call_args[0][1])
+        # gpg fails half way through
+        os.remove(os.path.join(self.rootdir, self.run.key))
+        self.assertIsNone(bk._stream_encrypt(self.run, pigz_cmd='gzip -c'))
+        self.assertFalse(os.path.exists(zip_encrypted))
+        # The commands before gpg might fail too once it stops reading
+        self.assertEqual(send_mail.call_count, 2)
+
+
+@unittest.skipIf(not find_executable('gpg'), "gpg is not available")
+class TestChunks(unittest.TestCase):
+    """ Test class for the encryption of runs in chunks """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_chunks")
+        os.environ['GNUPGHOME'] = os.path.join(self.rootdir, 'gnupg')
+        os.makedirs(os.environ['GNUPGHOME'], 0700)
+        self.run = run_vars(os.path.join(self.rootdir, '170103_NB501234_0003_AHXXXXBGXX'))
+        os.makedirs(os.path.join(self.rootdir, self.run.name))
+        for index in range(4):
+            with open(os.path.join(self.rootdir, self.run.name, 'file{}'.format(index)), 'wb') as fh:
+                fh.write(os.urandom(5000))
+        with open(os.path.join(self.rootdir, self.run.key), 'w') as fh:
+            fh.write('secret')
+        self.tar = subprocess.check_output(['tar', '-cf', '-', self.run.name], cwd=self.rootdir)
+
+    def tearDown(self):
+        stop_gpg_agent()
+        shutil.rmtree(self.rootdir)
+
+    def decrypt_parts(self, parts):
+        data = ''
+        for part, size, md5 in parts:
+            gpg = subprocess.Popen(['gpg', '--batch', '--passphrase-file', self.run.key, '-d',
+                                    os.path.join(self.run.chunks, part)],
+                                   cwd=self.rootdir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            chunk = subprocess.check_output(['gzip', '-dc'], stdin=gpg.stdout)
+            gpg.wait()
+            self.assertEqual((len(chunk), hashlib.md5(chunk).hexdigest()), (size, md5))
+            data += chunk
+        return data
+
+    def test_chunk_encrypt(self):
+        """ The tar stream is split in parts that are compressed and encrypted on their own """
+        bk = backup_utils()
+        self.assertTrue(bk._chunk_encrypt(self.run, 8192, pigz_cmd='gzip -c'))
+        chunk_size, parts, complete = bk._read_manifest(self.run)
+        self.assertTrue(complete)
+        self.assertEqual(chunk_size, 8192)
+        self.assertEqual(len(parts), len(self.tar) // 8192 + 1)
+        self.assertEqual(self.decrypt_parts(parts), self.tar)
+
+    def test_chunk_encrypt_resume(self):
+        """ An interrupted encryption goes on from the last finished part """
+        bk = backup_utils()
+        self.assertTrue(bk._chunk_encrypt(self.run, 8192, pigz_cmd='gzip -c'))
+        _, parts, _ = bk._read_manifest(self.run)
+        chunks_dir = os.path.join(self.rootdir, self.run.chunks)
+        os.remove(os.path.join(chunks_dir, self.run.manifest))
+        with open(os.path.join(chunks_dir, '{}.partial'.format(self.run.manifest)), 'w') as fh:
+            fh.write('# chunk_size 8192\n{}\t{}\t{}\n'.format(*parts[0]))
+        for part, _, _ in parts[1:]:
+            os.remove(os.path.join(chunks_dir, part))
+        mtime = os.path.getmtime(os.path.join(chunks_dir, parts[0][0]))
+        self.assertTrue(bk._chunk_encrypt(self.run, 8192, pigz_cmd='gzip -c'))
+        self.assertEqual(bk._read_manifest(self.run), (8192, parts, True))
+        self.assertEqual(os.path.getmtime(os.path.join(chunks_dir, parts[0][0])), mtime)
+        self.assertEqual(self.decrypt_parts(parts), self.tar)
+
+
+@unittest.skipIf(not find_executable('gpg') or not find_executable('pigz'), "gpg or pigz is not available")
+class TestRestore(unittest.TestCase):
+    """ Test class for restoring runs from PDC, using a fake dsmc and a throwaway gpg key """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_restore")
+        os.environ['FAKE_PDC_DIR'] = self.rootdir
+        os.environ['GNUPGHOME'] = os.path.join(self.rootdir, 'gnupg')
+        os.makedirs(os.environ['GNUPGHOME'], 0700)
+        subprocess.check_call(['gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+                               CONFIG['backup']['gpg_receiver'], 'future-default', 'default', 'never'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.archive_dir = os.path.join(self.rootdir, 'archive')
+        self.keys_dir = os.path.join(self.rootdir, 'keys')
+        self.outdir = os.path.join(self.rootdir, 'restored')
+        for adir in [self.archive_dir, self.keys_dir, self.outdir]:
+            os.makedirs(adir)
+        config = mock.patch.dict(CONFIG['backup'], data_dirs=[], archive_dirs=[self.archive_dir],
+                                 keys_path=self.keys_dir, dsmc=os.path.abspath('data/fake_dsmc.sh'),
+                                 size_cache=os.path.join(self.rootdir, 'dir_sizes.db'),
+                                 pdc_retries=1, pdc_retry_delay=0)
+        config.start()
+        self.addCleanup(config.stop)
+        self.name = '170103_NB501234_0003_AHXXXXBGXX'
+        self.content = {}
+        self.create_run(self.name)
+
+    def create_run(self, name):
+        os.makedirs(os.path.join(self.archive_dir, name, 'Data'))
+        for fl in ['RunInfo.xml', 'Data/file.bcl']:
+            self.content[(name, fl)] = os.urandom(20000)
+            with open(os.path.join(self.archive_dir, name, fl), 'wb') as fh:
+                fh.write(self.content[(name, fl)])
+
+    def tearDown(self):
+        stop_gpg_agent()
+        shutil.rmtree(self.rootdir)
+
+    def archive(self, chunk_size=None, name=None):
+        name = name or self.name
+        bk = backup_utils()
+        run = run_vars(os.path.join(self.archive_dir, name))
+        self.assertTrue(bk._encrypt_run(run, False, stream=True, chunk_size=chunk_size))
+        self.assertEqual(backup_utils.pdc_put(None)[name][0], 'archived')
+        self.assertFalse(os.listdir(self.archive_dir))
+
+    def assertRestored(self):
+        for (name, fl), content in self.content.items():
+            with open(os.path.join(self.outdir, name, fl), 'rb') as fh:
+                self.assertEqual(fh.read(), content)
+        self.assertEqual(sorted(os.listdir(self.outdir)), sorted(set(name for name, _ in self.content)))
+
+    def test_pdc_get(self):
+        """ A run archived in a single file is restored and checked against its md5sum """
+        self.archive()
+        backup_utils.pdc_get(self.name, outdir=self.outdir)
+        self.assertRestored()
+
+    def test_pdc_get_chunked(self):
+        """ A run archived in chunks is restored part by part """
+        self.archive(chunk_size=8192)
+        backup_utils.pdc_get(self.name, outdir=self.outdir)
+        self.assertRestored()
+
+    def test_pdc_get_runs_file(self):
+        """ The files of several runs are retrieved with a single dsmc call """
+        self.archive(chunk_size=8192)
+        other = '170104_NB501234_0004_AHXXXXBGXX'
+        self.create_run(other)
+        self.archive(name=other)
+        runs_file = os.path.join(self.rootdir, 'runs.txt')
+        with open(runs_file, 'w') as fh:
+            fh.write('{}\n{}.tar.gz.gpg\n'.format(self.name, other))
+        os.remove(os.path.join(self.rootdir, 'calls.txt'))
+        backup_utils.pdc_get(outdir=self.outdir, runs_file=runs_file, workers=2)
+        self.assertRestored()
+        self.assertEqual(len([c for c in self.dsmc_calls() if c.startswith('retrieve')]), 1)
+
+    def dsmc_calls(self):
+        with open(os.path.join(self.rootdir, 'calls.txt')) as fh:
+            return fh.readlines()
+
+    def encrypt(self, chunk_size=None):
+        run = run_vars(os.path.join(self.archive_dir, self.name))
+        self.assertTrue(backup_utils()._encrypt_run(run, False, stream=True, chunk_size=chunk_size))
+        return run
+
+    def test_decrypt_run(self):
+        """ An encrypted run is decrypted into a tar file, checking its md5sum """
+        run = self.encrypt()
+        backup_utils.decrypt_run(os.path.join(self.archive_dir, run.zip_encrypted),
+                                 os.path.join(self.keys_dir, run.key_encrypted), outdir=self.outdir)
+        subprocess.check_call(['tar', '-xf', '{}.tar'.format(self.name)], cwd=self.outdir)
+        os.remove(os.path.join(self.outdir, '{}.tar'.format(self.name)))
+        self.assertRestored()
+
+    def test_decrypt_run_chunked(self):
+        """ A run encrypted in chunks is decrypted and extracted in a single pass """
+        run = self.encrypt(chunk_size=8192)
+        backup_utils.decrypt_run(os.path.join(self.archive_dir, run.chunks),
+                                 os.path.join(self.keys_dir, run.key_encrypted), outdir=self.outdir, extract=True)
+        self.assertRestored()
+
+    def test_decrypt_run_md5_mismatch(self):
+        """ A decrypted run that does not match its md5sum is not kept """
+        run = self.encrypt()
+        with open(os.path.join(self.archive_dir, run.zip_md5), 'w') as fh:
+            fh.write('0123456789abcdef0123456789abcdef  {}\n'.format(run.zip))
+        self.assertRaises(SystemExit, backup_utils.decrypt_run, os.path.join(self.archive_dir, run.zip_encrypted),
+                          os.path.join(self.keys_dir, run.key_encrypted), outdir=self.outdir)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+    def test_pdc_get_corrupted(self):
+        """ A part that does not match the manifest stops the restore """
+        self.archive(chunk_size=8192)
+        with open(os.path.join(self.rootdir, 'store', self.archive_dir.lstrip('/'),
+                               '{}.chunks'.format(self.name), '{}.manifest'.format(self.name)), 'r+') as fh:
+            manifest = fh.read().replace('\t', '\t0', 2)
+            fh.seek(0)
+            fh.write(manifest)
+        self.assertRaises(SystemExit, backup_utils.pdc_get, self.name, self.outdir)
+        self.assertFalse(os.path.exists(os.path.join(self.outdir, '{}.restore'.format(self.name), self.name + '.key')))
@@ -2,9 +2,12 @@
 
 import os
 import shutil
+import subprocess
 import tempfile
 import unittest
-from taca.utils import misc, filesystem
+from taca.utils import bandwidth, misc, filesystem, rsync, ssh
+from taca.utils.checksums import ChecksumCache
+from taca.utils.ledger import TransferLedger, TransferMetrics
 
 class TestMisc():  
     """ Test class for the misc functions """
@@ -41,6 +44,79 @@ class TestMisc():
         """
         assert misc.hashfile(self.hashfile,hasher='sha1') == misc.hashfile(self.hashfile,'sha1')
         
+    def test_copy_stream(self):
+        """ Ensure that copy_stream copies and hashes the whole stream """
+        import hashlib
+        from StringIO import StringIO
+        dst = StringIO()
+        md5 = hashlib.md5()
+        with open(self.hashfile, 'rb') as src:
+            assert misc.copy_stream(src, dst, hashers=[md5], blocksize=4) == 22
+        assert dst.getvalue() == "This is some contents\n"
+        assert md5.hexdigest() == self.hashfile_digests['MD5']
+
+    def test_copy_stream_size(self):
+        """ Ensure that copy_stream stops after the given number of bytes """
+        from StringIO import StringIO
+        dst = StringIO()
+        with open(self.hashfile, 'rb') as src:
+            assert misc.copy_stream(src, dst, blocksize=4, size=10) == 10
+            assert misc.copy_stream(src, None, size=100) == 12
+        assert dst.getvalue() == "This is so"
+
+    def test_hashfile_multi(self):
+        """ Ensure that several digests are calculated at once """
+        digests = misc.hashfile_multi(self.hashfile, hashers=self.hashfile_digests.keys(), blocksize=8)
+        assert digests == self.hashfile_digests
+
+    def test_write_checksum_manifests(self):
+        """ Ensure that the manifests can be checked with md5sum and sha256sum """
+        manifests = misc.write_checksum_manifests(self.rootdir, hashers=['MD5', 'SHA256'], workers=2)
+        assert sorted(manifests.keys()) == ['MD5', 'SHA256']
+        with open(manifests['MD5']) as fh:
+            assert fh.read() == '{}  test_hashfile\n'.format(self.hashfile_digests['MD5'])
+        with open(manifests['SHA256']) as fh:
+            assert fh.read() == '{}  test_hashfile\n'.format(self.hashfile_digests['SHA256'])
+        for manifest in manifests.values():
+            os.remove(manifest)
+
+    def test_checksum_cache(self):
+        """ Ensure that cached digests are used only while the file is unchanged """
+        cache = ChecksumCache(os.path.join(self.rootdir, 'checksums.db'))
+        assert misc.hashfile(self.hashfile, hasher='md5', cache=cache) == self.hashfile_digests['MD5']
+        cache.put(self.hashfile, {'md5': 'cached'}, misc.cache_key(self.hashfile))
+        assert misc.hashfile(self.hashfile, hasher='md5', cache=cache) == 'cached'
+        assert cache.verify(sample=5) == (1, [(os.path.abspath(self.hashfile), 'md5')])
+        assert cache.invalidate(self.rootdir) == 1
+        assert misc.hashfile(self.hashfile, hasher='md5', cache=cache) == self.hashfile_digests['MD5']
+        assert cache.verify(sample=5) == (1, [])
+        os.remove(cache.db_file)
+
+    def test_checksum_cache_verify_path(self):
+        """ Ensure that a shared cache only audits the entries under the given directory """
+        import mock
+        from taca.storage import storage
+        cache = ChecksumCache(os.path.join(self.rootdir, 'checksums.db'))
+        files = {}
+        # 'run1' is a prefix of 'run10', which should not be audited with it
+        for name in ['run1', 'run10']:
+            os.makedirs(os.path.join(self.rootdir, name))
+            files[name] = os.path.join(self.rootdir, name, 'file')
+            with open(files[name], 'w') as fh:
+                fh.write(name)
+            cache.put(files[name], {'md5': 'corrupted'}, misc.cache_key(files[name]))
+        run1 = os.path.join(self.rootdir, 'run1')
+        assert cache.verify(sample=5, path=run1) == (1, [(files['run1'], 'md5')])
+        assert cache.verify(sample=5, path=files['run10']) == (1, [(files['run10'], 'md5')])
+        assert cache.verify(sample=5)[0] == 2
+        with mock.patch.dict(storage.CONFIG, {'storage': {'checksum_cache': cache.db_file}}):
+            with mock.patch.object(ChecksumCache, 'verify', autospec=True, side_effect=ChecksumCache.verify) as verify:
+                assert not storage.verify_checksum_cache(run1, 5)
+        assert verify.call_args[1]['path'] == run1
+        for name in ['run1', 'run10']:
+            shutil.rmtree(os.path.join(self.rootdir, name))
+        os.remove(cache.db_file)
+
     def check_hash(self, alg, exp):
         assert misc.hashfile(self.hashfile,hasher=alg) == exp
         
@@ -84,4 +160,362 @@ class TestFilesystem(unittest.TestCase):
             os.path.exists(target_folder),
             "A non-existing parent folder was not created \
             but method returned True"
-        )
\ No newline at end of file
+        )
+
+    def test_scandir(self):
+        """ Ensure that scandir lists the entries with their type """
+        os.mkdir(os.path.join(self.rootdir, "a_dir"))
+        open(os.path.join(self.rootdir, "a_file"), 'w').close()
+        entries = dict((entry.name, entry) for entry in filesystem.scandir(self.rootdir))
+        self.assertEqual(sorted(entries.keys()), ["a_dir", "a_file"])
+        self.assertTrue(entries["a_dir"].is_dir())
+        self.assertTrue(entries["a_file"].is_file())
+        self.assertEqual(entries["a_file"].path, os.path.join(self.rootdir, "a_file"))
+
+    def test_tree_stats(self):
+        """ Ensure that tree_stats adds up the whole tree and caches unchanged directories """
+        import mock
+        tree = os.path.join(self.rootdir, "tree")
+        for subdir in ["a/b", "c"]:
+            os.makedirs(os.path.join(tree, subdir))
+        for name, size in [("top", 10), ("a/one", 20), ("a/b/two", 30), ("c/three", 40)]:
+            with open(os.path.join(tree, name), 'w') as fh:
+                fh.write("x" * size)
+        os.utime(os.path.join(tree, "a/b/two"), (2000000000, 2000000000))
+        os.utime(os.path.join(tree, "c"), (1000000000, 1000000000))
+        cache = os.path.join(self.rootdir, "tree_stats.db")
+        self.assertEqual(filesystem.tree_stats(tree, workers=2), (100, 4, 2000000000))
+        self.assertEqual(filesystem.tree_stats(tree, workers=2, cache=cache), (100, 4, 2000000000))
+        with mock.patch('taca.utils.filesystem.scandir', side_effect=filesystem.scandir) as scandir:
+            self.assertEqual(filesystem.tree_stats(tree, cache=cache), (100, 4, 2000000000))
+            self.assertEqual(scandir.call_count, 0)
+            with open(os.path.join(tree, "c/four"), 'w') as fh:
+                fh.write("x" * 50)
+            self.assertEqual(filesystem.tree_stats(tree, cache=cache), (150, 5, 2000000000))
+            self.assertEqual(scandir.call_count, 1)
+
+    def test_remove_tree(self):
+        """ Ensure that a tree moved to the trash is removed completely """
+        tree = os.path.join(self.rootdir, "tree")
+        os.makedirs(os.path.join(tree, "a", "b"))
+        for name in ["top", "a/one", "a/b/two"]:
+            with open(os.path.join(tree, name), 'w') as fh:
+                fh.write("x" * 10)
+        os.symlink(os.path.join(tree, "a"), os.path.join(tree, "link"))
+        trashed = filesystem.move_to_trash(tree)
+        self.assertFalse(os.path.exists(tree))
+        self.assertEqual(os.path.dirname(trashed), os.path.join(self.rootdir, filesystem.TRASH_DIR))
+        self.assertEqual(filesystem.remove_tree(trashed, workers=2, max_rate=1000)[0], 4)
+        self.assertEqual(os.listdir(os.path.join(self.rootdir, filesystem.TRASH_DIR)), [])
+
+    def make_tree(self, tree):
+        os.makedirs(os.path.join(tree, "a", "b"))
+        for name, size in [("top", 10), ("a/one", 20), ("a/b/two", 30)]:
+            with open(os.path.join(tree, name), 'w') as fh:
+                fh.write("x" * size)
+        os.symlink("a/one", os.path.join(tree, "link"))
+
+    def test_move_tree_rename(self):
+        """ Ensure that a tree on the same file system is just renamed """
+        src, dst = os.path.join(self.rootdir, "src"), os.path.join(self.rootdir, "dst")
+        self.make_tree(src)
+        self.assertTrue(filesystem.move_tree(src, dst))
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(os.readlink(os.path.join(dst, "link")), "a/one")
+
+    def test_move_tree_copy(self):
+        """ Ensure that a tree is copied across file systems, resuming a previous copy """
+        import errno
+        import mock
+        src, dst = os.path.join(self.rootdir, "src"), os.path.join(self.rootdir, "dst")
+        self.make_tree(src)
+        expected = filesystem.tree_stats(src)[:2]
+        # A previous copy was interrupted half way
+        staging = os.path.join(self.rootdir, ".dst.moving")
+        os.makedirs(os.path.join(staging, "a"))
+        shutil.copy2(os.path.join(src, "a/one"), os.path.join(staging, "a/one"))
+        with open(os.path.join(staging, "top"), 'w') as fh:
+            fh.write("x")
+        rename = os.rename
+        def cross_device(old, new):
+            if old == src:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(old, new)
+        with mock.patch('os.rename', side_effect=cross_device):
+            with mock.patch('taca.utils.filesystem._copy_file', side_effect=filesystem._copy_file) as copy_file:
+                self.assertFalse(filesystem.move_tree(src, dst, workers=2))
+        self.assertEqual(copy_file.call_count, 3)
+        self.assertFalse(os.path.exists(src))
+        self.assertFalse(os.path.exists(staging))
+        self.assertEqual(filesystem.tree_stats(dst)[:2], expected)
+        self.assertEqual(os.readlink(os.path.join(dst, "link")), "a/one")
+
+    def test_move_tree_interrupted_removal(self):
+        """ Ensure that a move interrupted while removing the source can be resumed """
+        import errno
+        import mock
+        src, dst = os.path.join(self.rootdir, "src"), os.path.join(self.rootdir, "dst")
+        self.make_tree(src)
+        expected = filesystem.tree_stats(src)[:2]
+        rename, unlink = os.rename, os.unlink
+        removed = []
+        def cross_device(old, new):
+            if old == src:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            rename(old, new)
+        def interrupted(path):
+            if len(removed) == 2:
+                raise OSError(errno.EIO, "Input/output error")
+            removed.append(path)
+            unlink(path)
+        with mock.patch('os.rename', side_effect=cross_device):
+            with mock.patch('os.unlink', side_effect=interrupted):
+                self.assertRaises(OSError, filesystem.move_tree, src, dst)
+        self.assertTrue(os.path.exists(src))
+        self.assertFalse(filesystem.move_tree(src, dst))
+        self.assertFalse(os.path.exists(src))
+        self.assertEqual(filesystem.tree_stats(dst)[:2], expected)
+        self.assertFalse(filesystem.move_tree(src, dst))
+
+    def test_move_tree_interrupted(self):
+        """ Ensure that only the source is removed if the tree was already moved """
+        src, dst = os.path.join(self.rootdir, "src"), os.path.join(self.rootdir, "dst")
+        self.make_tree(src)
+        shutil.copytree(src, dst, symlinks=True)
+        self.assertFalse(filesystem.move_tree(src, dst))
+        self.assertFalse(os.path.exists(src))
+        with open(os.path.join(dst, "top"), 'a') as fh:
+            fh.write("x")
+        self.make_tree(src)
+        self.assertRaises(OSError, filesystem.move_tree, src, dst)
+
+    def test_locked(self):
+        """ Ensure that a lock cannot be acquired twice """
+        lock_file = os.path.join(self.rootdir, "test.lock")
+        with filesystem.locked(lock_file) as acquired:
+            self.assertTrue(acquired)
+            with filesystem.locked(lock_file) as acquired_again:
+                self.assertFalse(acquired_again)
+        with filesystem.locked(lock_file) as acquired:
+            self.assertTrue(acquired, "The lock was not released")
+
+class TestLedger(unittest.TestCase):
+    """ Test class for the transfer ledger """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_ledger")
+        self.transfer_file = os.path.join(self.rootdir, 'transfer.tsv')
+        with open(self.transfer_file, 'w') as fh:
+            fh.write("141124_ST-COMPLETED1_01_AFCIDXX\t2014-11-25 10:00:00\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_import_existing_file(self):
+        """ Runs already in the transfer file are found """
+        ledger = TransferLedger(self.transfer_file)
+        self.assertTrue(ledger.is_transferred('141124_ST-COMPLETED1_01_AFCIDXX'))
+        self.assertFalse(ledger.is_transferred('141124_ST-RUNNING1_03_AFCIDXX'))
+
+    def test_add(self):
+        """ Added runs are written to the transfer file and indexed """
+        TransferLedger(self.transfer_file).add('141124_ST-TOSTART1_04_FCIDXXX')
+        self.assertTrue(TransferLedger(self.transfer_file).is_transferred('141124_ST-TOSTART1_04_FCIDXXX'))
+        self.assertTrue(filesystem.is_in_file(self.transfer_file, '141124_ST-TOSTART1_04_FCIDXXX'))
+
+    def test_external_changes(self):
+        """ Rows appended or removed by others are picked up """
+        ledger = TransferLedger(self.transfer_file)
+        self.assertFalse(ledger.is_transferred('141124_ST-TOSTART1_04_FCIDXXX'))
+        with open(self.transfer_file, 'a') as fh:
+            fh.write("141124_ST-TOSTART1_04_FCIDXXX\t2014-11-26 10:00:00\n")
+        self.assertTrue(ledger.is_transferred('141124_ST-TOSTART1_04_FCIDXXX'))
+        with open(self.transfer_file, 'w') as fh:
+            fh.write("141124_ST-TOSTART1_04_FCIDXXX\t2014-11-26 10:00:00\n")
+        self.assertFalse(ledger.is_transferred('141124_ST-COMPLETED1_01_AFCIDXX'))
+
+    def test_metrics(self):
+        """ Transfer metrics are stored and queried by run and date """
+        from datetime import datetime
+        metrics = TransferMetrics(os.path.join(self.rootdir, 'transfer_metrics.db'))
+        metrics.add('141124_ST-COMPLETED1_01_AFCIDXX', {'files': 2, 'bytes_sent': 2048, 'mb_per_s': 1.5},
+                    started=datetime(2014, 11, 25))
+        metrics.add('141124_ST-TOSTART1_04_FCIDXXX', {'files': 1, 'shards': 2}, started=datetime(2014, 11, 26))
+        self.assertEqual([t['run'] for t in metrics.query()],
+                         ['141124_ST-COMPLETED1_01_AFCIDXX', '141124_ST-TOSTART1_04_FCIDXXX'])
+        transfer = metrics.query(run_id='141124_ST-COMPLETED1_01_AFCIDXX')[0]
+        self.assertEqual((transfer['files'], transfer['bytes_sent'], transfer['shards']), (2, 2048, None))
+        self.assertEqual(len(metrics.query(since=datetime(2014, 11, 26))), 1)
+
+class TestSSH(unittest.TestCase):
+    """ Test class for the shared SSH connections """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_ssh")
+        self.calls = []
+
+    def tearDown(self):
+        ssh.close_all()
+        shutil.rmtree(self.rootdir)
+
+    def fake_ssh(self, cl, **kwargs):
+        """ Pretend to be ssh, the master connection being the control socket """
+        self.calls.append(cl)
+        control_path = [arg.split('=', 1)[1] for arg in cl if arg.startswith('ControlPath=')][0]
+        if 'ControlMaster=yes' in cl:
+            open(control_path, 'w').close()
+        elif cl[1:3] == ['-O', 'exit']:
+            os.remove(control_path)
+        return 0
+
+    def test_master_shared(self):
+        """ One master connection per host is opened, reused and closed """
+        import mock
+        config = {'control_dir': self.rootdir, 'options': ['ServerAliveInterval=30']}
+        with mock.patch('subprocess.call', side_effect=self.fake_ssh):
+            master = ssh.get_master('server', user='taca', config=config)
+            self.assertIs(ssh.get_master('server', user='taca', config=config), master)
+            self.assertEqual(len([cl for cl in self.calls if 'ControlMaster=yes' in cl]), 1)
+            self.assertEqual(master.command(), ['ssh', '-o', 'ControlPath={}'.format(master.control_path),
+                                                '-o', 'ServerAliveInterval=30'])
+            # The master timed out, it is opened again
+            os.remove(master.control_path)
+            self.assertIs(ssh.get_master('server', user='taca', config=config), master)
+            self.assertEqual(len([cl for cl in self.calls if 'ControlMaster=yes' in cl]), 2)
+            ssh.close_all()
+            self.assertFalse(os.path.exists(master.control_path))
+        self.assertIsNone(ssh.get_master('server', config={'control_master': False}))
+        self.assertIsNone(ssh.get_master(None))
+
+    def test_master_failure(self):
+        """ Connections are made without a master if it cannot be opened """
+        import mock
+        with mock.patch('subprocess.call', return_value=255):
+            self.assertIsNone(ssh.get_master('server', config={'control_dir': self.rootdir}))
+
+RSYNC_OUTPUT = """sending incremental file list
+Run/Demultiplexing/Sample_S1_L001_R1_001.fastq.gz
+     1,048,576  50%    1.00MB/s    0:00:01 (xfr#1, to-chk=1/3)\r     2,097,152 100%    1.00MB/s    0:00:02 (xfr#2, to-chk=0/3)
+
+Number of files: 3 (reg: 2, dir: 1)
+Number of regular files transferred: 2
+Total file size: 2,097,152 bytes
+Total transferred file size: 2,097,152 bytes
+File list generation time: 0.012 seconds
+Total bytes sent: 2,098,000
+Total bytes received: 60
+
+sent 2,098,000 bytes  received 60 bytes  838,824.00 bytes/sec
+total size is 2,097,152  speedup is 1.00
+"""
+
+class TestRsync(unittest.TestCase):
+    """ Test class for the rsync helpers """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_rsync")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_parse_stats(self):
+        """ The --stats summary is parsed into metrics """
+        self.assertEqual(rsync.parse_stats(RSYNC_OUTPUT.splitlines()),
+                         {'files': 2, 'total_size': 2097152, 'transferred_size': 2097152,
+                          'file_list_time': 0.012, 'bytes_sent': 2098000, 'bytes_received': 60,
+                          'speedup': 1})
+
+    def test_call_rsync(self):
+        """ The output is logged without the progress lines and parsed """
+        output = os.path.join(self.rootdir, 'output.txt')
+        with open(output, 'w') as fh:
+            fh.write(RSYNC_OUTPUT)
+        metrics = rsync.call_rsync(['cat', output], prefix='test', log_dir=self.rootdir, progress_interval=0)
+        self.assertEqual(metrics['bytes_sent'], 2098000)
+        self.assertIn('elapsed', metrics)
+        with open(os.path.join(self.rootdir, 'test_rsync.out')) as fh:
+            log = fh.read()
+        self.assertIn('Total bytes sent: 2,098,000', log)
+        self.assertNotIn('xfr#', log)
+        self.assertRaises(subprocess.CalledProcessError, rsync.call_rsync, ['false'], log_dir=self.rootdir)
+
+class TestBandwidth(unittest.TestCase):
+    """ Test class for the bandwidth limits """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_bandwidth")
+        self.config = {'windows': [{'start': '08:00', 'end': '18:00', 'days': ['Mon', 'Tue', 'Wed', 'Thu', 'Fri'],
+                                    'limit': 200},
+                                   {'start': '22:00', 'end': '06:00', 'limit': 0}],
+                       'default_limit': 400, 'adaptive': True, 'min_limit': 20, 'max_latency': 0.1}
+        self.state_file = os.path.join(self.rootdir, 'bandwidth.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_current_window(self):
+        """ Windows apply by time of day and weekday, also across midnight """
+        from datetime import datetime
+        windows = self.config['windows']
+        self.assertIs(bandwidth.current_window(windows, datetime(2016, 6, 13, 9)), windows[0])
+        # Sunday
+        self.assertIsNone(bandwidth.current_window(windows, datetime(2016, 6, 12, 9)))
+        self.assertIs(bandwidth.current_window(windows, datetime(2016, 6, 13, 23)), windows[1])
+        self.assertIs(bandwidth.current_window(windows, datetime(2016, 6, 14, 5)), windows[1])
+        self.assertIsNone(bandwidth.current_window(windows, datetime(2016, 6, 14, 20)))
+
+    def test_fixed_limits(self):
+        """ Without adaptation the limit is the one of the window """
+        from datetime import datetime
+        self.config['adaptive'] = False
+        controller = bandwidth.BandwidthController(self.config, self.state_file)
+        self.assertEqual(controller.limit(self.rootdir, now=datetime(2016, 6, 13, 9)), 200)
+        self.assertIsNone(controller.limit(self.rootdir, now=datetime(2016, 6, 13, 23)))
+        self.assertEqual(controller.limit(self.rootdir, now=datetime(2016, 6, 13, 20)), 400)
+        self.assertEqual(bandwidth.rsync_option(200), '--bwlimit=195312')
+        self.assertIsNone(bandwidth.rsync_option(None))
+
+    def test_adaptive_limit(self):
+        """ The limit goes down when the storage is slow and back up to the window limit """
+        import mock
+        from datetime import datetime
+        now = datetime(2016, 6, 13, 9)
+        controller = bandwidth.BandwidthController(self.config, self.state_file)
+        with mock.patch('taca.utils.bandwidth.storage_latency', return_value=0.5):
+            self.assertEqual(controller.limit(self.rootdir, now=now), 100)
+            controller.record(99)
+            self.assertEqual(controller.limit(self.rootdir, now=now), 50)
+            self.assertEqual(controller.limit(self.rootdir, now=now), 25)
+            self.assertEqual(controller.limit(self.rootdir, now=now), 20)
+        with mock.patch('taca.utils.bandwidth.storage_latency', return_value=0.01):
+            # The previous transfer did not use all the bandwidth allowed
+            controller.record(10)
+            self.assertEqual(controller.limit(self.rootdir, now=now), 20)
+            controller.record(19)
+            self.assertEqual(controller.limit(self.rootdir, now=now), 25)
+            for _ in range(10):
+                controller.record(controller.limit(self.rootdir, now=now))
+            self.assertEqual(controller.limit(self.rootdir, now=now), 200)
+            # Unlimited window, only lowered when the storage is slow
+            self.assertIsNone(controller.limit(self.rootdir, now=datetime(2016, 6, 13, 23)))
+            controller.record(300)
+        with mock.patch('taca.utils.bandwidth.storage_latency', return_value=0.5):
+            self.assertEqual(controller.limit(self.rootdir, now=datetime(2016, 6, 13, 23)), 150)
+
+    def test_concurrent_updates(self):
+        """ Concurrent updates of the state are all kept """
+        from multiprocessing.pool import ThreadPool
+        controller = bandwidth.BandwidthController(self.config, self.state_file)
+        pool = ThreadPool(8)
+        try:
+            pool.map(lambda i: controller._save('window{}'.format(i), throughput=i), range(50))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(state['throughput'] for state in controller._load().values()), range(50))
+        self.assertEqual(sorted(os.listdir(self.rootdir)), ['bandwidth.json', 'bandwidth.json.lock'])
+
+    def test_storage_latency(self):
+        """ The latency probe leaves nothing behind """
+        self.assertGreaterEqual(bandwidth.storage_latency(self.rootdir), 0)
+        self.assertEqual(os.listdir(self.rootdir), [])